@@ -1,27 +1,110 @@
 import structlog
 import os
+import asyncio
 import redis
 import json
 import uuid
 import base64
+import zipfile
+import io
 from typing import List, Optional
-from fastapi import APIRouter, UploadFile, File, Form, HTTPException, Query
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException, Query, Response
+from fastapi.responses import StreamingResponse
 from app.logging_config import get_logger, setup_logging
-from app.constants import TASK_TYPES
-from app.config import S3StorageClient
-from app.processing import run_inference_and_visualize
+from app.constants import TASK_TYPES, TEXT_TASKS
+from app.config import INPUT_DEDUP, get_storage_client
+from app.processing import run_inference_and_visualize, run_multi_inference_and_visualize
+from app.render import ENCODINGS, has_visualization, render_encoded_async, mime_type
+from app.visualization_store import VISUALIZE_MODES, VISUALIZE_DEFAULT
+from app.jobs import sse_event
 
 # 1. Initialize Logging and Global Clients
 setup_logging()
 logger = get_logger(__name__)
-storage_client = S3StorageClient()
-from app.redis_model_proxy import RedisModelProxy
+storage_client = get_storage_client()
+from app.redis_model_proxy import RedisModelProxy, MODEL_TIMEOUT, BATCH_MAX_IN_FLIGHT
 
 # Instantiate the proxy
 model_proxy = RedisModelProxy()
 
+# Most images one /predict_batch call accepts, files and archive members together
+PREDICT_BATCH_MAX_ITEMS = int(os.environ.get("PREDICT_BATCH_MAX_ITEMS", "1000"))
+ARCHIVE_IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp", ".gif", ".tif", ".tiff")
+
 florence_router = APIRouter(tags=["Run Florence LLM"])
 
+
+async def store_input_image(image_bytes, file, store_image, request_id, path_prefix, keep_input=False):
+    """
+    Uploads the input image and returns (its presigned URL, its object key),
+    or (a base64 data URL, None) when store_image is off.
+    With INPUT_DEDUP the image is stored by content hash, so repeats share one object.
+    keep_input stores it by content hash even when store_image is off, for a lazy visualization
+    to download later; the response still carries the data URL.
+    """
+    if store_image and INPUT_DEDUP:
+        input_key = await storage_client.store_content_addressed(image_bytes, file.content_type or "application/octet-stream")
+        return storage_client.generate_presigned_url(input_key), input_key
+
+    if store_image:
+        # Match the keys expected by S3StorageClient.upload_file (**kwargs)
+        input_upload = await storage_client.upload_file(
+            data=image_bytes,           # Use 'data', not 'file_bytes'
+            mime=file.content_type,     # Use 'mime', not 'mime_type'
+            object_key=file.filename,
+            threadId=request_id,
+            path_prefix=path_prefix
+        )
+        # Get Presigned URL using the URL returned by the upload
+        input_key = input_upload["url"].split(f"{storage_client.bucket}/")[-1]
+        # Presigning is signed locally, it makes no request
+        return storage_client.generate_presigned_url(input_key), input_key
+
+    input_key = None
+    if keep_input:
+        input_key = await storage_client.store_content_addressed(image_bytes, file.content_type or "application/octet-stream")
+
+    # Convert to Base64 (This part was correct)
+    b64_input = base64.b64encode(image_bytes).decode('utf-8')
+    return f"data:{file.content_type};base64,{b64_input}", input_key
+
+
+def encode_outputs(output_data, store_image, image_format="png"):
+    """RESTORE THE CONTRACT: Convert bytes to Base64 if not stored in S3"""
+    final_outputs = []
+    for item in output_data:
+        if store_image:
+            # If it's a string, it's already an S3 URL
+            final_outputs.append(item)
+        else:
+            # If it's bytes, FastAPI will crash unless we Base64 encode it
+            b64_output = base64.b64encode(item).decode('utf-8')
+            final_outputs.append(f"data:{mime_type(image_format)};base64,{b64_output}")
+    return final_outputs
+
+
+def validate_visualization(visualize, image_format, image_quality):
+    if visualize not in VISUALIZE_MODES:
+        raise HTTPException(status_code=400, detail=f"visualize must be one of {list(VISUALIZE_MODES)}")
+    if image_format not in ENCODINGS:
+        raise HTTPException(status_code=400, detail=f"image_format must be one of {list(ENCODINGS)}")
+    if image_quality is not None and not 1 <= image_quality <= 100:
+        raise HTTPException(status_code=400, detail="image_quality must be between 1 and 100")
+
+
+async def save_for_lazy_visualization(request_id, results, input_key):
+    """Keeps the results (task -> result) so /visualize can draw them later. Returns the URL to fetch them from."""
+    if input_key is None or not any(has_visualization(task) for task in results):
+        return None
+    await model_proxy.visualizations.save(request_id, results, input_key)
+    return f"/v1/visualize/{request_id}"
+
+
+def validate_profile(profile):
+    if profile and profile not in model_proxy.config.GENERATION_PROFILES:
+        raise HTTPException(status_code=400, detail=f"Unknown profile '{profile}'. Available: {sorted(model_proxy.config.GENERATION_PROFILES)}")
+
+
 """
 store_image Flag determines whether API should store the images in Blob storage and return the path to the file 
 or should return the image bytes 
@@ -31,60 +114,55 @@ async def predict(
     task: str = Form(...),
     text_input: Optional[str] = Form(None),
     file: UploadFile = File(...),
-    store_image: bool = Form(True)
+    store_image: bool = Form(True),
+    use_cache: bool = Form(True),
+    profile: Optional[str] = Form(None, description="Generation profile, see /profiles. Defaults to the task's profile."),
+    visualize: str = Form(VISUALIZE_DEFAULT, description="eager: overlay in the response, lazy: render on GET /visualize/{request_id}, none: no overlay"),
+    image_format: str = Form("png", description="Overlay encoding: png, webp or jpeg"),
+    image_quality: Optional[int] = Form(None, description="Overlay quality for webp/jpeg, 1-100")
 ):
+    validate_profile(profile)
+    validate_visualization(visualize, image_format, image_quality)
+
     try:
-        request_id = structlog.contextvars.get_contextvars().get("request_id")
+        request_id = structlog.contextvars.get_contextvars().get("request_id") or uuid.uuid4().hex
         image_bytes = await file.read()
         
-        input_representation = None
-        
         logger.info(f"API Prediction request received reqest_id={request_id}, task={task}, store_image={store_image}")
         
         path_prefix = "fastapi"
-        # 1. HANDLE INPUT IMAGE
-        if store_image:
-            # Match the keys expected by S3StorageClient.upload_file (**kwargs)
-            input_upload = await storage_client.upload_file(
-                data=image_bytes,           # Use 'data', not 'file_bytes'
-                mime=file.content_type,     # Use 'mime', not 'mime_type'
-                object_key=file.filename,
-                threadId=request_id,
-                path_prefix=path_prefix
-            )
-            # Get Presigned URL using the URL returned by the upload
-            input_key = input_upload["url"].split(f"{storage_client.bucket}/")[-1]
-            input_representation = storage_client.generate_presigned_url(input_key)
-        else:
-            # Convert to Base64 (This part was correct)
-            b64_input = base64.b64encode(image_bytes).decode('utf-8')
-            input_representation = f"data:{file.content_type};base64,{b64_input}"
+        # 1. HANDLE INPUT IMAGE: uploaded while the model runs, nothing in inference needs it
+        # A lazy overlay is drawn from the stored input later, so that is kept even without store_image
+        keep_input = visualize == "lazy" and has_visualization(task)
+        input_upload = asyncio.create_task(store_input_image(image_bytes, file, store_image, request_id, path_prefix, keep_input))
 
        # 2. Run inference via the Proxy
-        result, output_data = await run_inference_and_visualize(
-            model=model_proxy, 
-            task_type=task, 
-            text_input=text_input, 
-            image_bytes=image_bytes,
-            return_path=store_image,
-            request_id=request_id,
-            path_prefix=path_prefix
-        )
+        try:
+            result, output_data = await run_inference_and_visualize(
+                model=model_proxy, 
+                task_type=task, 
+                text_input=text_input, 
+                image_bytes=image_bytes,
+                return_path=store_image,
+                request_id=request_id,
+                path_prefix=path_prefix,
+                use_cache=use_cache,
+                profile=profile,
+                visualize=visualize == "eager",
+                image_format=image_format,
+                image_quality=image_quality
+            )
+        except BaseException:
+            input_upload.cancel()
+            raise
+        input_representation, input_key = await input_upload
 
         logger.info("processing of image complete")
         
         # 3. RESTORE THE CONTRACT: Convert bytes to Base64 if not stored in S3
-        final_outputs = []
-        for item in output_data:
-            if store_image:
-                # If it's a string, it's already an S3 URL
-                final_outputs.append(item)
-            else:
-                # If it's bytes, FastAPI will crash unless we Base64 encode it
-                b64_output = base64.b64encode(item).decode('utf-8')
-                final_outputs.append(f"data:image/png;base64,{b64_output}")
+        final_outputs = encode_outputs(output_data, store_image, image_format)
 
-        return {
+        response = {
             "request_id": request_id,
             "task": task,
             "store_image_enabled": store_image,
@@ -92,17 +170,363 @@ async def predict(
             "result_data": result,
             "output_visualized": final_outputs 
         }
+        if visualize == "lazy":
+            response["visualize_url"] = await save_for_lazy_visualization(request_id, {task: result}, input_key)
+        return response
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.exception("API Prediction failed", error=str(e))
         raise HTTPException(status_code=500, detail=str(e))
 
+
+"""
+Runs several tasks on one image in one call. The image is uploaded and encoded by the model only once.
+tasks is a JSON list whose items are either a task name or {"task": ..., "text_input": ...}, e.g.
+["<OD>", "<MORE_DETAILED_CAPTION>", {"task": "<CAPTION_TO_PHRASE_GROUNDING>", "text_input": "a red car"}]
+"""
+@florence_router.post("/predict_multi")
+async def predict_multi(
+    tasks: str = Form(..., description='JSON list of task names or {"task": ..., "text_input": ...} objects'),
+    file: UploadFile = File(...),
+    store_image: bool = Form(True),
+    use_cache: bool = Form(True),
+    profile: Optional[str] = Form(None, description="Generation profile applied to every task. Defaults to each task's profile."),
+    visualize: str = Form(VISUALIZE_DEFAULT, description="eager: overlays in the response, lazy: render on GET /visualize/{request_id}, none: no overlays"),
+    image_format: str = Form("png", description="Overlay encoding: png, webp or jpeg"),
+    image_quality: Optional[int] = Form(None, description="Overlay quality for webp/jpeg, 1-100")
+):
+    validate_profile(profile)
+    validate_visualization(visualize, image_format, image_quality)
+
+    try:
+        raw_tasks = json.loads(tasks)
+        task_list = [
+            (item, None) if isinstance(item, str) else (item["task"], item.get("text_input"))
+            for item in raw_tasks
+        ]
+    except (ValueError, TypeError, KeyError):
+        raise HTTPException(status_code=400, detail="tasks must be a JSON list of task names or {\"task\", \"text_input\"} objects")
+
+    unknown = [task for task, _ in task_list if task not in TASK_TYPES]
+    if not task_list or unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown or missing tasks: {unknown}. See /tasks.")
+
+    try:
+        request_id = structlog.contextvars.get_contextvars().get("request_id") or uuid.uuid4().hex
+        image_bytes = await file.read()
+
+        logger.info("API multi-task prediction request received", tasks=[t for t, _ in task_list], store_image=store_image)
+
+        path_prefix = "fastapi"
+        # The input upload overlaps with inference, see /predict
+        keep_input = visualize == "lazy" and any(has_visualization(task) for task, _ in task_list)
+        input_upload = asyncio.create_task(store_input_image(image_bytes, file, store_image, request_id, path_prefix, keep_input))
+
+        try:
+            outputs = await run_multi_inference_and_visualize(
+                model=model_proxy,
+                tasks=task_list,
+                image_bytes=image_bytes,
+                return_path=store_image,
+                request_id=request_id,
+                path_prefix=path_prefix,
+                use_cache=use_cache,
+                profile=profile,
+                visualize=visualize == "eager",
+                image_format=image_format,
+                image_quality=image_quality
+            )
+        except BaseException:
+            input_upload.cancel()
+            raise
+        input_representation, input_key = await input_upload
+
+        response = {
+            "request_id": request_id,
+            "store_image_enabled": store_image,
+            "input_image": input_representation,
+            "results": [
+                {
+                    "task": task,
+                    "text_input": text_input,
+                    "result_data": result,
+                    "output_visualized": encode_outputs(output_data, store_image, image_format)
+                }
+                for (task, text_input), (result, output_data) in zip(task_list, outputs)
+            ]
+        }
+        if visualize == "lazy":
+            response["visualize_url"] = await save_for_lazy_visualization(
+                request_id, {task: result for (task, _), (result, _) in zip(task_list, outputs)}, input_key
+            )
+        return response
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("API multi-task prediction failed", error=str(e))
+        raise HTTPException(status_code=500, detail=str(e))
+
+"""
+Streams a text task's output while the model generates it, as server-sent events:
+  event: partial  data: {"text": "..."}   the text so far, replaces the previous partial
+  event: result   data: {"request_id", "task", "result_data"}   the parsed result, always last
+  event: error    data: {"detail", "status_code"}
+Only for text tasks (see TEXT_TASKS), nothing is stored or visualized.
+"""
+@florence_router.post("/predict_stream")
+async def predict_stream(
+    task: str = Form(...),
+    text_input: Optional[str] = Form(None),
+    file: UploadFile = File(...),
+    use_cache: bool = Form(True),
+    profile: Optional[str] = Form(None, description="Generation profile, see /profiles. Defaults to the task's profile.")
+):
+    validate_profile(profile)
+    if task not in TEXT_TASKS:
+        raise HTTPException(status_code=400, detail=f"Streaming is available for text tasks only: {TEXT_TASKS}")
+
+    request_id = structlog.contextvars.get_contextvars().get("request_id") or uuid.uuid4().hex
+    image_bytes = await file.read()
+    logger.info("API streaming prediction request received", request_id=request_id, task=task)
+    # Decided before the stream starts, so an overloaded queue gets a real status and Retry-After
+    await model_proxy.admission.admit(MODEL_TIMEOUT)
+
+    async def events():
+        try:
+            async for kind, value in model_proxy.stream_example(task, text_input, image_bytes, use_cache=use_cache, profile=profile):
+                if kind == "partial":
+                    yield sse_event("partial", {"text": value})
+                else:
+                    yield sse_event("result", {"request_id": request_id, "task": task, "result_data": value})
+        except HTTPException as e:
+            error = {"detail": e.detail, "status_code": e.status_code}
+            if e.headers and "Retry-After" in e.headers:
+                # Rejected by the dispatch's own admission check after the status line was sent
+                error["retry_after"] = int(e.headers["Retry-After"])
+            yield sse_event("error", error)
+        except Exception as e:
+            logger.exception("API streaming prediction failed", error=str(e))
+            yield sse_event("error", {"detail": str(e), "status_code": 500})
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+def read_archive(data):
+    """(name, bytes) of every image in a zip archive, in archive order. Directories and other files are skipped."""
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        return [
+            (info.filename, archive.read(info))
+            for info in archive.infolist()
+            if not info.is_dir() and info.filename.lower().endswith(ARCHIVE_IMAGE_EXTENSIONS)
+        ]
+
+
+"""
+Runs one task on many images in one call: upload them as repeated `files` fields and/or one zip `archive`.
+Results stream back as NDJSON, one line per image in completion order:
+{"index": 0, "filename": "a.jpg", "task": "<OD>", "result_data": {...}} or {"index": ..., "filename": ..., "error": ..., "status_code": ...}
+Nothing is stored or visualized, at most BATCH_MAX_IN_FLIGHT images of a call are queued at a time.
+"""
+@florence_router.post("/predict_batch")
+async def predict_batch(
+    task: str = Form(...),
+    text_input: Optional[str] = Form(None),
+    files: Optional[List[UploadFile]] = File(None),
+    archive: Optional[UploadFile] = File(None, description="zip archive of images"),
+    use_cache: bool = Form(True),
+    profile: Optional[str] = Form(None, description="Generation profile, see /profiles. Defaults to the task's profile.")
+):
+    validate_profile(profile)
+    if task not in TASK_TYPES:
+        raise HTTPException(status_code=400, detail=f"Unknown task {task}. See /tasks.")
+
+    # Uploads are read up front, they are closed once the streaming response starts
+    items = [(file.filename, await file.read()) for file in files or []]
+    if archive is not None:
+        try:
+            items += await asyncio.to_thread(read_archive, await archive.read())
+        except zipfile.BadZipFile:
+            raise HTTPException(status_code=400, detail="archive is not a valid zip file")
+    if not items:
+        raise HTTPException(status_code=400, detail="Send at least one image in files or archive")
+    if len(items) > PREDICT_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {PREDICT_BATCH_MAX_ITEMS} images per call")
+
+    logger.info("API batch prediction request received", task=task, items=len(items))
+    # Decided before the stream starts, so an overloaded queue still gets a real status and Retry-After.
+    # Later windows are not checked again, they only refill as earlier items finish.
+    await model_proxy.admission.admit(MODEL_TIMEOUT, items=min(len(items), BATCH_MAX_IN_FLIGHT))
+
+    async def lines():
+        try:
+            async for index, outcome in model_proxy.run_many(task, [data for _, data in items], text_input=text_input,
+                                                             use_cache=use_cache, profile=profile):
+                line = {"index": index, "filename": items[index][0], "task": task}
+                if isinstance(outcome, HTTPException):
+                    line.update(error=outcome.detail, status_code=outcome.status_code)
+                else:
+                    line["result_data"] = outcome
+                yield json.dumps(line) + "\n"
+        except Exception as e:
+            # The status line is long gone, report the failure in-band
+            logger.exception("API batch prediction failed", error=str(e))
+            yield json.dumps({"error": str(e), "status_code": 500}) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+"""
+Job mode: /jobs returns a job id right away instead of holding the connection for the queue wait
+and inference. Poll /jobs/{job_id} or follow /jobs/{job_id}/events (SSE) for
+queued -> batched -> generating -> done | failed. Jobs and their results expire after JOB_TTL.
+"""
+@florence_router.post("/jobs", status_code=202)
+async def submit_job(
+    task: str = Form(...),
+    text_input: Optional[str] = Form(None),
+    file: UploadFile = File(...),
+    use_cache: bool = Form(True),
+    profile: Optional[str] = Form(None, description="Generation profile, see /profiles. Defaults to the task's profile.")
+):
+    validate_profile(profile)
+    if task not in TASK_TYPES:
+        raise HTTPException(status_code=400, detail=f"Unknown task {task}. See /tasks.")
+
+    try:
+        image_bytes = await file.read()
+        job_id = await model_proxy.submit_job(task, text_input, image_bytes, use_cache=use_cache, profile=profile)
+        return {
+            "job_id": job_id,
+            "status_url": f"/v1/jobs/{job_id}",
+            "events_url": f"/v1/jobs/{job_id}/events",
+        }
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("Job submission failed", error=str(e))
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@florence_router.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """The job's status, and its result_data or error once it is final."""
+    try:
+        job = await model_proxy.jobs.get(job_id)
+    except Exception as e:
+        logger.exception("Failed to read job", job_id=job_id, error=str(e))
+        raise HTTPException(status_code=500, detail="Internal server error while reading the job")
+
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired job")
+    return job
+
+
+@florence_router.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """Server-sent events: the current status first, then every change. The last event carries the result."""
+    return StreamingResponse(
+        model_proxy.jobs.events(job_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@florence_router.get("/visualize/{request_id}")
+async def visualize_request(
+    request_id: str,
+    task: Optional[str] = Query(None, description="Task to draw, defaults to the request's first drawable task"),
+    image_format: str = Query("png", description="png, webp or jpeg"),
+    image_quality: Optional[int] = Query(None, description="Quality for webp/jpeg, 1-100")
+):
+    """
+    Draws the overlay of a /predict or /predict_multi request made with visualize=lazy.
+    The first call renders it, later calls with the same task and encoding are served from cache.
+    """
+    validate_visualization("lazy", image_format, image_quality)
+
+    try:
+        store = model_proxy.visualizations
+        source = await store.load(request_id)
+        if source is None:
+            raise HTTPException(status_code=404, detail="Unknown or expired request_id, or it was not made with visualize=lazy")
+
+        results = source["results"]
+        if task is None:
+            task = next((t for t in results if has_visualization(t)), None)
+        if task not in results or not has_visualization(task):
+            raise HTTPException(status_code=404, detail=f"No drawable result for task {task}")
+
+        overlay = await store.get_overlay(request_id, task, image_format, image_quality)
+        if overlay is None:
+            image_bytes = await storage_client.download_file(source["input_key"])
+            overlay = await render_encoded_async(task, results[task][task], image_bytes, image_format, image_quality)
+            await store.set_overlay(request_id, task, image_format, image_quality, overlay)
+            logger.info("Rendered lazy visualization", request_id=request_id, task=task, image_format=image_format)
+
+        return Response(content=overlay, media_type=mime_type(image_format))
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("Lazy visualization failed", error=str(e))
+        raise HTTPException(status_code=500, detail="Internal server error while rendering the visualization")
+
+
 @florence_router.get("/tasks", response_model=List[str])
 async def get_tasks():
     logger.info("Fetching available task types")
     return TASK_TYPES
 
 
+@florence_router.get("/profiles")
+async def get_profiles():
+    """Available generation profiles and which one each task uses by default."""
+    config = model_proxy.config
+    return {
+        "profiles": config.GENERATION_PROFILES,
+        "default_profile": config.DEFAULT_GENERATION_PROFILE,
+        "task_defaults": {task: config.resolve_profile(task) for task in TASK_TYPES},
+    }
+
+
+@florence_router.get("/cache/stats")
+async def get_cache_stats():
+    """Hit/miss counters and size of the shared inference result cache."""
+    try:
+        return await model_proxy.cache_stats()
+    except Exception as e:
+        logger.exception("Failed to read cache stats", error=str(e))
+        raise HTTPException(status_code=500, detail="Internal server error while reading cache stats")
+
+
+@florence_router.get("/worker/metrics")
+async def get_worker_metrics():
+    """Current batch settings, controller decisions and latency/throughput of every model worker."""
+    try:
+        return await model_proxy.worker_metrics()
+    except Exception as e:
+        logger.exception("Failed to read worker metrics", error=str(e))
+        raise HTTPException(status_code=500, detail="Internal server error while reading worker metrics")
+
+
+@florence_router.get("/ready")
+async def get_ready():
+    """Ready once at least one model worker has warmed up and keeps sending heartbeats, 503 otherwise."""
+    try:
+        workers = await model_proxy.ready_workers()
+    except Exception as e:
+        logger.exception("Failed to read worker heartbeats", error=str(e))
+        raise HTTPException(status_code=503, detail="Readiness unknown, Redis is not reachable")
+    if not workers:
+        raise HTTPException(status_code=503, detail="No model worker is ready")
+    return {"ready": True, "workers": workers}
+
+
 @florence_router.get("/refresh-url")
 async def refresh_url(url: str = Query(..., description="The S3 URL or object key to refresh")):
     """
@@ -122,7 +546,7 @@ async def refresh_url(url: str = Query(..., description="The S3 URL or object ke
             s3_key = url
 
         # 2. Check if the file actually exists in MinIO
-        if not storage_client.file_exists(s3_key):
+        if not await storage_client.object_exists(s3_key):
             logger.warning("File not found for refresh", key=s3_key)
             raise HTTPException(status_code=404, detail="File does not exist or has been deleted by lifecycle policy.")
 
@@ -0,0 +1,92 @@
+import os
+import math
+import time
+from fastapi import HTTPException
+from app.logging_config import get_logger
+from app.batch_controller import WORKER_METRICS_KEY_PREFIX
+
+logger = get_logger(__name__)
+
+# Rejects new tasks up front when they could not finish in time anyway, instead of letting them
+# wait out MODEL_TIMEOUT in the queue and piling more images into Redis
+ADMISSION_CONTROL = os.environ.get("ADMISSION_CONTROL", "true").lower() == "true"
+# Hard cap on queued tasks, whatever the estimate says. 0 disables it.
+MAX_QUEUE_LENGTH = int(os.environ.get("MAX_QUEUE_LENGTH", "500"))
+# 503 (overloaded) by default, 429 suits clients that treat it as a rate limit
+ADMISSION_REJECT_STATUS = int(os.environ.get("ADMISSION_REJECT_STATUS", "503"))
+# Retry-After sent when the queue is full and no throughput figure is known yet
+ADMISSION_RETRY_AFTER_S = int(os.environ.get("ADMISSION_RETRY_AFTER_S", "5"))
+# How long a process reuses the throughput read from the workers' metrics (they publish every BATCH_ADJUST_INTERVAL_S)
+ADMISSION_REFRESH_S = float(os.environ.get("ADMISSION_REFRESH_S", "2"))
+
+
+class AdmissionController:
+    """
+    Estimates how long a new task would wait: the tasks ahead of it divided by the workers'
+    combined requests_per_s. Ahead of it are the queue in Redis plus the tasks the workers have
+    already taken off it, which they publish with their metrics: waiting_tasks (prepared or held
+    for batching) and active_tasks (decoding).
+
+    requests_per_s only measures capacity when tasks were left waiting at the end of the window;
+    while the workers keep up it is just the arrival rate. So only such windows update it, and the
+    last such figure is kept in between. Until one is known, only MAX_QUEUE_LENGTH applies.
+    """
+    def __init__(self, client, queue):
+        self.client = client
+        self.queue = queue
+        self._throughput = None
+        self._worker_backlog = 0
+        self._refreshed_at = 0.0
+
+    async def refresh(self):
+        """
+        (throughput, worker backlog): requests per second all workers together complete, None until
+        measured under backlog, and the tasks they hold. Re-read at most every ADMISSION_REFRESH_S.
+        """
+        if time.time() - self._refreshed_at < ADMISSION_REFRESH_S:
+            return self._throughput, self._worker_backlog
+        self._refreshed_at = time.time()
+
+        total, backlog = 0.0, 0
+        async for key in self.client.scan_iter(match=f"{WORKER_METRICS_KEY_PREFIX}:*"):
+            requests_per_s, queue_depth, waiting, active = await self.client.hmget(
+                key, "requests_per_s", "queue_depth", "waiting_tasks", "active_tasks"
+            )
+            if requests_per_s is None:
+                continue
+            waiting = int(waiting or 0)
+            backlog += waiting + int(active or 0)
+            # Tasks were waiting for this worker, whether still in Redis or already pulled
+            if int(queue_depth or 0) + waiting > 0:
+                total += float(requests_per_s)
+        if total > 0:
+            self._throughput = total
+        self._worker_backlog = backlog
+        return self._throughput, self._worker_backlog
+
+    async def admit(self, budget_s, items=1):
+        """
+        Raises HTTPException(ADMISSION_REJECT_STATUS) with a Retry-After header when queueing items
+        more tasks would pass MAX_QUEUE_LENGTH, or their estimated wait would exceed budget_s.
+        """
+        if not ADMISSION_CONTROL:
+            return
+        depth = await self.queue.depth()
+        throughput, worker_backlog = await self.refresh()
+
+        if MAX_QUEUE_LENGTH and depth + items > MAX_QUEUE_LENGTH:
+            # Time until enough of the queue has drained for these items to fit
+            retry_after = (depth + items - MAX_QUEUE_LENGTH) / throughput if throughput else ADMISSION_RETRY_AFTER_S
+            self._reject("Task queue is full, retry later", retry_after, depth=depth, cap=MAX_QUEUE_LENGTH)
+
+        if throughput:
+            wait_s = (depth + worker_backlog + items) / throughput
+            if wait_s > budget_s:
+                self._reject("Model workers are overloaded, retry later", wait_s - budget_s, depth=depth,
+                             worker_backlog=worker_backlog, estimated_wait_s=round(wait_s, 1), budget_s=budget_s)
+
+    def _reject(self, detail, retry_after_s, **fields):
+        retry_after = max(1, math.ceil(retry_after_s))
+        logger.warning("Request rejected by admission control", reason=detail, retry_after_s=retry_after, **fields)
+        raise HTTPException(status_code=ADMISSION_REJECT_STATUS, detail=detail,
+                            headers={"Retry-After": str(retry_after)})
@@ -0,0 +1,152 @@
+import os
+from abc import ABC, abstractmethod
+import torch
+from app.logging_config import get_logger
+
+logger = get_logger(__name__)
+
+BACKENDS = ("torch", "onnx")
+# File names scripts/export_onnx.py writes into ONNX_MODEL_DIR
+ONNX_GRAPHS = ("vision_encoder", "prefill", "decode_step")
+
+
+class InferenceBackend(ABC):
+    """
+    The three step level operations the continuous batching scheduler runs the model through.
+    Tensors in and out are torch tensors on the model's device, whatever executes the graphs:
+
+    - encode_image(pixel_values) -> image features
+    - prefill(image_features, input_ids, attention_mask) -> (cross_kv, encoder mask)
+    - decode_step(tokens, positions, self_kv, self_valid, cross_kv, cross_valid) -> (logits, self_kv)
+
+    A key/value cache is a list of (k, v) pairs in the backend's own layout, rows on dim -4 and
+    length on dim -2: one pair per decoder layer for torch, a single pair of all layers stacked
+    for onnx. The scheduler only selects, pads and concatenates along those two dims, so each
+    backend gets back the layout it produced. See Florence2Model for the shapes. Tokenization,
+    generation rules and parsing stay with the processor, so every backend produces the same replies.
+    """
+    name = None
+
+    @abstractmethod
+    def encode_image(self, pixel_values):
+        ...
+
+    @abstractmethod
+    def prefill(self, image_features, input_ids, attention_mask):
+        ...
+
+    @abstractmethod
+    def decode_step(self, tokens, positions, self_kv, self_valid, cross_kv, cross_valid):
+        ...
+
+
+class TorchBackend(InferenceBackend):
+    """The PyTorch modules of the loaded transformers model, in the configured CPU precision."""
+    name = "torch"
+
+    def __init__(self, model):
+        self.model = model
+
+    def encode_image(self, pixel_values):
+        return self.model.encode_image(pixel_values)
+
+    def prefill(self, image_features, input_ids, attention_mask):
+        return self.model.prefill(image_features, input_ids, attention_mask)
+
+    def decode_step(self, tokens, positions, self_kv, self_valid, cross_kv, cross_valid):
+        return self.model.decode_step(tokens, positions, self_kv, self_valid, cross_kv, cross_valid)
+
+
+class OnnxBackend(InferenceBackend):
+    """
+    ONNX Runtime sessions of the graphs exported by scripts/export_onnx.py. The key/value caches
+    stay in the graphs' stacked (layers, rows, heads, length, head_dim) layout between steps.
+
+    Decode steps run through an IOBinding. The cross-attention cache only changes when rows are
+    admitted or retired, so it is bound once per change instead of being fed again every token.
+    The self-attention cache of a step is written by the session straight into a tensor that
+    becomes the next step's input.
+    """
+    name = "onnx"
+
+    def __init__(self, model_dir, threads=None):
+        # Optional dependency, only needed with INFERENCE_BACKEND=onnx
+        import onnxruntime as ort
+
+        self._ort = ort
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = threads or torch.get_num_threads()
+        self.sessions = {}
+        for graph in ONNX_GRAPHS:
+            path = os.path.join(model_dir, f"{graph}.onnx")
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"{path} is missing, export it with scripts/export_onnx.py")
+            self.sessions[graph] = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self._decode_binding = self.sessions["decode_step"].io_binding()
+        # The scheduler's cross cache tensors currently bound, and the contiguous copies bound in their place
+        self._cross_sources = ()
+        self._cross_bound = ()
+        logger.info("ONNX Runtime backend loaded", model_dir=model_dir, threads=options.intra_op_num_threads)
+
+    def _run(self, graph, **inputs):
+        feed = {name: tensor.detach().cpu().contiguous().numpy() for name, tensor in inputs.items()}
+        return [torch.from_numpy(output) for output in self.sessions[graph].run(None, feed)]
+
+    def _bind_input(self, name, tensor):
+        """Binds a contiguous CPU tensor without copying it; the caller keeps it alive until the run."""
+        self._decode_binding.bind_ortvalue_input(name, self._ort.OrtValue.ortvalue_from_numpy(tensor.numpy()))
+
+    def encode_image(self, pixel_values):
+        return self._run("vision_encoder", pixel_values=pixel_values.float())[0]
+
+    def prefill(self, image_features, input_ids, attention_mask):
+        cross_k, cross_v, encoder_mask = self._run(
+            "prefill", image_features=image_features, input_ids=input_ids, attention_mask=attention_mask
+        )
+        return [(cross_k, cross_v)], encoder_mask.bool()
+
+    def decode_step(self, tokens, positions, self_kv, self_valid, cross_kv, cross_valid):
+        (self_k, self_v), = self_kv
+        (cross_k, cross_v), = cross_kv
+
+        sources = (cross_k, cross_v, cross_valid)
+        if len(self._cross_sources) != len(sources) or any(a is not b for a, b in zip(self._cross_sources, sources)):
+            # Rows were admitted or retired since the last step
+            self._cross_sources = sources
+            self._cross_bound = tuple(t.contiguous() for t in sources)
+            for name, tensor in zip(("cross_k", "cross_v", "cross_valid"), self._cross_bound):
+                self._bind_input(name, tensor)
+
+        inputs = {
+            "tokens": tokens.contiguous(),
+            "positions": positions.contiguous(),
+            "self_k": self_k.contiguous(),
+            "self_v": self_v.contiguous(),
+            "self_valid": self_valid.contiguous(),
+        }
+        for name, tensor in inputs.items():
+            self._bind_input(name, tensor)
+
+        # Outputs come back in the order they were first bound, logits (allocated by the session) first
+        self._decode_binding.bind_output("logits", "cpu")
+        # Cache extended by this step's token, written by the session in place
+        shape = (*self_k.shape[:-2], self_valid.shape[1], self_k.shape[-1])
+        new_k, new_v = self_k.new_empty(shape), self_v.new_empty(shape)
+        for name, tensor in (("new_self_k", new_k), ("new_self_v", new_v)):
+            self._decode_binding.bind_output(name, "cpu", 0, tensor.numpy().dtype, shape, tensor.data_ptr())
+
+        self.sessions["decode_step"].run_with_iobinding(self._decode_binding)
+        logits = torch.from_numpy(self._decode_binding.get_outputs()[0].numpy())
+        return logits, [(new_k, new_v)]
+
+
+def load_backend(model, name, onnx_model_dir=None):
+    """The backend named by INFERENCE_BACKEND for a loaded Florence2Model."""
+    if name == "torch":
+        return TorchBackend(model)
+    if name == "onnx":
+        if model.device.type != "cpu":
+            raise ValueError("The onnx backend runs on CPU only")
+        return OnnxBackend(onnx_model_dir)
+    raise ValueError(f"Unknown INFERENCE_BACKEND '{name}'. Available: {list(BACKENDS)}")
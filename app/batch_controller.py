@@ -0,0 +1,160 @@
+import os
+import time
+import socket
+import threading
+from collections import deque
+from app.logging_config import get_logger
+
+logger = get_logger(__name__)
+
+ADAPTIVE_BATCHING = os.environ.get("ADAPTIVE_BATCHING", "true").lower() == "true"
+# Worker-side p95 the controller steers to: from the moment a task is queued until its reply is sent
+TARGET_P95_MS = float(os.environ.get("TARGET_P95_MS", "10000"))
+BATCH_ADJUST_INTERVAL_S = float(os.environ.get("BATCH_ADJUST_INTERVAL_S", "5"))
+# Upper bounds the controller never goes past
+MAX_BATCH_SIZE_LIMIT = int(os.environ.get("MAX_BATCH_SIZE_LIMIT", "32"))
+MAX_ACTIVE_ROWS_LIMIT = int(os.environ.get("MAX_ACTIVE_ROWS_LIMIT", "64"))
+BATCH_TIMEOUT_LIMIT_MS = float(os.environ.get("BATCH_TIMEOUT_LIMIT_MS", "200"))
+
+# Growth step of the decode pool: one 3-beam request
+ROWS_STEP = 3
+# Intervals to hold after growing stopped paying off in throughput
+SATURATED_HOLD_INTERVALS = 6
+
+WORKER_METRICS_KEY_PREFIX = "florence_worker:metrics"
+
+
+def worker_metrics_key():
+    return f"{WORKER_METRICS_KEY_PREFIX}:{socket.gethostname()}:{os.getpid()}"
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+class AdaptiveBatchController:
+    """
+    Tunes the worker's batching knobs online instead of deriving them from API_WORKER_COUNT:
+
+    - max_rows: decode rows in the continuous batching pool
+    - batch_size: most tasks prefilled together
+    - wait_s: how long an idle pool waits for a burst so it shares one prefill
+
+    Every BATCH_ADJUST_INTERVAL_S it looks at the last window's p95 request latency, decode step
+    latency, token throughput and the queue depth, and makes one decision:
+
+    - shrink: p95 is over TARGET_P95_MS, the pool is larger than the device can serve in time
+    - grow: there is a backlog, the pool is full and p95 has room
+    - saturated: the last growth did not raise throughput, so it is undone and growth pauses
+    - hold: anything else
+
+    The wait window only grows while p95 has plenty of room and prefills come out small.
+
+    The observe_* methods are called from the worker's pipeline threads while adjust runs on the
+    scheduler's, so the window is only touched under a lock and adjust works on a swapped out copy.
+    """
+    def __init__(self, batch_size, max_rows, wait_s):
+        self.batch_size = batch_size
+        self.max_rows = max_rows
+        self.wait_s = wait_s
+        self.decision = "hold"
+        self._grown_at_throughput = None
+        self._hold_until = 0.0
+        self._lock = threading.Lock()
+        self._reset_window(time.time())
+        self.last_metrics = {}
+
+    def _reset_window(self, now):
+        self._window_start = now
+        self._latencies = []
+        self._step_times = []
+        self._tokens = 0
+        self._prefill_sizes = deque(maxlen=256)
+
+    def _take_window(self, now):
+        """Swaps in a fresh window and returns the closed one as (start, latencies, step_times, tokens, prefill_sizes)."""
+        with self._lock:
+            window = (self._window_start, self._latencies, self._step_times, self._tokens, self._prefill_sizes)
+            self._reset_window(now)
+        return window
+
+    def observe_step(self, duration, rows):
+        with self._lock:
+            self._step_times.append(duration)
+            self._tokens += rows
+
+    def observe_request(self, latency):
+        with self._lock:
+            self._latencies.append(latency)
+
+    def observe_prefill(self, size):
+        with self._lock:
+            self._prefill_sizes.append(size)
+
+    def due(self):
+        return time.time() - self._window_start >= BATCH_ADJUST_INTERVAL_S
+
+    def adjust(self, queue_depth, active_rows):
+        """Closes the current window, applies one decision and returns the window's metrics."""
+        now = time.time()
+        window_start, latencies, step_times, tokens, prefill_sizes = self._take_window(now)
+        elapsed = max(now - window_start, 1e-6)
+        p95 = percentile(latencies, 95)
+        p95_ms = None if p95 is None else p95 * 1000
+        throughput = tokens / elapsed
+        prefill_avg = sum(prefill_sizes) / len(prefill_sizes) if prefill_sizes else 0.0
+
+        if ADAPTIVE_BATCHING:
+            self.decision = self._decide(p95_ms, throughput, queue_depth, active_rows, prefill_avg, now)
+
+        step_p50 = percentile(step_times, 50)
+        self.last_metrics = {
+            "adaptive": int(ADAPTIVE_BATCHING),
+            "decision": self.decision,
+            "batch_size": self.batch_size,
+            "max_active_rows": self.max_rows,
+            "wait_ms": round(self.wait_s * 1000, 1),
+            "target_p95_ms": TARGET_P95_MS,
+            "p95_latency_ms": -1 if p95_ms is None else round(p95_ms),
+            "completed": len(latencies),
+            "step_p50_ms": -1 if step_p50 is None else round(step_p50 * 1000, 2),
+            "steps": len(step_times),
+            "tokens_per_s": round(throughput, 1),
+            "requests_per_s": round(len(latencies) / elapsed, 3),
+            "prefill_avg": round(prefill_avg, 2),
+            "queue_depth": queue_depth,
+            "active_rows": active_rows,
+            "updated_at": round(now, 3),
+        }
+        return self.last_metrics
+
+    def _decide(self, p95_ms, throughput, queue_depth, active_rows, prefill_avg, now):
+        if p95_ms is not None and p95_ms > TARGET_P95_MS:
+            self.max_rows = max(ROWS_STEP, int(self.max_rows * 0.75))
+            self.batch_size = max(1, int(self.batch_size * 0.75))
+            self.wait_s = self.wait_s / 2
+            self._grown_at_throughput = None
+            return "shrink"
+
+        # The wait window only buys anything when there is latency to spare
+        if p95_ms is not None and p95_ms > TARGET_P95_MS * 0.8:
+            self.wait_s = self.wait_s / 2
+        elif (p95_ms is None or p95_ms < TARGET_P95_MS * 0.5) and 0 < prefill_avg < self.batch_size / 2:
+            self.wait_s = min(BATCH_TIMEOUT_LIMIT_MS / 1000, self.wait_s + 0.01)
+
+        if queue_depth > 0 and active_rows >= self.max_rows and now >= self._hold_until:
+            if self._grown_at_throughput is not None and throughput < self._grown_at_throughput * 1.05:
+                # More rows only made every step slower, the device is saturated
+                self.max_rows = max(ROWS_STEP, self.max_rows - ROWS_STEP)
+                self._grown_at_throughput = None
+                self._hold_until = now + SATURATED_HOLD_INTERVALS * BATCH_ADJUST_INTERVAL_S
+                return "saturated"
+            self._grown_at_throughput = throughput
+            self.max_rows = min(MAX_ACTIVE_ROWS_LIMIT, self.max_rows + ROWS_STEP)
+            self.batch_size = min(MAX_BATCH_SIZE_LIMIT, self.batch_size + 1)
+            return "grow"
+
+        return "hold"
@@ -0,0 +1,113 @@
+import os
+import time
+from collections import Counter
+from app.constants import TASK_OUTPUT_LENGTH, MEDIUM_OUTPUT
+from app.logging_config import get_logger
+
+logger = get_logger(__name__)
+
+# A task that has waited this long is batched next, whatever is compatible with it
+BATCH_STARVATION_MS = float(os.environ.get("BATCH_STARVATION_MS", "2000")) / 1000
+
+
+def batch_bucket(task):
+    """
+    Tasks in the same bucket share a generation profile and decode for a similar number of steps,
+    so they can share a batch. Multi-task requests (several tasks on one image) run on their own.
+    """
+    if task.get('tasks'):
+        return "multi"
+    return f"{task.get('profile') or 'default'}/{TASK_OUTPUT_LENGTH.get(task.get('task'), MEDIUM_OUTPUT)}"
+
+
+class BatchFormer:
+    """
+    Holds the tasks the worker has taken off the queue but not run yet, and forms batches
+    out of compatible ones instead of first-come-first-served.
+
+    The bucket with the most pending work goes next so batches come out full and homogeneous,
+    unless the oldest pending task has waited BATCH_STARVATION_MS, in which case its bucket goes
+    next no matter how small it is.
+    """
+    def __init__(self):
+        # (entry_id, task, received_at), oldest first
+        self.pending = []
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, entry_id, task):
+        self.pending.append((entry_id, task, time.time()))
+
+    def drop_expired(self):
+        """Removes and returns the (entry_id, task) pairs whose caller has already given up."""
+        now = time.time()
+        expired = [(e, t) for e, t, _ in self.pending if t.get('deadline') is not None and now >= t['deadline']]
+        if expired:
+            self.pending = [item for item in self.pending if not (item[1].get('deadline') is not None and now >= item[1]['deadline'])]
+        return expired
+
+    def oldest_age(self):
+        if not self.pending:
+            return 0.0
+        return time.time() - self.pending[0][2]
+
+    def largest_bucket(self):
+        if not self.pending:
+            return 0
+        return max(Counter(batch_bucket(t) for _, t, _ in self.pending).values())
+
+    def ready(self, max_size, wait_s):
+        """A batch leaves when one bucket can fill it, or when the oldest task has waited long enough."""
+        return self.largest_bucket() >= max_size or self.oldest_age() >= wait_s
+
+    def next_batch(self, max_size, max_rows=None, rows_of=None, min_one=False):
+        """
+        Removes and returns up to max_size (entry_id, task) pairs from one bucket, oldest first.
+        With max_rows, the batch also stops before its tasks need more than max_rows decode rows
+        (rows_of(task) says how many a task needs). min_one takes the first task even if it needs more.
+        """
+        if not self.pending:
+            return []
+
+        starving = self.oldest_age() >= BATCH_STARVATION_MS
+        if starving:
+            bucket = batch_bucket(self.pending[0][1])
+        else:
+            counts = Counter(batch_bucket(t) for _, t, _ in self.pending)
+            # Ties go to the bucket holding the oldest task
+            first_seen = {}
+            for i, (_, t, _) in enumerate(self.pending):
+                first_seen.setdefault(batch_bucket(t), i)
+            bucket = max(counts, key=lambda b: (counts[b], -first_seen[b]))
+
+        batch, remaining = [], []
+        rows, full = 0, False
+        for item in self.pending:
+            if not full and len(batch) < max_size and batch_bucket(item[1]) == bucket:
+                needed = rows_of(item[1]) if max_rows is not None else 0
+                if max_rows is None or rows + needed <= max_rows or (min_one and not batch):
+                    batch.append(item)
+                    rows += needed
+                    continue
+                # Keep the bucket's order, a big task is not overtaken by the small ones behind it
+                full = True
+            remaining.append(item)
+        self.pending = remaining
+
+        if not batch:
+            return []
+
+        task_types = Counter(t.get('task') for _, t, _ in batch)
+        logger.info("Batch assembled",
+                    count=len(batch),
+                    bucket=bucket,
+                    starving=starving,
+                    task_types=dict(task_types),
+                    # Share of the batch taken by its most common task type, 1.0 is fully homogeneous
+                    homogeneity=round(task_types.most_common(1)[0][1] / len(batch), 2),
+                    max_wait_ms=round((time.time() - batch[0][2]) * 1000),
+                    left_pending=len(self.pending),
+                    ids=[t.get('request_id') for _, t, _ in batch])
+
+        return [(entry_id, task) for entry_id, task, _ in batch]
@@ -1,7 +1,15 @@
+from typing import Dict
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from app.logging_config import get_logger
 import os
+import time
+import asyncio
+import hashlib
+import functools
+import mimetypes
+from collections import OrderedDict
 import chainlit as cl
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import boto3
 from chainlit.data.storage_clients.base import BaseStorageClient
@@ -12,6 +20,25 @@ logger = get_logger(__name__)
 class ModelConfig(BaseSettings):
     MODEL_ID: str = "microsoft/Florence-2-large"
     RATE_LIMIT: int = 5
+    # Named decoding profiles for model.generate. Sampling is always off, which keeps results deterministic and cacheable.
+    # "quality" is the original 3-beam search, "fast" is greedy single-beam decoding (the biggest latency lever on CPU).
+    GENERATION_PROFILES: Dict[str, Dict[str, int]] = {
+        "fast": {"num_beams": 1, "max_new_tokens": 1024},
+        "quality": {"num_beams": 3, "max_new_tokens": 1024},
+    }
+    DEFAULT_GENERATION_PROFILE: str = "quality"
+    # Per task default profile, e.g. {"<CAPTION>": "fast"}. A profile sent with the request wins.
+    TASK_GENERATION_PROFILES: Dict[str, str] = {}
+    # Numerics on CPU (a GPU always runs float16): "fp32", "bf16" (float32 weights, bfloat16 autocast)
+    # or "int8" (dynamic int8 quantization of the language model's Linear layers)
+    CPU_PRECISION: str = "fp32"
+    # What runs the worker's encode/prefill/decode steps: "torch", or "onnx" for the ONNX Runtime
+    # graphs that scripts/export_onnx.py writes into ONNX_MODEL_DIR (CPU only)
+    INFERENCE_BACKEND: str = "torch"
+    ONNX_MODEL_DIR: str = "/app/hf_cache/florence-2-large-onnx"
+    # Map the weights from a shared safetensors file (see app.shared_weights) instead of keeping a
+    # private copy, so several workers on one host share them. The supervisor turns it on.
+    MMAP_WEIGHTS: bool = False
     
     model_config = SettingsConfigDict(
         env_file=".env",
@@ -25,7 +52,45 @@ class ModelConfig(BaseSettings):
         # Structured log with model details as metadata
         logger.info("Model configuration initialized", 
                     model_id=self.MODEL_ID, \
-                    rate_limit=self.RATE_LIMIT)
+                    rate_limit=self.RATE_LIMIT,
+                    generation_profiles=list(self.GENERATION_PROFILES),
+                    default_generation_profile=self.DEFAULT_GENERATION_PROFILE,
+                    cpu_precision=self.CPU_PRECISION,
+                    inference_backend=self.INFERENCE_BACKEND)
+
+    def resolve_profile(self, task, profile=None):
+        """Picks the generation profile for a task: the requested one, else the task default, else the global default."""
+        name = profile or self.TASK_GENERATION_PROFILES.get(task) or self.DEFAULT_GENERATION_PROFILE
+        if name not in self.GENERATION_PROFILES:
+            raise ValueError(f"Unknown generation profile '{name}'. Available: {sorted(self.GENERATION_PROFILES)}")
+        return name
+
+    def generation_kwargs(self, profile):
+        return {**self.GENERATION_PROFILES[profile], "do_sample": False}
+
+
+# Concurrent S3 requests per process: the size of boto3's HTTP connection pool and of the
+# thread pool the blocking boto3 calls run on, so they never block the event loop
+S3_MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS", "32"))
+
+# Input images are stored once per content hash under INPUT_KEY_PREFIX, repeat uploads are skipped
+INPUT_DEDUP = os.getenv("INPUT_DEDUP", "true").lower() == "true"
+INPUT_KEY_PREFIX = os.getenv("INPUT_KEY_PREFIX", "inputs")
+# Keys this process stored or found recently, checked before asking S3
+INPUT_DEDUP_CACHE_SIZE = int(os.getenv("INPUT_DEDUP_CACHE_SIZE", "4096"))
+# A stored input older than this is written again, which restarts its BUCKET_TTL lifecycle clock,
+# so a deduplicated URL never points at an object about to be purged. Keep it well below BUCKET_TTL.
+INPUT_DEDUP_MAX_AGE_S = int(os.getenv("INPUT_DEDUP_MAX_AGE_S", str(12 * 3600)))
+
+_shared_storage_client = None
+
+
+def get_storage_client():
+    """The process wide S3StorageClient. boto3 clients are thread safe, one pooled client serves every request."""
+    global _shared_storage_client
+    if _shared_storage_client is None:
+        _shared_storage_client = S3StorageClient()
+    return _shared_storage_client
 
 
 class S3StorageClient(BaseStorageClient):
@@ -35,8 +100,12 @@ class S3StorageClient(BaseStorageClient):
         
         logger.info("Initializing S3 Storage Client (SeaweedFS Compatible)", 
                     bucket=self.bucket, 
-                    endpoint=endpoint)
+                    endpoint=endpoint,
+                    max_pool_connections=S3_MAX_POOL_CONNECTIONS)
         
+        self._executor = ThreadPoolExecutor(max_workers=S3_MAX_POOL_CONNECTIONS, thread_name_prefix="s3")
+        # content addressed key -> when it was written, most recently used last
+        self._recent_keys = OrderedDict()
         try:
             # SeaweedFS uses path-style addressing natively for its S3 emulation layer
             self.client = boto3.client(
@@ -45,12 +114,16 @@ class S3StorageClient(BaseStorageClient):
                 aws_access_key_id=os.getenv("S3_ACCESS_KEY"),
                 aws_secret_access_key=os.getenv("S3_SECRET_KEY"),
                 use_ssl=False,
-                config=boto3.session.Config(signature_version='s3v4')
+                config=boto3.session.Config(signature_version='s3v4', max_pool_connections=S3_MAX_POOL_CONNECTIONS)
             )
             logger.info("S3 Client created successfully")
         except Exception as e:
             logger.exception("Failed to initialize S3 client", error=str(e))    
 
+    async def _run(self, fn, *args, **kwargs):
+        """Runs a blocking boto3 call on the S3 thread pool."""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+
     async def upload_file(self, **kwargs):
         actual_content = kwargs.get("data")
         actual_mime = kwargs.get("mime", "application/octet-stream")
@@ -79,7 +152,8 @@ class S3StorageClient(BaseStorageClient):
                     size_bytes=len(actual_content) if actual_content else 0)
 
         try:
-            self.client.put_object(
+            await self._run(
+                self.client.put_object,
                 Bucket=self.bucket,
                 Key=clean_key,
                 Body=actual_content,
@@ -96,10 +170,64 @@ class S3StorageClient(BaseStorageClient):
         return {"url": f"{public_base}/buckets/{self.bucket}/{clean_key}"}
     
 
+    async def store_content_addressed(self, data, mime="application/octet-stream"):
+        """
+        Stores data under the SHA-256 of its content and returns the object key. Content this
+        process stored recently, or that S3 already holds and is younger than INPUT_DEDUP_MAX_AGE_S,
+        is not uploaded again. Concurrent first uploads of the same bytes both write, which is harmless.
+        """
+        digest = await self._run(lambda: hashlib.sha256(data).hexdigest())
+        key = f"{INPUT_KEY_PREFIX}/{digest[:2]}/{digest}{mimetypes.guess_extension(mime) or ''}"
+
+        written_at = self._recent_keys.get(key)
+        if written_at is None:
+            written_at = await self._run(self._last_modified, key)
+        if written_at is not None and time.time() - written_at < INPUT_DEDUP_MAX_AGE_S:
+            self._remember(key, written_at)
+            logger.info("Input already stored, upload skipped", key=key)
+            return key
+
+        logger.info("Starting content addressed upload to S3", key=key, mime=mime, size_bytes=len(data))
+        try:
+            await self._run(
+                self.client.put_object,
+                Bucket=self.bucket,
+                Key=key,
+                Body=data,
+                ContentType=mime,
+                Expires=datetime.utcnow() + timedelta(days=1)
+            )
+        except Exception as e:
+            logger.exception("S3 upload failed", key=key, error=str(e))
+            raise e
+        self._remember(key, time.time())
+        return key
+
+    def _remember(self, key, written_at):
+        self._recent_keys[key] = written_at
+        self._recent_keys.move_to_end(key)
+        while len(self._recent_keys) > INPUT_DEDUP_CACHE_SIZE:
+            self._recent_keys.popitem(last=False)
+
+    def _last_modified(self, object_key):
+        """Epoch seconds the object was last written, or None when it does not exist."""
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=object_key)["LastModified"].timestamp()
+        except self.client.exceptions.ClientError as e:
+            if e.response['Error']['Code'] == "404":
+                return None
+            raise e
+
+    async def download_file(self, object_key: str) -> bytes:
+        logger.debug("Downloading file from S3", key=object_key)
+        def fetch():
+            return self.client.get_object(Bucket=self.bucket, Key=object_key)["Body"].read()
+        return await self._run(fetch)
+
     async def delete_file(self, filename: str):
         logger.info("Deleting file from S3", key=filename)
         try:
-            self.client.delete_object(Bucket=self.bucket, Key=filename)
+            await self._run(self.client.delete_object, Bucket=self.bucket, Key=filename)
             logger.info("File deleted successfully", key=filename)
         except Exception as e:
             logger.error("Failed to delete file", key=filename, error=str(e))
@@ -145,6 +273,10 @@ class S3StorageClient(BaseStorageClient):
             logger.error("Failed to generate presigned URL", error=str(e))
             return None
 
+    async def object_exists(self, object_key: str) -> bool:
+        """file_exists() on the S3 thread pool."""
+        return await self._run(self.file_exists, object_key)
+
     def file_exists(self, object_key: str) -> bool:
         """Checks if an object exists in the S3 bucket."""
         try:
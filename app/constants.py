@@ -1,5 +1,5 @@
 import os
-from typing import Literal, List, Final
+from typing import Literal, List, Final, Dict
 
 CAPTION: Final[str] = "<CAPTION>"
 DETAILED_CAPTION: Final[str] = "<DETAILED_CAPTION>"
@@ -32,4 +32,39 @@ TASK_TYPES: Final[List[str]] = [
     OPEN_VOCABULARY_DETECTION,
     REGION_TO_CATEGORY,
     REGION_TO_DESCRIPTION
-]
\ No newline at end of file
+]
+
+# Tasks whose result is plain text. Their decoded text is meaningful while it is being generated,
+# so they can stream it (/predict_stream, the Chainlit UI).
+TEXT_TASKS: Final[List[str]] = [
+    CAPTION,
+    DETAILED_CAPTION,
+    MORE_DETAILED_CAPTION,
+    OCR,
+    REGION_TO_CATEGORY,
+    REGION_TO_DESCRIPTION
+]
+
+# Expected decode length per task, used by the worker to batch compatible work together.
+# Every sequence in a batch pays for the longest decode in it, so a <CAPTION> should not
+# ride along with a <DENSE_REGION_CAPTION> that runs to hundreds of tokens.
+SHORT_OUTPUT: Final[str] = "short"
+MEDIUM_OUTPUT: Final[str] = "medium"
+LONG_OUTPUT: Final[str] = "long"
+
+TASK_OUTPUT_LENGTH: Final[Dict[str, str]] = {
+    CAPTION: SHORT_OUTPUT,
+    DETAILED_CAPTION: SHORT_OUTPUT,
+    REGION_TO_CATEGORY: SHORT_OUTPUT,
+    REGION_TO_DESCRIPTION: SHORT_OUTPUT,
+    CAPTION_TO_PHRASE_GROUNDING: SHORT_OUTPUT,
+    OPEN_VOCABULARY_DETECTION: SHORT_OUTPUT,
+    MORE_DETAILED_CAPTION: MEDIUM_OUTPUT,
+    OD: MEDIUM_OUTPUT,
+    OCR: MEDIUM_OUTPUT,
+    REGION_PROPOSAL: MEDIUM_OUTPUT,
+    REFERRING_EXPRESSION_SEGMENTATION: MEDIUM_OUTPUT,
+    REGION_TO_SEGMENTATION: MEDIUM_OUTPUT,
+    OCR_WITH_REGION: LONG_OUTPUT,
+    DENSE_REGION_CAPTION: LONG_OUTPUT,
+}
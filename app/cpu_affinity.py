@@ -0,0 +1,47 @@
+import os
+
+
+def parse_cpus(spec):
+    """'0-3,8,10-11' -> [0, 1, 2, 3, 8, 10, 11]"""
+    cpus = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            first, last = part.split("-")
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def format_cpus(cpus):
+    return ",".join(map(str, cpus))
+
+
+def split_cpus(cpus, parts):
+    """Contiguous, near equal core sets, so a worker's threads stay close to each other."""
+    size, extra = divmod(len(cpus), parts)
+    sets, start = [], 0
+    for i in range(parts):
+        end = start + size + (1 if i < extra else 0)
+        sets.append(cpus[start:end])
+        start = end
+    return sets
+
+
+def apply_pinning():
+    """
+    Called by a worker before it loads the model: pins the process to WORKER_CPUS and sizes torch's
+    intra-op pool to WORKER_THREADS (default one thread per pinned core).
+    """
+    import torch
+
+    cpus = os.environ.get("WORKER_CPUS")
+    if cpus and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, parse_cpus(cpus))
+    threads = int(os.environ.get("WORKER_THREADS") or 0) or (len(parse_cpus(cpus)) if cpus else 0)
+    if threads:
+        torch.set_num_threads(threads)
+    return cpus, threads
@@ -0,0 +1,81 @@
+import io
+import os
+import math
+from PIL import Image
+from app.logging_config import get_logger
+
+logger = get_logger(__name__)
+
+# The processor resizes every image to 768x768 anyway, so shipping a 12 MP phone photo through
+# Redis and decoding it on the worker buys nothing. Uploads above the budget are downscaled in
+# the API before they are queued, and coordinates in the results are mapped back to the original.
+INGEST_DOWNSCALE = os.environ.get("INGEST_DOWNSCALE", "true").lower() == "true"
+INGEST_MAX_PIXELS = int(os.environ.get("INGEST_MAX_PIXELS", str(1536 * 1536)))
+INGEST_JPEG_QUALITY = int(os.environ.get("INGEST_JPEG_QUALITY", "95"))
+
+# Result fields holding pixel coordinates as flat x, y, x, y, ... runs (possibly nested)
+GEOMETRY_KEYS = ("bboxes", "quad_boxes", "polygons")
+
+
+def prepare_image(image_data):
+    """
+    Downscales an upload above INGEST_MAX_PIXELS, keeping its aspect ratio.
+    Returns (image_bytes to queue, (scale_x, scale_y) from the queued image back to the original,
+    or None when the upload is queued as is).
+    """
+    if not INGEST_DOWNSCALE:
+        return image_data, None
+
+    try:
+        with Image.open(io.BytesIO(image_data)) as image:
+            # Only the header has been read so far
+            width, height = image.size
+            if width * height <= INGEST_MAX_PIXELS:
+                return image_data, None
+
+            factor = math.sqrt(INGEST_MAX_PIXELS / (width * height))
+            target = (max(1, int(width * factor)), max(1, int(height * factor)))
+            # thumbnail() lets the JPEG decoder skip most of the full resolution decode
+            image.thumbnail(target)
+            image = image.convert("RGB")
+
+            buf = io.BytesIO()
+            image.save(buf, format="JPEG", quality=INGEST_JPEG_QUALITY)
+            scale = (width / image.width, height / image.height)
+            new_size = image.size
+    except Exception as e:
+        # Not an image PIL can read; the worker reports it
+        logger.warning("Skipping ingest downscale", error=str(e))
+        return image_data, None
+
+    logger.info("Downscaled upload before queueing",
+                original=f"{width}x{height}",
+                queued=f"{new_size[0]}x{new_size[1]}",
+                original_bytes=len(image_data),
+                queued_bytes=buf.tell())
+    return buf.getvalue(), scale
+
+
+def rescale_result(result, scale):
+    """Maps the coordinates of a parsed result ({task: prediction}) from the queued image back to the original."""
+    if not scale or not isinstance(result, dict):
+        return result
+    return {
+        task: _rescale_prediction(prediction, scale) if isinstance(prediction, dict) else prediction
+        for task, prediction in result.items()
+    }
+
+
+def _rescale_prediction(prediction, scale):
+    return {
+        key: _scale_coords(value, scale) if key in GEOMETRY_KEYS else value
+        for key, value in prediction.items()
+    }
+
+
+def _scale_coords(value, scale):
+    if not isinstance(value, list):
+        return value
+    if value and all(isinstance(v, (int, float)) for v in value):
+        return [round(v * scale[i % 2], 2) for i, v in enumerate(value)]
+    return [_scale_coords(v, scale) for v in value]
@@ -0,0 +1,125 @@
+import os
+import json
+import time
+from app import wire
+from app.logging_config import get_logger
+
+logger = get_logger(__name__)
+
+# Jobs are fire-and-forget predictions: the API enqueues the task and returns a job id, the
+# worker writes the outcome straight into the job's Redis hash, so no API process waits for it.
+# How long a job's state and result stay readable after its last update
+JOB_TTL = int(os.environ.get("JOB_TTL", "86400"))
+# Worker-side deadline of a job task. Far longer than MODEL_TIMEOUT, a job may sit behind a deep backlog.
+JOB_TIMEOUT = int(os.environ.get("JOB_TIMEOUT", "3600"))
+# SSE comment sent on an idle event stream so proxies keep the connection open
+JOB_EVENTS_KEEPALIVE_S = float(os.environ.get("JOB_EVENTS_KEEPALIVE_S", "15"))
+
+JOB_KEY_PREFIX = "florence_job"
+
+# queued:     on the task queue
+# batched:    taken off the queue and picked into a prefill batch
+# generating: prefilled, the decoder is producing tokens
+# done / failed: final, the hash holds the result or the error
+JOB_STATES = ("queued", "batched", "generating", "done", "failed")
+FINAL_STATES = ("done", "failed")
+
+
+def job_key(job_id):
+    return f"{JOB_KEY_PREFIX}:{job_id}"
+
+
+def events_channel(job_id):
+    return f"{JOB_KEY_PREFIX}:{job_id}:events"
+
+
+def queue_job_update(pipe, job_id, status, **fields):
+    """
+    Queues a state change of a job on a pipeline: the hash is updated, its TTL renewed and the
+    new state published to the job's event channel. Works on sync (worker) and async (API) pipelines.
+    """
+    now = round(time.time(), 3)
+    mapping = {"status": status, "updated_at": now}
+    if "result" in fields:
+        mapping["result"] = wire.pack(fields.pop("result"))
+    mapping.update({k: v for k, v in fields.items() if v is not None})
+
+    pipe.hset(job_key(job_id), mapping=mapping)
+    pipe.expire(job_key(job_id), JOB_TTL)
+    pipe.publish(events_channel(job_id), json.dumps({"job_id": job_id, "status": status, "updated_at": now}))
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class JobStore:
+    """Reads and creates jobs for the API, on the proxy's async Redis client."""
+    def __init__(self, client):
+        self.client = client
+
+    async def create(self, job_id, status="queued", **fields):
+        pipe = self.client.pipeline(transaction=False)
+        queue_job_update(pipe, job_id, status, created_at=round(time.time(), 3), **fields)
+        await pipe.execute()
+
+    async def get(self, job_id):
+        """The job as a dict with its result unpacked, or None when unknown or expired."""
+        raw = await self.client.hgetall(job_key(job_id))
+        if not raw:
+            return None
+        job = {k.decode(): v for k, v in raw.items()}
+        result = job.pop("result", None)
+        job = {k: v.decode() for k, v in job.items()}
+        for field in ("created_at", "updated_at"):
+            if field in job:
+                job[field] = float(job[field])
+        if result is not None:
+            job["result_data"] = wire.unpack(result)
+        return {"job_id": job_id, **job}
+
+    async def events(self, job_id):
+        """
+        Yields SSE messages: the job's current state, then every state change until it is final.
+        Subscribing before reading the state means no change can fall between the two.
+        """
+        pubsub = self.client.pubsub()
+        await pubsub.subscribe(events_channel(job_id))
+        try:
+            job = await self.get(job_id)
+            if job is None:
+                yield sse_event("error", {"job_id": job_id, "detail": "Unknown or expired job"})
+                return
+            yield sse_event("status", job)
+            if job["status"] in FINAL_STATES:
+                return
+
+            idle_since = time.monotonic()
+            while True:
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                if message is None:
+                    if time.monotonic() - idle_since >= JOB_EVENTS_KEEPALIVE_S:
+                        idle_since = time.monotonic()
+                        yield ": keepalive\n\n"
+                        # A missed final event (e.g. a Redis reconnect) must not leave the stream hanging
+                        job = await self.get(job_id)
+                        if job is None or job["status"] in FINAL_STATES:
+                            break
+                    continue
+
+                idle_since = time.monotonic()
+                event = json.loads(message["data"])
+                if event["status"] in FINAL_STATES:
+                    break
+                yield sse_event("status", event)
+
+            job = await self.get(job_id)
+            if job is None:
+                yield sse_event("error", {"job_id": job_id, "detail": "Unknown or expired job"})
+            else:
+                # The final event carries the result or error
+                yield sse_event("status", job)
+        finally:
+            # Also runs when the client disconnects mid-stream
+            await pubsub.unsubscribe(events_channel(job_id))
+            await pubsub.aclose()
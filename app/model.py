@@ -1,25 +1,39 @@
 import os
-import signal
 import torch
 from PIL import Image
 import io
 import time
+import resource
+from contextlib import nullcontext, contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import patch
-from transformers import AutoProcessor, AutoModelForCausalLM, AutoConfig
+from transformers import AutoProcessor, AutoModelForCausalLM, AutoConfig, GenerationConfig
 from transformers.dynamic_module_utils import get_imports
+from app.backends import load_backend
+from app import shared_weights
 from app.logging_config import get_logger
 
 # Use the structured logger
 logger = get_logger(__name__)
 
-class ModelTimeoutException(Exception):
-    """Custom exception for timeouts"""
-    pass
 
-def timeout_handler(signum, frame):
-    raise ModelTimeoutException("Model inference exceeded limit")
+def is_expired(deadline, now=None):
+    return deadline is not None and (now or time.time()) >= deadline
 
-timeout_val = int(os.environ.get("MODEL_TIMEOUT", "30"))
+
+CPU_PRECISIONS = ("fp32", "bf16", "int8")
+
+
+def rss_mb():
+    """Resident set size of this process in MB (peak RSS where /proc is not available)."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
 
 
 def fixed_get_imports(filename: str | os.PathLike) -> list[str]:
@@ -47,45 +61,116 @@ class Florence2Model:
                         name=torch.cuda.get_device_name(0),
                         vram=f"{torch.cuda.get_device_properties(self.device).total_memory / 1024**2:.0f}MB")
 
+        self.config = config
+        backend_name = config.INFERENCE_BACKEND.lower()
+        # GPUs always run float16, the precision modes are a CPU optimization
+        self.precision = config.CPU_PRECISION.lower() if self.device.type == "cpu" else "fp16"
+        if self.device.type == "cpu" and self.precision not in CPU_PRECISIONS:
+            raise ValueError(f"Unknown CPU_PRECISION '{config.CPU_PRECISION}'. Available: {list(CPU_PRECISIONS)}")
+        if backend_name == "onnx" and self.precision != "fp32":
+            # The exported graphs are float32, CPU_PRECISION only applies to the PyTorch modules
+            logger.warning("CPU_PRECISION is ignored by the onnx backend", cpu_precision=self.precision)
+            self.precision = "fp32"
+
+        # Seconds per loading phase, the worker adds them to its startup breakdown
+        self.load_timings = {}
+        # A downloaded checkpoint (download_model.sh) is resolved from disk only, no hub round trips
+        local = os.path.isdir(config.MODEL_ID)
+
         try:
             with patch("transformers.dynamic_module_utils.get_imports", fixed_get_imports):
-                logger.info("Loading model and processor...", patch="flash_attn_fixed")
-                
-                model_config = AutoConfig.from_pretrained(
-                    config.MODEL_ID, 
-                    trust_remote_code=True
-                )
-                # Ensure we use SDPA for ROCm compatibility
-                model_config.attn_implementation = "sdpa"
-
-                self.model = AutoModelForCausalLM.from_pretrained(
-                    config.MODEL_ID, 
-                    config=model_config,
-                    trust_remote_code=True,
-                    torch_dtype=torch.float16 if self.device.type == "cuda" else torch.float32 # Use Half precision on GPU
-                ).to(self.device).eval()
-                
-                self.processor = AutoProcessor.from_pretrained(
-                    config.MODEL_ID, 
-                    trust_remote_code=True
-                )
-            logger.info("Model loaded successfully ✅")
+                logger.info("Loading model and processor...", patch="flash_attn_fixed", local_files_only=local)
+
+                with self._timed("config"):
+                    model_config = AutoConfig.from_pretrained(
+                        config.MODEL_ID, 
+                        trust_remote_code=True,
+                        local_files_only=local
+                    )
+                    # Ensure we use SDPA for ROCm compatibility
+                    model_config.attn_implementation = "sdpa"
+                self.model_config = model_config
+
+                # The tokenizer and image processor load while the weights do, they share nothing
+                with ThreadPoolExecutor(max_workers=1) as executor:
+                    processor = executor.submit(self._load_processor, config.MODEL_ID, local)
+
+                    if backend_name == "onnx":
+                        # The ONNX graphs carry their own weights, the PyTorch model is never loaded.
+                        # The language model would build its generation config the same way.
+                        self.model = None
+                        self.generation_config = GenerationConfig.from_model_config(model_config.text_config)
+                    else:
+                        with self._timed("weights"):
+                            self.model = AutoModelForCausalLM.from_pretrained(
+                                config.MODEL_ID, 
+                                config=model_config,
+                                trust_remote_code=True,
+                                local_files_only=local,
+                                # Tensors go from the memory mapped safetensors file straight into the
+                                # parameters, without a randomly initialized copy first
+                                low_cpu_mem_usage=True,
+                                torch_dtype=torch.float16 if self.device.type == "cuda" else torch.float32 # Use Half precision on GPU
+                            ).to(self.device).eval()
+                        self.generation_config = self.model.language_model.generation_config
+
+                    self.processor = processor.result()
+
+            if self.model is not None and config.MMAP_WEIGHTS and self.device.type == "cpu" and self.precision != "int8" and local:
+                # int8 packs its own copy of the weights anyway, there is nothing to share
+                with self._timed("mmap"):
+                    path = shared_weights.ensure_mapped_checkpoint(config.MODEL_ID, self.torch_dtype)
+                    shared_weights.map_weights(self.model, path)
+
+            if self.model is not None and self.precision == "int8":
+                # Weights of the language model's Linear layers become int8, activations are quantized
+                # on the fly. The vision tower and the image projection (a bare matrix) stay float32.
+                with self._timed("quantize"):
+                    torch.ao.quantization.quantize_dynamic(
+                        self.model.language_model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+                    )
+            # The step primitives below always exist, the backend decides what executes the worker's steps
+            with self._timed("backend"):
+                self.backend = load_backend(self, backend_name, config.ONNX_MODEL_DIR)
+            logger.info("Model loaded successfully ✅", precision=self.precision, backend=self.backend.name,
+                        **self.memory_footprint(), **{f"{k}_s": round(v, 2) for k, v in self.load_timings.items()})
         except Exception as e:
             logger.exception("Failed to load model", error=str(e))
             raise
-    
-        # In model.py
-    def warmup(self):
-        logger.info("🔥 Warming up model with Batch Size 2...")
-        # Create a dummy batch of 2 to force kernel compilation for batching
-        dummy_input = [
-            {"task": "<OD>", "text": None, "image": Image.new('RGB', (224, 224))},
-            {"task": "<OD>", "text": None, "image": Image.new('RGB', (224, 224))}
-        ]
-        # Run it once to "bake" the kernels
-        self.run_batch(dummy_input, timeout_val=120)
-        logger.info("✅ Warmup complete.")
 
+    @contextmanager
+    def _timed(self, phase):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.load_timings[phase] = time.time() - start
+
+    def _load_processor(self, model_id, local):
+        start = time.time()
+        processor = AutoProcessor.from_pretrained(model_id, trust_remote_code=True, local_files_only=local)
+        self.load_timings["processor"] = time.time() - start
+        return processor
+
+    def memory_footprint(self):
+        """Size of the loaded weights (int8 packed weights included) and the process RSS, in MB."""
+        if self.model is None:
+            # The ONNX Runtime sessions hold the weights, only the RSS accounts for them
+            return {"rss_mb": round(rss_mb(), 1)}
+        total = 0
+        for value in self.model.state_dict().values():
+            # Dynamically quantized Linear layers store (packed weight, bias) tuples
+            for tensor in (value if isinstance(value, tuple) else (value,)):
+                if isinstance(tensor, torch.Tensor):
+                    total += tensor.nelement() * tensor.element_size()
+        return {"weights_mb": round(total / 1024 ** 2, 1), "rss_mb": round(rss_mb(), 1)}
+
+    def autocast(self):
+        """Context every forward pass runs in: bfloat16 autocast in bf16 mode, nothing otherwise."""
+        if self.precision == "bf16":
+            return torch.autocast("cpu", dtype=torch.bfloat16)
+        return nullcontext()
+    
     def preprocess_image(self, image_data):
         if not isinstance(image_data, Image.Image):
             image = Image.open(io.BytesIO(image_data)).convert('RGB')
@@ -93,81 +178,147 @@ class Florence2Model:
             return image
         return image_data
 
-    def run_example(self, task_prompt, text_input=None, image_data=None):
+    # --- Step-level primitives for the continuous batching scheduler (app/scheduler.py) ---
+    # generate() owns its batch until every sequence is done. These split decoding into
+    # prefill and single token steps, so the scheduler can change the batch between steps.
+
+    @property
+    def torch_dtype(self):
+        return torch.float16 if self.device.type == "cuda" else torch.float32
+
+    @property
+    def decoder(self):
+        return self.model.language_model.get_decoder()
+
+    def generation_defaults(self):
+        """The decoding rules generate() would apply, read from the language model's generation config."""
+        gen = self.generation_config
+        eos = gen.eos_token_id if gen.eos_token_id is not None else 2
+        return {
+            "decoder_start_token_id": gen.decoder_start_token_id if gen.decoder_start_token_id is not None else 2,
+            "eos_token_id": eos[0] if isinstance(eos, (list, tuple)) else eos,
+            "forced_bos_token_id": gen.forced_bos_token_id,
+            "forced_eos_token_id": gen.forced_eos_token_id,
+            "no_repeat_ngram_size": gen.no_repeat_ngram_size or 0,
+            "length_penalty": gen.length_penalty if gen.length_penalty is not None else 1.0,
+            "early_stopping": gen.early_stopping,
+        }
+
+    def kv_layout(self):
+        """(decoder layers, attention heads, head dim) of the key/value caches, from the model config."""
+        text = self.model_config.text_config
+        return text.decoder_layers, text.decoder_attention_heads, text.d_model // text.decoder_attention_heads
+
+    def pixel_values(self, images):
+        return self.processor.image_processor(images, return_tensors="pt")["pixel_values"].to(self.device, self.torch_dtype)
+
+    def tokenize(self, prompts):
+        """Returns (input_ids, attention_mask) for the task prompts, right padded."""
+        encoded = self.processor.tokenizer(
+            self.processor._construct_prompts(prompts),
+            return_tensors="pt",
+            padding=True
+        )
+        return encoded["input_ids"].to(self.device), encoded["attention_mask"].to(self.device)
+
+    @torch.no_grad()
+    def encode_image(self, pixel_values):
+        with self.autocast():
+            return self.model._encode_image(pixel_values)
+
+    @torch.no_grad()
+    def prefill(self, image_features, input_ids, attention_mask):
         """
-        Maintains backward compatibility for Chainlit.
-        Wraps the batch logic to process a single request.
+        Runs the language encoder over image features + prompt tokens (one row each) and projects
+        its output into every decoder layer's cross-attention keys and values, once per request.
+        Returns (cross_kv, cross_valid): per layer (k, v) of shape (rows, heads, src_len, head_dim),
+        and a (rows, src_len) bool mask of the positions that are not padding.
         """
-        results = self.run_batch([
-            {"task": task_prompt, "text": text_input, "image": image_data}
-        ])
-        return results[0]
+        with self.autocast():
+            inputs_embeds = self.model.get_input_embeddings()(input_ids)
+            inputs_embeds, _ = self.model._merge_input_ids_with_image_features(image_features, inputs_embeds)
+            # Unlike the merge's all-ones mask, prompt padding is masked out
+            encoder_mask = torch.cat([
+                torch.ones(image_features.shape[:2], dtype=attention_mask.dtype, device=attention_mask.device),
+                attention_mask
+            ], dim=1)
 
-    def run_batch(self, tasks, timeout_val=timeout_val):
+            encoder_hidden = self.model.language_model.get_encoder()(
+                inputs_embeds=inputs_embeds,
+                attention_mask=encoder_mask
+            ).last_hidden_state
+
+            cross_kv = []
+            for layer in self.decoder.layers:
+                attn = layer.encoder_attn
+                cross_kv.append((self._split_heads(attn.k_proj(encoder_hidden), attn),
+                                 self._split_heads(attn.v_proj(encoder_hidden), attn)))
+            return cross_kv, encoder_mask.bool()
+
+    @torch.no_grad()
+    def decode_step(self, tokens, positions, self_kv, self_valid, cross_kv, cross_valid):
         """
-        Core Batching Engine. Handles list of tasks for the Worker.
-        Each task is a dict: {'task': str, 'text': str, 'image': bytes}
+        Feeds one token per row through the decoder.
+        tokens, positions: (rows,) long. self_kv: per layer (k, v) of the tokens decoded so far, left
+        padded to a common length; self_valid masks that padding and includes the new token's column.
+        Returns (logits of shape (rows, vocab), self_kv extended by the new token).
         """
-        if not tasks:
-            return []
+        with self.autocast():
+            decoder = self.decoder
 
-        start_time = time.time()
-        images = []
-        prompts = []
-        
-        signal.signal(signal.SIGALRM, timeout_handler)
-        signal.alarm(timeout_val)
-        
-        try:
-            for t in tasks:
-                # Use your existing preprocessing logic for consistency
-                image = self.preprocess_image(t['image'])
-                images.append(image)
-                
-                prompt = t['task'] if t.get('text') is None else t['task'] + t['text']
-                prompts.append(prompt)
-
-            # Determine the correct dtype
-            torch_dtype = torch.float16 if self.device.type == "cuda" else torch.float32
-
-            # The "Bus": Processor handles all images and prompts at once
-            inputs = self.processor(
-                text=prompts, 
-                images=images, 
-                return_tensors="pt", 
-                padding=True
-            ).to(self.device, torch_dtype)
-
-            generated_ids = self.model.generate(
-                input_ids=inputs["input_ids"],
-                pixel_values=inputs["pixel_values"],
-                max_new_tokens=1024,
-                do_sample=False,
-                num_beams=3,
-            )
-
-            generated_texts = self.processor.batch_decode(generated_ids, skip_special_tokens=False)
-            
-            parsed_results = []
-            for i, gen_text in enumerate(generated_texts):
-                parsed = self.processor.post_process_generation(
-                    gen_text,
-                    task=tasks[i]['task'],
-                    image_size=(images[i].width, images[i].height),
+            embeds = decoder.embed_tokens(tokens[:, None])
+            # Newer copies of the Bart decoder scale inside the embedding module
+            if not hasattr(decoder.embed_tokens, "embed_scale"):
+                embeds = embeds * getattr(decoder, "embed_scale", 1.0)
+            # Learned positions are per row, rows admitted at different steps sit at different positions
+            pos_table = decoder.embed_positions
+            position_embeds = torch.nn.functional.embedding(positions[:, None] + getattr(pos_table, "offset", 2), pos_table.weight)
+            hidden = decoder.layernorm_embedding(embeds + position_embeds.to(embeds.dtype))
+
+            self_mask = self._additive_mask(self_valid, hidden.dtype)
+            cross_mask = self._additive_mask(cross_valid, hidden.dtype)
+            # The layers only look at the encoder states' length to reuse the cached cross keys/values
+            encoder_placeholder = hidden.new_empty((hidden.shape[0], cross_valid.shape[1], 0))
+
+            new_kv = []
+            for layer, (self_k, self_v), (cross_k, cross_v) in zip(decoder.layers, self_kv, cross_kv):
+                outputs = layer(
+                    hidden,
+                    attention_mask=self_mask,
+                    encoder_hidden_states=encoder_placeholder,
+                    encoder_attention_mask=cross_mask,
+                    past_key_value=(self_k, self_v, cross_k, cross_v),
+                    use_cache=True,
                 )
-                parsed_results.append(parsed)
-
-            duration = round(time.time() - start_time, 2)
-            logger.info("Batch inference complete", 
-                        batch_size=len(tasks), 
-                        duration_sec=duration)
-            
-            signal.alarm(0)
-            return parsed_results
-
-        except ModelTimeoutException:
-            logger.error("Hard timeout reached during model.generate")
-            raise
-        except Exception as e:
-            logger.exception("Error during batch model inference", error=str(e))
-            raise
\ No newline at end of file
+                hidden = outputs[0]
+                new_kv.append(tuple(outputs[-1][:2]))
+
+            if getattr(decoder, "layer_norm", None) is not None:
+                hidden = decoder.layer_norm(hidden)
+
+            language_model = self.model.language_model
+            logits = language_model.lm_head(hidden[:, -1])
+            if getattr(language_model, "final_logits_bias", None) is not None:
+                logits = logits + language_model.final_logits_bias[0]
+            return logits, new_kv
+
+    def decode_tokens(self, token_ids, task, image_size):
+        """Parses one finished sequence into the task's structured result."""
+        text = self.processor.batch_decode([token_ids], skip_special_tokens=False)[0]
+        return self.processor.post_process_generation(text, task=task, image_size=image_size)
+
+    def decode_text(self, token_ids):
+        """Plain text of a sequence that may still be running, special tokens left out."""
+        return self.processor.batch_decode([token_ids], skip_special_tokens=True)[0]
+
+    @staticmethod
+    def _split_heads(states, attn):
+        rows, length, _ = states.shape
+        return states.view(rows, length, attn.num_heads, attn.head_dim).transpose(1, 2).contiguous()
+
+    @staticmethod
+    def _additive_mask(valid, dtype):
+        """(rows, length) bool -> (rows, 1, 1, length) additive attention mask."""
+        mask = torch.zeros(valid.shape, dtype=dtype, device=valid.device)
+        mask = mask.masked_fill(~valid, torch.finfo(dtype).min)
+        return mask[:, None, None, :]
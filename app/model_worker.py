@@ -1,110 +1,499 @@
 import os
 import redis
-import json
-import base64
 import time
+import threading
+from queue import Queue, Empty
 from app.model import Florence2Model
+from app.scheduler import ContinuousBatchScheduler, DecodeRequest
+from app.batch_controller import AdaptiveBatchController, worker_metrics_key, ADAPTIVE_BATCHING, BATCH_ADJUST_INTERVAL_S
 from app.config import ModelConfig
+from app.task_queue import get_task_queue, QUEUE_BACKEND
+from app.batching import BatchFormer
+from app.pipeline import StageStats
+from app.cpu_affinity import apply_pinning
+from app.single_flight import FINISH_SCRIPT, flight_keys, parse_waiter_address
+from app.jobs import queue_job_update
+from app.readiness import StartupTimer, Heartbeat
+from app import wire, ingest
 from app.logging_config import get_logger, setup_logging
 
 
 # Initialize structured logger
 setup_logging()
 logger = get_logger("model_worker")
+# Started right after the imports, which it still accounts for
+startup = StartupTimer()
 
 # --- CONFIGURATION ---
 # Read limits from environment (Infisical/Docker)
 REDIS_HOST = os.environ.get("REDIS_HOST") # Use the full URL if possible
-MAX_BATCH_SIZE = int(os.environ.get("API_WORKER_COUNT", "4")) # batch size is same as no. of fastapi instances running 
-# This is how long we wait for the 'bus' to fill up before leaving the station
-BATCH_TIMEOUT_MS = float(os.environ.get("BATCH_TIMEOUT_MS", "200")) / 1000 
+# Starting points only, AdaptiveBatchController tunes both online (ADAPTIVE_BATCHING)
+# Most tasks prefilled together
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", os.environ.get("API_WORKER_COUNT", "4")))
+# When the decode pool is idle, how long the first arrivals wait for company so they share one prefill.
+# A busy pool never waits: new tasks join at the next token step.
+BATCH_TIMEOUT_MS = float(os.environ.get("BATCH_TIMEOUT_MS", "50")) / 1000 
+# How many queued tasks the worker looks at when picking a compatible batch
+BATCH_LOOKAHEAD = int(os.environ.get("BATCH_LOOKAHEAD", str(MAX_BATCH_SIZE * 4)))
+# Bounds of the queues between the pipeline stages: decoded images waiting for the scheduler,
+# and finished sequences waiting to be parsed and delivered
+PREPARED_QUEUE_SIZE = int(os.environ.get("PREPARED_QUEUE_SIZE", str(BATCH_LOOKAHEAD)))
+OUTPUT_QUEUE_SIZE = int(os.environ.get("OUTPUT_QUEUE_SIZE", "64"))
 
 try:
     if not REDIS_HOST:
         raise ValueError("REDIS_HOST is required")
 
-    r = redis.from_url(REDIS_HOST)
-    model = Florence2Model(ModelConfig())
-    model.warmup()
-    logger.info("Model Worker Online", 
-                device=str(model.device), 
-                max_batch_size=MAX_BATCH_SIZE,
-                batch_timeout=f"{BATCH_TIMEOUT_MS*1000}ms")
+    with startup.phase("redis"):
+        r = redis.from_url(REDIS_HOST)
+        queue = get_task_queue(r)
+        queue.setup()
+        finish_flight = r.register_script(FINISH_SCRIPT)
+    # Under the supervisor each worker gets its own cores and thread count
+    cpus, threads = apply_pinning()
+    with startup.phase("model"):
+        model = Florence2Model(ModelConfig())
+    for phase, duration in model.load_timings.items():
+        startup.add(f"model_{phase}", duration)
+    scheduler = ContinuousBatchScheduler(model)
+    controller = AdaptiveBatchController(MAX_BATCH_SIZE, scheduler.max_rows, BATCH_TIMEOUT_MS)
 except Exception as e:
     logger.exception("Failed to initialize Model Worker", error=str(e))
     exit(1)
 
 
-while True:
-    try:
-        # 1. Wait for the FIRST task (Blocking)
-        res = r.brpop("florence_tasks", timeout=1)
-        if not res:
-            continue
-            
-        _, first_task_raw = res
-        task_list = [json.loads(first_task_raw)]
-        
-        # 2. DYNAMIC BATCHING: Try to fill the bus
-        # We wait up to BATCH_TIMEOUT_MS to see if more tasks arrive
-        deadline = time.time() + BATCH_TIMEOUT_MS
-        
-        while len(task_list) < MAX_BATCH_SIZE and time.time() < deadline:
-            # Non-blocking pop
-            next_task_raw = r.rpop("florence_tasks")
-            if next_task_raw:
-                task_list.append(json.loads(next_task_raw))
+def collect_waiters(replies):
+    """
+    Ends the single-flight of every coalesced task in one round trip and returns
+    (waiter, reply) pairs for the identical requests that joined while it was in flight.
+    """
+    coalesced = [(task, reply) for task, reply in replies if task.get('coalesce_key')]
+    if not coalesced:
+        return []
+
+    pipe = r.pipeline(transaction=False)
+    for task, _ in coalesced:
+        finish_flight(keys=flight_keys(task['coalesce_key']), client=pipe)
+
+    waiters = []
+    for (task, reply), addresses in zip(coalesced, pipe.execute()):
+        for address in addresses:
+            task_id, reply_to = parse_waiter_address(address)
+            waiters.append(({"task_id": task_id, "reply_to": reply_to, "request_id": task.get('request_id')}, reply))
+    if waiters:
+        logger.info("Fanning out coalesced replies", waiters=len(waiters))
+    return waiters
+
+
+def deliver(replies):
+    """
+    Pushes (task, reply) pairs onto the requesting processes' reply lists in one pipelined round trip.
+    The proxy's listener routes each reply to the waiting request by task_id.
+    Jobs have no waiting request, their outcome is written into the job instead.
+    """
+    replies = list(replies) + collect_waiters(replies)
+
+    pipe = r.pipeline(transaction=False)
+    reply_keys = set()
+    for task, reply in replies:
+        if task.get('job_id'):
+            if "error" in reply:
+                queue_job_update(pipe, task['job_id'], "failed", error=reply["error"])
             else:
-                # Small sleep to prevent tight loop if queue is empty
-                time.sleep(0.01)
-
-        if len(task_list) > 1:
-            logger.info("Batch assembled", 
-                        count=len(task_list),
-                        ids=[t.get('request_id') for t in task_list])
-
-        # 3. Prepare images for run_batch
-        batch_input = []
-        for t in task_list:
-            # Check for required fields to avoid crash
-            if 'image_b64' not in t:
-                logger.error("Malformed task: missing image_b64", request_id=t.get('request_id'))
+                queue_job_update(pipe, task['job_id'], "done", result=ingest.rescale_result(reply["result"], task.get('scale')))
+            continue
+
+        reply_to = task.get('reply_to')
+        if not reply_to:
+            logger.error("Task has no reply_to, dropping reply", request_id=task.get('request_id'))
+            continue
+
+        pipe.lpush(reply_to, wire.pack({**reply, "task_id": task.get('task_id')}))
+        reply_keys.add(reply_to)
+
+    for reply_to in reply_keys:
+        pipe.expire(reply_to, 60) # TTL for safety, the list is shared by all requests of that process
+    pipe.execute()
+
+
+def intake(entries):
+    """
+    Stage 1: turns raw queue entries into prepared tasks: payload decoded, image decoded and
+    tensorized, one DecodeRequest per sequence. Malformed tasks are answered and acked right
+    away so they are never redelivered.
+    """
+    for entry_id, raw in entries:
+        start_time = time.time()
+        try:
+            t = wire.unpack(raw)
+        except Exception:
+            logger.error("Malformed task: undecodable payload", entry_id=entry_id)
+            queue.ack([entry_id])
+            continue
+
+        # Check for required fields to avoid crash
+        if not wire.has_image(t) or not (t.get('task') or t.get('tasks')):
+            logger.error("Malformed task: missing image or task", request_id=t.get('request_id'))
+            outbox.put(("reply", [(t, {"error": "Malformed task: missing image or task"}, entry_id)]))
+            continue
+
+        try:
+            image = model.preprocess_image(wire.read_image(t))
+            slot = {
+                "entry_id": entry_id,
+                "task": t,
+                "image_size": (image.width, image.height),
+                "pixel_values": model.pixel_values([image]),
+                "started_at": start_time,
+                "done": False,
+            }
+            slot["requests"] = [
+                decode_request(slot, i, sub, t.get('deadline'))
+                for i, sub in enumerate(subtasks_of(t))
+            ]
+            slot["results"] = [None] * len(slot["requests"])
+            slot["remaining"] = len(slot["requests"])
+        except Exception as e:
+            logger.error("Failed to prepare task", request_id=t.get('request_id'), error=str(e))
+            outbox.put(("reply", [(t, {"error": str(e)}, entry_id)]))
+            continue
+
+        stages.add("intake", time.time() - start_time)
+        # Blocks while the scheduler is this far behind
+        prepared.put(slot)
+
+
+def decode_request(slot, index, sub, deadline):
+    generation = model.config.generation_kwargs(model.config.resolve_profile(sub['task'], sub.get('profile')))
+    return DecodeRequest(
+        (slot, index),
+        sub['task'] if sub.get('text_input') is None else sub['task'] + sub['text_input'],
+        num_beams=generation.get('num_beams', 1),
+        max_new_tokens=generation.get('max_new_tokens', 1024),
+        deadline=deadline,
+        # Streaming only applies to single task requests that someone is waiting on
+        stream=bool(slot['task'].get('stream')) and not slot['task'].get('tasks'),
+    )
+
+
+def subtasks_of(t):
+    """A multi-task request decodes one sequence per task, a single task is its own only subtask."""
+    return t.get('tasks') or [t]
+
+
+def rows_needed(t):
+    """Decode rows a task takes in the pool: one per beam of each of its sequences."""
+    try:
+        return sum(
+            model.config.generation_kwargs(model.config.resolve_profile(sub['task'], sub.get('profile'))).get('num_beams', 1)
+            for sub in subtasks_of(t)
+        )
+    except ValueError:
+        return 1
+
+
+def intake_loop():
+    while True:
+        try:
+            room = prepared.maxsize - prepared.qsize()
+            if room <= 0:
+                time.sleep(0.005)
                 continue
-                
-            batch_input.append({
-                "task": t['task'],
-                "text": t.get('text_input'),
-                "image": base64.b64decode(t['image_b64'])
-            })
-
-        inference_start = time.time()
-        
-        # 4. Run Inference
+            # One blocking multi-pop takes whatever has arrived, up to the room left
+            entries = queue.pop(room, block_ms=1000)
+            reject_dead_letters(queue.dead_letters())
+            intake(entries)
+            # The decode loop refreshes them too, but it only starts after warmup
+            queue.refresh()
+        except Exception as e:
+            logger.exception("Intake stage error", error=str(e))
+            time.sleep(1)
+
+
+def reject_dead_letters(entries):
+    """Answers tasks the queue gave up on after repeated crashed deliveries with an error reply (or a failed job)."""
+    for entry_id, raw in entries:
         try:
-            results = model.run_batch(batch_input)
+            t = wire.unpack(raw)
+        except Exception:
+            queue.ack([entry_id])
+            continue
+        outbox.put(("reply", [(t, DEAD_LETTER_REPLY, entry_id)]))
+
+
+def start(batch):
+    """
+    Stage 2a: prefills a formed batch of prepared tasks into the decode pool. A multi-task
+    request becomes one sequence per task, all sharing a single pass of the vision encoder.
+    """
+    slots = [slot for slot, _ in batch]
+    jobs = [slot['task']['job_id'] for slot in slots if slot['task'].get('job_id')]
+    controller.observe_prefill(len(slots))
+    if jobs:
+        outbox.put(("progress", jobs, "batched"))
+    try:
+        with stages.timed("prefill", len(slots)):
+            scheduler.admit([(slot.pop("pixel_values"), slot["requests"]) for slot in slots])
+    except Exception as e:
+        logger.exception("Prefill failed", error=str(e))
+        outbox.put(("fail", slots, str(e)))
+        return
+    if jobs:
+        outbox.put(("progress", jobs, "generating"))
+
+
+def complete(finished):
+    """
+    Stage 3: parses the sequences that left the pool and replies to every task whose sequences
+    are all done. A slot's results and completion are only updated by this stage, so no lock is needed.
+    """
+    replies, slots = [], []
+    for request, token_ids in finished:
+        slot, index = request.handle
+        # A sibling sequence already expired or failed the whole task
+        if slot['done']:
+            continue
+
+        t = slot['task']
+        if token_ids is None:
+            slot['done'] = True
+            replies.append((t, EXPIRED_REPLY))
+            slots.append(slot)
+            continue
+
+        try:
+            with stages.timed("postprocess"):
+                sub = subtasks_of(t)[index]
+                slot['results'][index] = model.decode_tokens(token_ids, sub['task'], slot['image_size'])
         except Exception as e:
-            # Notify ALL pending requests in this batch that it failed/timed out
-            for t in task_list:
-                req_id = t.get('request_id')
-                r.lpush(req_id, json.dumps({"error": str(e)}))
-                r.expire(req_id, 10)
+            logger.exception("Failed to parse generation", request_id=t.get('request_id'), error=str(e))
+            slot['done'] = True
+            replies.append((t, {"error": str(e)}))
+            slots.append(slot)
+            continue
+
+        slot['remaining'] -= 1
+        if slot['remaining'] == 0:
+            slot['done'] = True
+            result = slot['results'] if t.get('tasks') else slot['results'][0]
+            replies.append((t, {"result": result}))
+            slots.append(slot)
+
+    if not replies:
+        return
+    send([(t, reply, slot['entry_id']) for (t, reply), slot in zip(replies, slots)])
+
+    now = time.time()
+    for slot in slots:
+        # Queue wait included when the proxy stamped the task
+        controller.observe_request(now - (slot['task'].get('enqueued_at') or slot['started_at']))
+    logger.info("Delivered",
+                request_ids=[slot['task'].get('request_id') for slot in slots],
+                durations=[round(now - slot['started_at'], 2) for slot in slots])
+
+
+def send(items):
+    """Delivery, then ack, of (task, reply, entry_id) triples. A crash before the ack leaves the tasks pending for redelivery."""
+    with stages.timed("deliver", len(items)):
+        deliver([(t, reply) for t, reply, _ in items])
+        queue.ack([entry_id for _, _, entry_id in items])
+
+
+def stream_partials(partials):
+    """
+    Sends streaming requests the text generated so far, whenever it changed, on their reply list.
+    Runs in the output stage ahead of the sequence's final reply, so partials always arrive first.
+    """
+    pipe = r.pipeline(transaction=False)
+    sent = 0
+    for request, token_ids in partials:
+        slot, _ = request.handle
+        if slot['done'] or not slot['task'].get('reply_to'):
+            continue
+        text = model.decode_text(token_ids)
+        if not text or text == slot.get('streamed_text'):
             continue
-        
-        duration = round(time.time() - inference_start, 2)
-
-        # 5. Delivery
-        for i, result in enumerate(results):
-            req_id = task_list[i]['request_id']
-            
-            # Push to the "Private Mailbox"
-            r.lpush(req_id, json.dumps(result))
-            r.expire(req_id, 60) # TTL for safety
-            
-            logger.info("Delivered", 
-                        request_id=req_id, 
-                        duration=duration, 
-                        batch_pos=i)
+        slot['streamed_text'] = text
+        t = slot['task']
+        pipe.lpush(t['reply_to'], wire.pack({"task_id": t.get('task_id'), "partial": text}))
+        sent += 1
+    if sent:
+        pipe.execute()
+
+
+def report_progress(job_ids, status):
+    """Publishes the new state of several jobs in one round trip."""
+    pipe = r.pipeline(transaction=False)
+    for job_id in job_ids:
+        queue_job_update(pipe, job_id, status)
+    pipe.execute()
+
+
+def output_loop():
+    while True:
+        kind, *args = outbox.get()
+        try:
+            if kind == "finished":
+                complete(args[0])
+            elif kind == "reply":
+                send(args[0])
+            elif kind == "progress":
+                report_progress(*args)
+            elif kind == "partial":
+                stream_partials(args[0])
+            elif kind == "fail":
+                slots, error = args
+                failed = [slot for slot in slots if not slot['done']]
+                for slot in failed:
+                    slot['done'] = True
+                send([(slot['task'], {"error": error}, slot['entry_id']) for slot in failed])
+        except Exception as e:
+            logger.exception("Output stage error", error=str(e))
+
+
+def publish_metrics():
+    """Closes the controller's window, applies its decision and publishes the result for /worker/metrics."""
+    metrics = controller.adjust(queue.depth(), scheduler.rows)
+    scheduler.max_rows = controller.max_rows
+    metrics.update(stages.report())
+    metrics.update(prepared_queue=prepared.qsize(), output_queue=outbox.qsize())
+    # Tasks this worker already took off the queue: waiting to be admitted, and decoding.
+    # The API's admission control counts them as queued, Redis no longer does.
+    metrics.update(waiting_tasks=prepared.qsize() + len(former),
+                   active_tasks=len({id(seq.request.handle[0]) for seq in scheduler.sequences}))
+
+    try:
+        pipe = r.pipeline(transaction=False)
+        pipe.hset(worker_metrics_key(), mapping=metrics)
+        # A worker that stops publishing disappears from the metrics
+        pipe.expire(worker_metrics_key(), int(BATCH_ADJUST_INTERVAL_S * 3) + 1)
+        pipe.execute()
+    except redis.RedisError as e:
+        logger.warning("Failed to publish worker metrics", error=str(e))
+
+    logger.info("Stage timings", **{k: v for k, v in metrics.items() if k.startswith("stage_") or k.endswith("_queue")})
+    if metrics['decision'] != "hold":
+        logger.info("Batch settings adjusted", **metrics)
+
+
+def take_prepared(block_s=None):
+    """Moves prepared tasks into the batch former, waiting up to block_s for the first one."""
+    try:
+        slot = prepared.get(timeout=block_s) if block_s else prepared.get_nowait()
+    except Empty:
+        return
+    while True:
+        former.add(slot, slot['task'])
+        if len(former) >= max(BATCH_LOOKAHEAD, controller.batch_size):
+            return
+        try:
+            slot = prepared.get_nowait()
+        except Empty:
+            return
+
+
+# Sent instead of a result when a task's deadline passes. The original caller is gone,
+# but requests coalesced onto it may still be waiting and should fail fast.
+EXPIRED_REPLY = {"error": "Deadline exceeded before the model could finish"}
+# Sent for a task whose deliveries kept taking workers down (STREAM_MAX_DELIVERIES)
+DEAD_LETTER_REPLY = {"error": "Task dropped after repeatedly failing on model workers"}
+
+# The worker is a pipeline of three threads joined by bounded queues:
+#   intake    pops tasks, decodes and tensorizes images       -> prepared
+#   scheduler (this thread) admits prepared tasks and runs the decode steps -> outbox
+#   output    parses finished sequences, delivers and acks
+# so image decoding for upcoming tasks and parsing/delivery of finished ones overlap with decoding.
+stages = StageStats()
+prepared = Queue(maxsize=PREPARED_QUEUE_SIZE)
+outbox = Queue(maxsize=OUTPUT_QUEUE_SIZE)
+# The former holds prepared slots in place of queue entry ids
+former = BatchFormer()
+
+# The intake stage starts taking and decoding tasks while the model warms up,
+# so the first batch is prepared by the time the decode loop begins
+threading.Thread(target=intake_loop, name="intake", daemon=True).start()
+threading.Thread(target=output_loop, name="output", daemon=True).start()
+
+try:
+    with startup.phase("warmup"):
+        scheduler.warmup()
+except Exception as e:
+    logger.exception("Warmup failed", error=str(e))
+    exit(1)
+
+timings = startup.report()
+heartbeat = Heartbeat(r, device=model.device, backend=model.backend.name, precision=model.precision,
+                      ready_at=f"{time.time():.3f}", **timings)
+heartbeat.beat(force=True)
+if os.environ.get("WORKER_READY_FILE"):
+    # Tells the supervisor the next worker may start loading
+    open(os.environ["WORKER_READY_FILE"], "w").close()
+logger.info("Startup timings", **timings)
+logger.info("Model Worker Online", 
+            device=str(model.device), 
+            max_batch_size=MAX_BATCH_SIZE,
+            max_active_rows=scheduler.max_rows,
+            batch_lookahead=BATCH_LOOKAHEAD,
+            queue_backend=QUEUE_BACKEND,
+            adaptive_batching=ADAPTIVE_BATCHING,
+            batch_timeout=f"{BATCH_TIMEOUT_MS*1000}ms",
+            cpus=cpus or "all",
+            threads=threads or "default")
+
+while True:
+    try:
+        # Only a loop that keeps turning keeps the worker ready
+        heartbeat.beat()
+        # Keeps the tasks this worker holds from being claimed by others as orphaned
+        queue.refresh()
+        if controller.due():
+            publish_metrics()
+
+        # 1. Take prepared tasks. Block only when there is nothing to admit or decode.
+        if not len(former) and not len(scheduler):
+            take_prepared(block_s=1)
+            if not len(former):
+                continue
+            # Coming out of idle, let a burst fill up so it shares the first prefill
+            while not former.ready(controller.batch_size, controller.wait_s):
+                take_prepared(block_s=max(controller.wait_s - former.oldest_age(), 0.001))
+        else:
+            take_prepared()
+
+        # 2. Drop tasks whose caller already timed out, a tiny error reply is all they cost
+        expired = former.drop_expired()
+        if expired:
+            logger.warning("Dropping expired tasks", count=len(expired), ids=[t.get('request_id') for _, t in expired])
+            outbox.put(("reply", [(t, EXPIRED_REPLY, slot['entry_id']) for slot, t in expired]))
+
+        # 3. Admit waiting tasks into free decode rows at this step boundary.
+        # An empty pool takes a task even if it needs more rows than the pool has.
+        if len(former) and scheduler.free_rows:
+            batch = former.next_batch(controller.batch_size, max_rows=scheduler.free_rows,
+                                      rows_of=rows_needed, min_one=not len(scheduler))
+            if batch:
+                start(batch)
+
+        # 4. One token step for every sequence in the pool; finished ones go to the output stage right away
+        if len(scheduler):
+            try:
+                step_start = time.time()
+                rows = scheduler.rows
+                finished = scheduler.step()
+                controller.observe_step(time.time() - step_start, rows)
+                stages.add("step", time.time() - step_start)
+            except Exception as e:
+                # The pool's caches are in an unknown state, fail everything in it
+                logger.exception("Decode step failed", error=str(e))
+                slots = {id(req.handle[0]): req.handle[0] for req in scheduler.abort()}
+                outbox.put(("fail", list(slots.values()), str(e)))
+                continue
+            if finished:
+                outbox.put(("finished", finished))
+            partials = scheduler.streaming()
+            if partials:
+                outbox.put(("partial", partials))
 
     except Exception as e:
         logger.exception("Worker loop error", error=str(e))
-        time.sleep(1)
\ No newline at end of file
+        time.sleep(1)
@@ -0,0 +1,44 @@
+import time
+import threading
+from contextlib import contextmanager
+from collections import defaultdict
+
+
+class StageStats:
+    """
+    Busy time and item counts of the worker's pipeline stages, shared by the stage threads.
+    report() returns each stage's average time per item and its utilization (share of wall time
+    it was busy) since the previous report, which tells which stage bounds throughput.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._busy = defaultdict(float)
+        self._items = defaultdict(int)
+        self._since = time.time()
+
+    @contextmanager
+    def timed(self, stage, items=1):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(stage, time.time() - start, items)
+
+    def add(self, stage, duration, items=1):
+        with self._lock:
+            self._busy[stage] += duration
+            self._items[stage] += items
+
+    def report(self):
+        with self._lock:
+            now = time.time()
+            elapsed = max(now - self._since, 1e-6)
+            stats = {}
+            for stage, busy in self._busy.items():
+                items = self._items[stage]
+                stats[f"stage_{stage}_ms"] = round(busy / items * 1000, 2) if items else 0.0
+                stats[f"stage_{stage}_util"] = round(busy / elapsed, 3)
+            self._busy.clear()
+            self._items.clear()
+            self._since = now
+            return stats
@@ -1,41 +1,27 @@
-import io
 import chainlit as cl
-from PIL import Image
 from app.logging_config import get_logger
-from app.utils import draw_polygons, plot_bbox, draw_ocr_bboxes, fig_to_pil
-from app.constants import (
-    CAPTION_TO_PHRASE_GROUNDING,
-    REFERRING_EXPRESSION_SEGMENTATION,
-    OPEN_VOCABULARY_DETECTION,
-    OD,
-    DENSE_REGION_CAPTION,
-    REGION_PROPOSAL,
-    REGION_TO_SEGMENTATION,
-    OCR_WITH_REGION
-)
-from app.config import S3StorageClient
+from app.render import render_encoded_async, has_visualization, mime_type, file_extension
+from app.config import get_storage_client
+from app.constants import TEXT_TASKS
 
 logger = get_logger(__name__)
 
-def image_to_bytes(image):
-    buf = io.BytesIO()
-    image.save(buf, format='PNG')
-    return buf.getvalue()
 
-
-async def run_inference_and_visualize(model, task_type, text_input, image_bytes, return_path=False, request_id=None, path_prefix="chainlit"):
+async def run_inference_and_visualize(model, task_type, text_input, image_bytes, return_path=False, request_id=None, path_prefix="chainlit", use_cache=True, profile=None,
+                                      visualize=True, image_format="png", image_quality=None):
     """
     Core logic: Takes task, input, and image bytes. 
     Returns the raw result and a list of processed image data (bytes or MinIO URLs).
     if return_path = True, output image gets stored in the minio and path is returned
+    if use_cache = False, the result cache is bypassed and the model always runs
+    profile selects a named generation profile (None = the task's default)
+    if visualize = False, no overlay is drawn (the list is empty)
+    image_format / image_quality select the overlay encoding (png, webp, jpeg)
     """
-    logger.info("Running inference core", task=task_type, return_path=return_path, path_prefix=path_prefix)
-    
-    # 1. Load Image
-    original_image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+    logger.info("Running inference core", task=task_type, profile=profile, return_path=return_path, path_prefix=path_prefix)
     
-    # 2. Inference call
-    result = model.run_example(task_type, text_input, image_bytes)
+    # 1. Inference call (awaited, so other requests keep flowing while the worker is busy)
+    result = await model.run_example(task_type, text_input, image_bytes, use_cache=use_cache, profile=profile)
     
     # 2. ADD THE DEBUG LINE HERE
     logger.debug("DEBUGGING MODEL OUTPUT", 
@@ -45,30 +31,54 @@ async def run_inference_and_visualize(model, task_type, text_input, image_bytes,
     
     # 3. Visualization Logic
     visualized_images = []
-    det_tasks = [OD, DENSE_REGION_CAPTION, REGION_PROPOSAL, CAPTION_TO_PHRASE_GROUNDING, OPEN_VOCABULARY_DETECTION]
-    
-    processed_image = None
-    if task_type in det_tasks:
-        fig = plot_bbox(original_image, result[task_type])
-        processed_image = fig_to_pil(fig)
-    elif task_type in [REFERRING_EXPRESSION_SEGMENTATION, REGION_TO_SEGMENTATION]:
-        processed_image = original_image.copy()
-        draw_polygons(processed_image, result[task_type], fill_mask=True)
-    elif task_type == OCR_WITH_REGION:
-        processed_image = original_image.copy()
-        draw_ocr_bboxes(processed_image, result[task_type])
+    if visualize:
+        visualized_images = await visualize_result(task_type, result, image_bytes, return_path, request_id, path_prefix,
+                                                   image_format=image_format, image_quality=image_quality)
+    return result, visualized_images
+
+
+async def run_multi_inference_and_visualize(model, tasks, image_bytes, return_path=False, request_id=None, path_prefix="chainlit", use_cache=True, profile=None,
+                                            visualize=True, image_format="png", image_quality=None):
+    """
+    Multi-task variant: runs every (task_type, text_input) pair in tasks on the same image
+    with a single worker round trip. Returns a list of (result, visualized_images) in task order.
+    """
+    logger.info("Running multi-task inference core", tasks=[t for t, _ in tasks], profile=profile, return_path=return_path)
+
+    results = await model.run_multi(tasks, image_bytes, use_cache=use_cache, profile=profile)
+
+    outputs = []
+    for i, ((task_type, _), result) in enumerate(zip(tasks, results)):
+        visualized_images = []
+        if visualize:
+            visualized_images = await visualize_result(task_type, result, image_bytes, return_path, request_id, path_prefix,
+                                                       object_key=f"result_{i}_{task_type}.{file_extension(image_format)}",
+                                                       image_format=image_format, image_quality=image_quality)
+        outputs.append((result, visualized_images))
+    return outputs
+
+
+async def visualize_result(task_type, result, image_bytes, return_path=False, request_id=None, path_prefix="chainlit", object_key=None,
+                           image_format="png", image_quality=None):
+    """
+    Draws the result of a detection, segmentation or OCR task over the original image, in the render pool.
+    Returns a list with the overlay (PNG bytes, or its S3 URL when return_path = True), empty for text only tasks.
+    Text only tasks never decode the image at all.
+    """
+    visualized_images = []
+    if not has_visualization(task_type):
+        return visualized_images
+
+    img_bytes = await render_encoded_async(task_type, result[task_type], image_bytes, image_format, image_quality)
 
     # 4. Handle Return Format (Bytes vs. MinIO Path)
-    if processed_image:
-        img_bytes = image_to_bytes(processed_image)
-        
+    if img_bytes:
         if return_path:
-            # Initialize S3 client and upload
-            s3_client = S3StorageClient()
-            upload_result = await s3_client.upload_file(
+            # Shared pooled client, the upload runs off the event loop
+            upload_result = await get_storage_client().upload_file(
                 data=img_bytes, 
-                mime="image/png", 
-                object_key=f"result_{task_type}.png",
+                mime=mime_type(image_format), 
+                object_key=object_key or f"result_{task_type}.{file_extension(image_format)}",
                 threadId=request_id, 
                 path_prefix=path_prefix
             )
@@ -76,7 +86,28 @@ async def run_inference_and_visualize(model, task_type, text_input, image_bytes,
         else:
             visualized_images.append(img_bytes)
 
-    return result, visualized_images
+    return visualized_images
+
+
+async def stream_text_result(model, task_type, text_input, image_data):
+    """Streams the generated text into one Chainlit message, then replaces it with the parsed result."""
+    answer = cl.Message(content=f"**Result for {task_type}:**\n")
+    header = answer.content
+    await answer.send()
+
+    shown = ""
+    async for kind, value in model.stream_example(task_type, text_input, image_data):
+        if kind == "partial":
+            if value.startswith(shown):
+                await answer.stream_token(value[len(shown):])
+            else:
+                # Beam search revised earlier text
+                answer.content = header + value
+                await answer.update()
+            shown = value
+        else:
+            answer.content = f"{header}{value}"
+            await answer.update()
 
 
 async def process_image_workflow(model, text_input, task_menu_callback):
@@ -94,6 +125,12 @@ async def process_image_workflow(model, text_input, task_menu_callback):
         # 1. Read file from disk (Chainlit specific)
         with open(image_element.path, 'rb') as f:
             image_data = f.read()
+
+        # Text tasks show their output as it is generated
+        if task_type in TEXT_TASKS:
+            await stream_text_result(model, task_type, text_input, image_data)
+            logger.info("Chainlit workflow completed ✅", task=task_type)
+            return
         
         # 2. FIX: Added 'await' here because the core logic is now async
         result, image_outputs = await run_inference_and_visualize(
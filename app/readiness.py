@@ -0,0 +1,127 @@
+import os
+import sys
+import time
+import socket
+import argparse
+from contextlib import contextmanager
+from app.logging_config import get_logger
+
+logger = get_logger(__name__)
+
+# A worker that has warmed up keeps this key alive while its main loop runs. The API's /ready
+# and the entrypoint read it directly instead of watching the worker's log.
+WORKER_READY_KEY_PREFIX = "florence_worker:ready"
+# How often the main loop refreshes the key, and how long it outlives the last refresh.
+# A worker stuck in one step longer than the TTL stops counting as ready.
+HEARTBEAT_INTERVAL_S = float(os.environ.get("HEARTBEAT_INTERVAL_S", "2"))
+HEARTBEAT_TTL_S = int(os.environ.get("HEARTBEAT_TTL_S", "15"))
+# Set by entrypoint.sh for each container start and inherited by its workers. A restarted container
+# reuses the hostname and usually the pids, so the previous run's keys can still be alive; --local
+# only counts heartbeats carrying the current boot id.
+WORKER_BOOT_ID = os.environ.get("WORKER_BOOT_ID", "")
+
+
+def worker_ready_key(host=None, pid=None):
+    return f"{WORKER_READY_KEY_PREFIX}:{host or socket.gethostname()}:{pid or os.getpid()}"
+
+
+def process_age_s():
+    """Seconds since this process was started, covering interpreter start and imports. None without /proc."""
+    try:
+        with open("/proc/self/stat") as f:
+            # Field 22 is the start time in clock ticks after boot, counted after the ")" ending the name
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class StartupTimer:
+    """Wall time of each named startup phase, logged as one breakdown once the worker is ready."""
+    def __init__(self):
+        self.phases = {}
+        self._start = time.time()
+        age = process_age_s()
+        if age is not None:
+            # Everything before the timer existed: interpreter, torch and transformers imports
+            self.phases["imports"] = age
+            self._start -= age
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def add(self, name, duration):
+        self.phases[name] = self.phases.get(name, 0.0) + duration
+
+    def total(self):
+        return time.time() - self._start
+
+    def report(self):
+        """Phase -> seconds. Phases that overlapped each other sum to more than the total."""
+        report = {f"{name}_s": round(duration, 2) for name, duration in self.phases.items()}
+        report["total_s"] = round(self.total(), 2)
+        return report
+
+
+class Heartbeat:
+    """The ready key of this worker: info fields plus a last_beat timestamp, refreshed at most every HEARTBEAT_INTERVAL_S."""
+    def __init__(self, client, **info):
+        self.client = client
+        self.key = worker_ready_key()
+        self.info = {k: str(v) for k, v in info.items()}
+        if WORKER_BOOT_ID:
+            self.info["boot_id"] = WORKER_BOOT_ID
+        self._last = 0.0
+
+    def beat(self, force=False):
+        now = time.time()
+        if not force and now - self._last < HEARTBEAT_INTERVAL_S:
+            return
+        self._last = now
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            pipe.hset(self.key, mapping={**self.info, "last_beat": f"{now:.3f}"})
+            pipe.expire(self.key, HEARTBEAT_TTL_S)
+            pipe.execute()
+        except Exception as e:
+            # The worker keeps serving, it just stops looking ready until Redis is back
+            logger.warning("Failed to send heartbeat", error=str(e))
+
+
+def ready_workers(client, host=None):
+    """Ready key suffix (host:pid) -> info of every worker with a live heartbeat, only those on host if given."""
+    pattern = f"{WORKER_READY_KEY_PREFIX}:{host}:*" if host else f"{WORKER_READY_KEY_PREFIX}:*"
+    workers = {}
+    for key in client.scan_iter(match=pattern):
+        fields = client.hgetall(key)
+        if fields:
+            workers[key.decode()[len(WORKER_READY_KEY_PREFIX) + 1:]] = {k.decode(): v.decode() for k, v in fields.items()}
+    return workers
+
+
+def main():
+    """Exit status 0 when a worker is ready. entrypoint.sh runs it with --local while waiting for its own worker."""
+    import redis
+
+    parser = argparse.ArgumentParser(description="Checks for a model worker with a live heartbeat")
+    parser.add_argument("--local", action="store_true", help="only count workers on this host, started by this boot")
+    args = parser.parse_args()
+    try:
+        workers = ready_workers(redis.from_url(os.environ["REDIS_HOST"]), socket.gethostname() if args.local else None)
+    except Exception as e:
+        print(f"Readiness check failed: {e}", file=sys.stderr)
+        sys.exit(2)
+    if args.local and WORKER_BOOT_ID:
+        workers = {name: info for name, info in workers.items() if info.get("boot_id") == WORKER_BOOT_ID}
+    sys.exit(0 if workers else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,51 +1,543 @@
 import os
-import redis
-import json
+import time
 import uuid
-import base64
+import socket
+import asyncio
 import structlog
+import redis.asyncio as aioredis
 from fastapi import HTTPException
 from app.logging_config import get_logger
+from app.task_queue import get_task_queue
+from app.result_cache import ResultCache, make_cache_key, RESULT_CACHE_ENABLED
+from app.single_flight import COALESCE_ENABLED, JOIN_SCRIPT, FINISH_SCRIPT, flight_keys, waiter_address, parse_waiter_address
+from app.batch_controller import WORKER_METRICS_KEY_PREFIX
+from app.readiness import WORKER_READY_KEY_PREFIX
+from app.visualization_store import VisualizationStore
+from app.jobs import JobStore, JOB_TIMEOUT
+from app.admission import AdmissionController
+from app.config import ModelConfig
+from app import wire, ingest
 
 logger = get_logger(__name__)
 
-r = redis.from_url(os.environ.get("REDIS_HOST", "redis://florence-redis:6379"))
+REDIS_HOST = os.environ.get("REDIS_HOST", "redis://florence-redis:6379")
 MODEL_TIMEOUT = int(os.environ.get("MODEL_TIMEOUT", "30"))
+# Most items of one run_many call (/predict_batch) queued or running at a time
+BATCH_MAX_IN_FLIGHT = int(os.environ.get("BATCH_MAX_IN_FLIGHT", "32"))
+# Every process owns one reply list. The worker pushes all replies for this process onto it
+# and a single listener task routes them to the waiting request by task_id.
+REPLY_KEY_PREFIX = "florence_replies"
+
 
 class RedisModelProxy:
     """
-    Acts as a 'Fake' model. Instead of running inference, 
-    it pushes to Redis and waits for the worker.
+    Acts as a 'Fake' model. Instead of running inference,
+    it pushes to Redis and awaits the worker's reply without blocking the event loop.
     """
-    def run_example(self, task_prompt, text_input=None, image_data=None):
+    def __init__(self):
+        self.config = ModelConfig()
+        self._redis = None
+        self._queue = None
+        self._cache = None
+        self._visualizations = None
+        self._jobs = None
+        self._admission = None
+        self._join_flight_script = None
+        self._finish_flight_script = None
+        self._listener_redis = None
+        self._listener_task = None
+        self._reply_key = None
+        self._pending: dict[str, asyncio.Future] = {}
+        # task_id -> queue of partial texts, for requests made through stream_example
+        self._streams: dict[str, asyncio.Queue] = {}
+
+    @property
+    def reply_key(self):
+        return self._reply_key
+
+    def _ensure_listener(self):
+        """
+        Lazily binds the Redis clients and the reply listener to the running event loop.
+        Done on first use (not in __init__) so that gunicorn forks and Chainlit's loop each get their own.
+        """
+        if self._listener_task is not None and not self._listener_task.done():
+            return
+
+        self._redis = aioredis.from_url(REDIS_HOST)
+        self._queue = get_task_queue(self._redis)
+        self._cache = ResultCache(self._redis)
+        self._visualizations = VisualizationStore(self._redis)
+        self._jobs = JobStore(self._redis)
+        self._admission = AdmissionController(self._redis, self._queue)
+        self._join_flight_script = self._redis.register_script(JOIN_SCRIPT)
+        self._finish_flight_script = self._redis.register_script(FINISH_SCRIPT)
+        # The listener parks on BRPOP, so it gets a dedicated connection
+        self._listener_redis = aioredis.from_url(REDIS_HOST)
+        self._reply_key = f"{REPLY_KEY_PREFIX}:{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._listener_task = asyncio.get_running_loop().create_task(self._listen())
+        logger.info("Reply listener started", reply_key=self._reply_key)
+
+    async def _listen(self):
+        while True:
+            try:
+                res = await self._listener_redis.brpop(self._reply_key, timeout=1)
+                if not res:
+                    continue
+
+                _, reply_raw = res
+                reply = wire.unpack(reply_raw)
+                if "partial" in reply:
+                    stream = self._streams.get(reply.get("task_id"))
+                    if stream is not None:
+                        stream.put_nowait(reply["partial"])
+                    continue
+
+                future = self._pending.pop(reply.get("task_id"), None)
+
+                # The caller may already have timed out; a late reply is simply dropped
+                if future is None or future.done():
+                    logger.warning("Dropping reply with no waiting request", task_id=reply.get("task_id"))
+                    continue
+                future.set_result(reply)
+
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception("Reply listener error", error=str(e))
+                await asyncio.sleep(1)
+
+    async def close(self):
+        if self._listener_task is not None:
+            self._listener_task.cancel()
+            try:
+                await self._listener_task
+            except asyncio.CancelledError:
+                pass
+            self._listener_task = None
+
+        for future in self._pending.values():
+            if not future.done():
+                future.cancel()
+        self._pending.clear()
+        self._streams.clear()
+
+        for client in (self._redis, self._listener_redis):
+            if client is not None:
+                await client.aclose()
+        self._redis = None
+        self._listener_redis = None
+        logger.info("Reply listener stopped", reply_key=self._reply_key)
+
+    @property
+    def visualizations(self):
+        """Store of results waiting for lazy rendering, on this process's Redis client."""
+        self._ensure_listener()
+        return self._visualizations
+
+    @property
+    def jobs(self):
+        """Store of submitted jobs, on this process's Redis client."""
+        self._ensure_listener()
+        return self._jobs
+
+    @property
+    def admission(self):
+        """Queue depth admission control, for endpoints that must reject before they start streaming."""
+        self._ensure_listener()
+        return self._admission
+
+    async def cache_stats(self):
+        self._ensure_listener()
+        return await self._cache.stats()
+
+    async def worker_metrics(self):
+        """The batching settings and latest measurements each live model worker publishes."""
+        self._ensure_listener()
+        workers = {}
+        async for key in self._redis.scan_iter(match=f"{WORKER_METRICS_KEY_PREFIX}:*"):
+            fields = await self._redis.hgetall(key)
+            if fields:
+                name = key.decode()[len(WORKER_METRICS_KEY_PREFIX) + 1:]
+                workers[name] = {k.decode(): v.decode() for k, v in fields.items()}
+        return workers
+
+    async def ready_workers(self):
+        """Every model worker with a live heartbeat: its device, backend and startup timings."""
+        self._ensure_listener()
+        workers = {}
+        async for key in self._redis.scan_iter(match=f"{WORKER_READY_KEY_PREFIX}:*"):
+            fields = await self._redis.hgetall(key)
+            if fields:
+                name = key.decode()[len(WORKER_READY_KEY_PREFIX) + 1:]
+                workers[name] = {k.decode(): v.decode() for k, v in fields.items()}
+        return workers
+
+    async def run_example(self, task_prompt, text_input=None, image_data=None, use_cache=True, profile=None):
+        """
+        Returns the parsed result for one task. Served from the result cache when possible;
+        use_cache=False skips the lookup (the fresh result still refreshes the cache).
+        profile names a generation profile from ModelConfig, None means the task's default.
+        """
         # image_data is mandatory as per API contract
         if image_data is None:
             raise ValueError("image_data is mandatory for inference")
 
-        # Get existing request_id from context or create one
+        profile = self.config.resolve_profile(task_prompt, profile)
+        self._ensure_listener()
+
+        # The content address of this inference keys both the result cache and request coalescing
+        request_key = None
+        if RESULT_CACHE_ENABLED or COALESCE_ENABLED:
+            request_key = self._request_key(image_data, task_prompt, text_input, profile)
+
+        if use_cache:
+            cached = await self._cache_get(request_key)
+            if cached is not None:
+                logger.info("Result cache hit", task=task_prompt, cache_key=request_key)
+                return cached
+
+        # Oversized uploads are queued downscaled, the result is mapped back to original coordinates
+        queued_image, scale = await asyncio.to_thread(ingest.prepare_image, image_data)
+        result = await self._dispatch(
+            {"task": task_prompt, "text_input": text_input, "profile": profile},
+            queued_image,
+            coalesce_key=request_key if COALESCE_ENABLED else None
+        )
+        result = ingest.rescale_result(result, scale)
+
+        await self._cache_set(request_key, result)
+        return result
+
+    async def run_multi(self, tasks, image_data, use_cache=True, profile=None):
+        """
+        Runs several tasks on one image as a single worker task, so the image is uploaded to the
+        queue once and encoded once. tasks is a list of (task_prompt, text_input) pairs.
+        Cached results are reused per task; only the misses go to the worker.
+        Returns the parsed results in task order.
+        """
+        if image_data is None:
+            raise ValueError("image_data is mandatory for inference")
+
+        subtasks = [
+            {"task": task, "text_input": text, "profile": self.config.resolve_profile(task, profile)}
+            for task, text in tasks
+        ]
+        self._ensure_listener()
+
+        keys = [None] * len(subtasks)
+        results = [None] * len(subtasks)
+        if RESULT_CACHE_ENABLED:
+            keys = [self._request_key(image_data, t["task"], t["text_input"], t["profile"]) for t in subtasks]
+            if use_cache:
+                for i, key in enumerate(keys):
+                    results[i] = await self._cache_get(key)
+
+        missing = [i for i, result in enumerate(results) if result is None]
+        logger.info("Multi-task request", tasks=len(subtasks), cached=len(subtasks) - len(missing))
+
+        if missing:
+            queued_image, scale = await asyncio.to_thread(ingest.prepare_image, image_data)
+            fresh = await self._dispatch({"tasks": [subtasks[i] for i in missing]}, queued_image)
+            for i, result in zip(missing, fresh):
+                results[i] = result = ingest.rescale_result(result, scale)
+                await self._cache_set(keys[i], result)
+
+        return results
+
+    async def submit_job(self, task_prompt, text_input=None, image_data=None, use_cache=True, profile=None):
+        """
+        Enqueues one task as a job and returns its id without waiting for the model. The worker
+        writes the outcome into the job (see app.jobs), so the job outlives this request and
+        runs against JOB_TIMEOUT instead of MODEL_TIMEOUT. A cached result completes the job at once.
+        """
+        if image_data is None:
+            raise ValueError("image_data is mandatory for inference")
+
+        profile = self.config.resolve_profile(task_prompt, profile)
+        self._ensure_listener()
         request_id = structlog.contextvars.get_contextvars().get("request_id") or uuid.uuid4().hex
-        
-        logger.info(f"Dispatching task to worker task. request_id {request_id} ")
+        job_id = uuid.uuid4().hex
+        job_fields = {"task": task_prompt, "text_input": text_input, "profile": profile, "request_id": request_id}
 
-        # 1. Package the task
+        if use_cache and RESULT_CACHE_ENABLED:
+            cached = await self._cache_get(self._request_key(image_data, task_prompt, text_input, profile))
+            if cached is not None:
+                logger.info("Result cache hit, job completed on submit", task=task_prompt, job_id=job_id)
+                await self._jobs.create(job_id, "done", result=cached, **job_fields)
+                return job_id
+
+        # A job waits up to JOB_TIMEOUT, but an over-full queue still has no room for it
+        await self._admission.admit(JOB_TIMEOUT)
+        queued_image, scale = await asyncio.to_thread(ingest.prepare_image, image_data)
+        now = time.time()
         payload = {
             "request_id": request_id,
+            "task_id": job_id,
+            # No reply_to: the worker completes the job in Redis instead of replying
+            "job_id": job_id,
+            "deadline": now + JOB_TIMEOUT,
+            "enqueued_at": now,
             "task": task_prompt,
             "text_input": text_input,
-            "image_b64": base64.b64encode(image_data).decode('utf-8')
+            "profile": profile,
+            # Image stays inline: a job may wait longer than a shm file should live, and nobody here releases it
+            "image": queued_image,
         }
+        if scale:
+            # The worker maps coordinates back to the original image, as run_example does here
+            payload["scale"] = list(scale)
+
+        # The job exists before the task can be picked up, so the worker's updates always land on it
+        await self._jobs.create(job_id, "queued", **job_fields)
+        pipe = self._redis.pipeline(transaction=False)
+        self._queue.push(pipe, wire.pack(payload))
+        await pipe.execute()
+        logger.info("Job submitted", request_id=request_id, job_id=job_id, task=task_prompt)
+        return job_id
+
+    async def run_many(self, task_prompt, images, text_input=None, use_cache=True, profile=None, max_in_flight=None):
+        """
+        Runs one task on many images and yields (index, result or HTTPException) in completion order.
+        Up to max_in_flight images are queued at a time, each refill in a single pipelined write, so
+        the worker's batcher sees them together. Cached results are yielded first; no coalescing.
+        """
+        profile = self.config.resolve_profile(task_prompt, profile)
+        max_in_flight = max(1, max_in_flight or BATCH_MAX_IN_FLIGHT)
+        self._ensure_listener()
+        request_id = structlog.contextvars.get_contextvars().get("request_id") or uuid.uuid4().hex
+
+        keys = [None] * len(images)
+        waiting = []
+        for index, image_data in enumerate(images):
+            if RESULT_CACHE_ENABLED:
+                keys[index] = self._request_key(image_data, task_prompt, text_input, profile)
+            cached = await self._cache_get(keys[index]) if use_cache else None
+            if cached is not None:
+                yield index, cached
+            else:
+                waiting.append(index)
+        logger.info("Batch request", request_id=request_id, items=len(images), cached=len(images) - len(waiting))
+
+        # future -> (index, task_id, scale, shm_path, deadline)
+        in_flight = {}
+        try:
+            while waiting or in_flight:
+                # 1. Top the window up in one round trip
+                if waiting and len(in_flight) < max_in_flight:
+                    refill, waiting = waiting[:max_in_flight - len(in_flight)], waiting[max_in_flight - len(in_flight):]
+                    prepared = await asyncio.gather(*(asyncio.to_thread(ingest.prepare_image, images[i]) for i in refill))
+                    pipe = self._redis.pipeline(transaction=False)
+                    now = time.time()
+                    for index, (queued_image, scale) in zip(refill, prepared):
+                        task_id = uuid.uuid4().hex
+                        future = asyncio.get_running_loop().create_future()
+                        self._pending[task_id] = future
+                        payload = {
+                            "request_id": request_id,
+                            "task_id": task_id,
+                            "reply_to": self._reply_key,
+                            "deadline": now + MODEL_TIMEOUT,
+                            "enqueued_at": now,
+                            "task": task_prompt,
+                            "text_input": text_input,
+                            "profile": profile,
+                        }
+                        shm_path = wire.attach_image(payload, queued_image, task_id)
+                        self._queue.push(pipe, wire.pack(payload))
+                        in_flight[future] = (index, task_id, scale, shm_path, now + MODEL_TIMEOUT)
+                    await pipe.execute()
+
+                # 2. Hand out whatever finished, fail whatever ran past its deadline
+                timeout = max(0.0, min(deadline for *_, deadline in in_flight.values()) - time.time())
+                done, _ = await asyncio.wait(in_flight, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                now = time.time()
+                for future in [f for f in in_flight if f in done or in_flight[f][4] <= now]:
+                    index, task_id, scale, shm_path, _ = in_flight.pop(future)
+                    self._pending.pop(task_id, None)
+                    wire.release_image(shm_path)
+
+                    if not future.done():
+                        future.cancel()
+                        logger.error("Worker response timeout", request_id=request_id, task_id=task_id)
+                        yield index, HTTPException(status_code=504, detail="Model worker timeout. The queue might be too long.")
+                        continue
+
+                    reply = future.result()
+                    if "error" in reply:
+                        yield index, HTTPException(status_code=500, detail=reply["error"])
+                        continue
+                    result = ingest.rescale_result(reply["result"], scale)
+                    await self._cache_set(keys[index], result)
+                    yield index, result
+        finally:
+            # The client went away mid-stream: stop waiting, the worker drops the rest at their deadline
+            for future, (_, task_id, _, shm_path, _) in in_flight.items():
+                self._pending.pop(task_id, None)
+                future.cancel()
+                wire.release_image(shm_path)
+
+    async def stream_example(self, task_prompt, text_input=None, image_data=None, use_cache=True, profile=None):
+        """
+        run_example() that also reports progress: yields ("partial", text generated so far) while
+        the worker decodes, then ("result", parsed result). A partial replaces the previous one,
+        with beam search the text may be revised. A cached result is yielded right away.
+        """
+        if image_data is None:
+            raise ValueError("image_data is mandatory for inference")
 
-        # 2. Push to the general outbox
-        r.lpush("florence_tasks", json.dumps(payload))
+        profile = self.config.resolve_profile(task_prompt, profile)
+        self._ensure_listener()
 
-        # 3. Blocking Wait on the private mailbox (request_id)
-        # Timeout is 30 seconds
-        res = r.brpop(request_id, timeout=MODEL_TIMEOUT)
+        request_key = self._request_key(image_data, task_prompt, text_input, profile) if RESULT_CACHE_ENABLED else None
+        if use_cache:
+            cached = await self._cache_get(request_key)
+            if cached is not None:
+                logger.info("Result cache hit", task=task_prompt, cache_key=request_key)
+                yield "result", cached
+                return
 
-        if not res:
-            logger.error(f"Worker response timeout request_id {request_id}")
+        queued_image, scale = await asyncio.to_thread(ingest.prepare_image, image_data)
+        # The stream is registered before the task exists, so the first partial cannot be missed.
+        # No coalescing: partials only go to the request that queued the task.
+        task_id = uuid.uuid4().hex
+        partials = asyncio.Queue()
+        self._streams[task_id] = partials
+        dispatch = asyncio.create_task(self._dispatch(
+            {"task": task_prompt, "text_input": text_input, "profile": profile, "stream": True},
+            queued_image,
+            task_id=task_id
+        ))
+        try:
+            while True:
+                next_partial = asyncio.ensure_future(partials.get())
+                await asyncio.wait({next_partial, dispatch}, return_when=asyncio.FIRST_COMPLETED)
+                if not next_partial.done():
+                    next_partial.cancel()
+                    break
+                yield "partial", next_partial.result()
+
+            # Raises the HTTPException of a failed or timed out task
+            result = ingest.rescale_result(dispatch.result(), scale)
+        finally:
+            self._streams.pop(task_id, None)
+            dispatch.cancel()
+
+        await self._cache_set(request_key, result)
+        yield "result", result
+
+    def _request_key(self, image_data, task_prompt, text_input, profile):
+        """Keys the result cache and, derived from it, request coalescing. The workers share this process's ModelConfig."""
+        return make_cache_key(image_data, task_prompt, text_input,
+                              self.config.MODEL_ID, self.config.generation_kwargs(profile),
+                              self.config.CPU_PRECISION.lower(), self.config.INFERENCE_BACKEND.lower())
+
+    async def _cache_get(self, key):
+        """Cache lookups never fail a request, a broken cache is just a miss."""
+        if not (RESULT_CACHE_ENABLED and key):
+            return None
+        try:
+            return await self._cache.get(key)
+        except Exception as e:
+            logger.warning("Result cache lookup failed", error=str(e))
+            return None
+
+    async def _cache_set(self, key, result):
+        if not (RESULT_CACHE_ENABLED and key):
+            return
+        try:
+            await self._cache.set(key, result)
+        except Exception as e:
+            logger.warning("Result cache store failed", error=str(e))
+
+    async def _join_flight(self, coalesce_key, task_id):
+        """Returns True if this request leads the flight and has to enqueue the task itself."""
+        is_leader = await self._join_flight_script(
+            keys=flight_keys(coalesce_key),
+            args=[waiter_address(task_id, self._reply_key), MODEL_TIMEOUT * 1000]
+        )
+        return bool(is_leader)
+
+    async def _abandon_flight(self, coalesce_key, request_id, error):
+        """Ends a flight whose leader failed to enqueue its task and sends every waiter an error reply."""
+        try:
+            waiters = await self._finish_flight_script(keys=flight_keys(coalesce_key))
+            if not waiters:
+                return
+            pipe = self._redis.pipeline(transaction=False)
+            reply_keys = set()
+            for address in waiters:
+                task_id, reply_to = parse_waiter_address(address)
+                pipe.lpush(reply_to, wire.pack({"error": f"Coalesced request failed: {error}", "task_id": task_id}))
+                reply_keys.add(reply_to)
+            for reply_to in reply_keys:
+                pipe.expire(reply_to, 60)
+            await pipe.execute()
+            logger.warning("Failed coalesced waiters of an unqueued task", request_id=request_id, waiters=len(waiters))
+        except Exception as e:
+            # The flight key still expires after MODEL_TIMEOUT, the waiters just wait it out
+            logger.error("Could not release single-flight", request_id=request_id, error=str(e))
+
+    async def _dispatch(self, body, image_data, coalesce_key=None, task_id=None):
+        """
+        Enqueues one worker task (body holds the task fields) and awaits its reply.
+        With a coalesce_key, an identical task already in flight is joined instead of enqueued again.
+        task_id is generated unless the caller needs to know it up front.
+        """
+        # Get existing request_id from context or create one
+        request_id = structlog.contextvars.get_contextvars().get("request_id") or uuid.uuid4().hex
+        # task_id is what the reply is routed by; request_id is only for tracing and may repeat
+        task_id = task_id or uuid.uuid4().hex
+
+        # 1. Register the waiter before anything is pushed so a fast reply can never be missed
+        future = asyncio.get_running_loop().create_future()
+        self._pending[task_id] = future
+        shm_path = None
+
+        try:
+            # Rejects with Retry-After when the queue is full or the wait would outlast MODEL_TIMEOUT
+            await self._admission.admit(MODEL_TIMEOUT)
+            if coalesce_key and not await self._join_flight(coalesce_key, task_id):
+                logger.info("Coalesced with identical in-flight request", request_id=request_id, task_id=task_id)
+            else:
+                logger.info("Dispatching task to worker", request_id=request_id, task_id=task_id)
+
+                # 2. Package the task
+                payload = {
+                    "request_id": request_id,
+                    "task_id": task_id,
+                    "reply_to": self._reply_key,
+                    # Absolute deadline, so the worker can skip work nobody is waiting for anymore
+                    "deadline": time.time() + MODEL_TIMEOUT,
+                    # Lets the worker measure latency including the queue wait
+                    "enqueued_at": time.time(),
+                    **body,
+                }
+                if coalesce_key:
+                    payload["coalesce_key"] = coalesce_key
+                try:
+                    shm_path = wire.attach_image(payload, image_data, task_id)
+
+                    # 3. Push to the general outbox
+                    pipe = self._redis.pipeline(transaction=False)
+                    self._queue.push(pipe, wire.pack(payload))
+                    await pipe.execute()
+                except Exception as e:
+                    # No worker will ever finish this flight, so the requests that joined it are failed here
+                    if coalesce_key:
+                        await self._abandon_flight(coalesce_key, request_id, e)
+                    raise
+
+            # 4. Wait for the listener to hand us our reply
+            reply = await asyncio.wait_for(future, timeout=MODEL_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.error("Worker response timeout", request_id=request_id, task_id=task_id)
             raise HTTPException(status_code=504, detail="Model worker timeout. The queue might be too long.")
+        finally:
+            self._pending.pop(task_id, None)
+            wire.release_image(shm_path)
+
+        if "error" in reply:
+            logger.error("Worker reported inference failure", request_id=request_id, error=reply["error"])
+            raise HTTPException(status_code=500, detail=reply["error"])
 
-        # res is a tuple: (key_name, value)
-        _, result_json = res
-        return json.loads(result_json)
\ No newline at end of file
+        return reply["result"]
@@ -0,0 +1,216 @@
+import io
+import os
+import random
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+from app.logging_config import get_logger
+from app.constants import (
+    CAPTION_TO_PHRASE_GROUNDING,
+    REFERRING_EXPRESSION_SEGMENTATION,
+    OPEN_VOCABULARY_DETECTION,
+    OD,
+    DENSE_REGION_CAPTION,
+    REGION_PROPOSAL,
+    REGION_TO_SEGMENTATION,
+    OCR_WITH_REGION
+)
+
+logger = get_logger(__name__)
+
+# Rendering is CPU work, it runs in a pool so it never blocks the event loop.
+# "thread" suits most deployments (Pillow releases the GIL while drawing and encoding);
+# "process" isolates it completely at the cost of pickling the image bytes across.
+RENDER_POOL = os.environ.get("RENDER_POOL", "thread").lower()
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS", "4"))
+# Opacity of segmentation masks. 1 is the solid red fill the visualizations always had;
+# lower values blend the mask with the image so the segmented object stays visible.
+RENDER_MASK_OPACITY = float(os.environ.get("RENDER_MASK_OPACITY", "1"))
+
+DETECTION_TASKS = (OD, DENSE_REGION_CAPTION, REGION_PROPOSAL, CAPTION_TO_PHRASE_GROUNDING, OPEN_VOCABULARY_DETECTION)
+SEGMENTATION_TASKS = (REFERRING_EXPRESSION_SEGMENTATION, REGION_TO_SEGMENTATION)
+OCR_TASKS = (OCR_WITH_REGION,)
+
+# format name -> (Pillow format, mime type, file extension)
+ENCODINGS = {
+    "png": ("PNG", "image/png", "png"),
+    "webp": ("WEBP", "image/webp", "webp"),
+    "jpeg": ("JPEG", "image/jpeg", "jpg"),
+}
+DEFAULT_QUALITY = 90
+
+colormap = ['blue', 'orange', 'green', 'purple', 'brown', 'pink', 'gray', 'olive', 'cyan', 'red',
+            'lime', 'indigo', 'violet', 'aqua', 'magenta', 'coral', 'gold', 'tan', 'skyblue']
+
+_executor = None
+
+
+def has_visualization(task_type):
+    """Only detection, segmentation and OCR-with-region results are drawn; everything else is text."""
+    return task_type in DETECTION_TASKS or task_type in SEGMENTATION_TASKS or task_type in OCR_TASKS
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        if RENDER_POOL == "process":
+            _executor = ProcessPoolExecutor(max_workers=RENDER_WORKERS)
+        else:
+            _executor = ThreadPoolExecutor(max_workers=RENDER_WORKERS, thread_name_prefix="render")
+    return _executor
+
+
+def mime_type(image_format):
+    return ENCODINGS[image_format][1]
+
+
+def file_extension(image_format):
+    return ENCODINGS[image_format][2]
+
+
+async def render_encoded_async(task_type, prediction, image_bytes, image_format="png", quality=None):
+    """render_encoded() in the render pool."""
+    return await asyncio.get_running_loop().run_in_executor(
+        _get_executor(), render_encoded, task_type, prediction, image_bytes, image_format, quality
+    )
+
+
+def render_encoded(task_type, prediction, image_bytes, image_format="png", quality=None):
+    """
+    Decodes the image, draws the prediction of task_type over it and returns it encoded as
+    image_format (png, webp or jpeg; quality applies to the lossy two). None for text tasks.
+    """
+    image = render(task_type, prediction, Image.open(io.BytesIO(image_bytes)).convert("RGB"))
+    if image is None:
+        return None
+    return encode(image, image_format, quality)
+
+
+def encode(image, image_format="png", quality=None):
+    pil_format = ENCODINGS[image_format][0]
+    buf = io.BytesIO()
+    if pil_format == "PNG":
+        image.save(buf, format=pil_format)
+    else:
+        image.save(buf, format=pil_format, quality=quality or DEFAULT_QUALITY)
+    return buf.getvalue()
+
+
+def render(task_type, prediction, image):
+    """Returns a copy of the RGB image with the prediction drawn on it, or None for text tasks."""
+    if task_type in DETECTION_TASKS:
+        return draw_bboxes(image.copy(), prediction)
+    if task_type in SEGMENTATION_TASKS:
+        return draw_masks(image.copy(), prediction)
+    if task_type in OCR_TASKS:
+        return draw_quads(image.copy(), prediction)
+    return None
+
+
+def _font(size, names=("arial.ttf",), scale_default=True):
+    for name in names:
+        try:
+            return ImageFont.truetype(name, size)
+        except IOError:
+            pass
+    if not scale_default:
+        return ImageFont.load_default()
+    try:
+        # Pillow >= 10.1 scales its built-in font
+        return ImageFont.load_default(size)
+    except TypeError:
+        return ImageFont.load_default()
+
+
+# The matplotlib figure boxes used to be drawn on: 6.4x4.8 in at 150 dpi, the image filling about
+# 95% of it. Sizes that were given in points there are converted to pixels of the original image,
+# so lines and labels keep the proportions they had while the image keeps its own resolution.
+LEGACY_FIGURE_PX = (6.4 * 150 * 0.95, 4.8 * 150 * 0.95)
+
+
+def _points_to_px(image, points):
+    scale = min(LEGACY_FIGURE_PX[0] / image.width, LEGACY_FIGURE_PX[1] / image.height)
+    return points * 150 / 72 / scale
+
+
+def draw_bboxes(image, data):
+    """
+    Red 2pt boxes with the label in white 10pt DejaVu Sans on a red tag (80% opacity, thin dark
+    border) whose baseline sits 5px above the top left corner, as the matplotlib plot drew them.
+    """
+    bboxes = data.get('bboxes', [])
+    labels = data.get('labels') or data.get('bboxes_labels') or []
+    # Unlabelled boxes still get a tag
+    if not labels and bboxes:
+        labels = [f"obj_{i}" for i in range(len(bboxes))]
+
+    draw = ImageDraw.Draw(image, "RGBA")
+    # matplotlib's default font, if it is installed
+    font = _font(max(8, round(_points_to_px(image, 10))), ("DejaVuSans.ttf", "arial.ttf"))
+    line_width = max(1, round(_points_to_px(image, 2)))
+    pad = _points_to_px(image, 4)
+    for bbox, label in zip(bboxes, labels):
+        x1, y1, x2, y2 = bbox
+        draw.rectangle((x1, y1, x2, y2), outline=(255, 0, 0), width=line_width)
+        left, top, right, bottom = draw.textbbox((x1, y1 - 5), str(label), font=font, anchor="ls")
+        draw.rectangle((left - pad, top - pad, right + pad, bottom + pad),
+                       fill=(255, 0, 0, 204), outline=(0, 0, 0, 204), width=max(1, round(line_width / 2)))
+        draw.text((x1, y1 - 5), str(label), fill=(255, 255, 255), font=font, anchor="ls")
+    return image
+
+
+def draw_masks(image, prediction, opacity=None):
+    """
+    The first polygon of the first instance, filled in red with a 1px red outline, and
+    "Segmentation applied" in the top left corner. opacity (default RENDER_MASK_OPACITY) below 1
+    blends the fill with the image instead of covering it.
+    """
+    opacity = RENDER_MASK_OPACITY if opacity is None else opacity
+    polygons = prediction.get('polygons', [])
+    width, height = image.size
+
+    # Segmentation results are [instance][polygon][x, y, ...], some tasks drop the instance level
+    if polygons and isinstance(polygons[0], list) and polygons[0] and isinstance(polygons[0][0], list):
+        polygons = polygons[0]
+    if not polygons:
+        logger.warning("No polygons found in prediction data")
+        return image
+
+    points = np.asarray(polygons[0], dtype=np.float64)
+    points = points[:len(points) // 2 * 2].reshape(-1, 2).astype(int)
+    points[:, 0] = points[:, 0].clip(0, width - 1)
+    points[:, 1] = points[:, 1].clip(0, height - 1)
+    points = [tuple(p) for p in points.tolist()]
+
+    if len(points) > 2:
+        if opacity >= 1:
+            draw = ImageDraw.Draw(image)
+            draw.polygon(points, fill=(255, 0, 0))
+            # Separately, Pillow skips the outline when it has the fill's colour
+            draw.polygon(points, outline=(255, 0, 0))
+        else:
+            mask_image = Image.new("L", image.size, 0)
+            ImageDraw.Draw(mask_image).polygon(points, fill=255)
+            # Blended in a single vectorized pass
+            pixels = np.asarray(image, dtype=np.float32)
+            mask = np.asarray(mask_image) > 0
+            red = np.array([255, 0, 0], dtype=np.float32)
+            pixels[mask] = pixels[mask] * (1 - opacity) + red * opacity
+            image = Image.fromarray(pixels.round().astype(np.uint8))
+            ImageDraw.Draw(image).polygon(points, outline=(255, 0, 0))
+
+    ImageDraw.Draw(image).text((10, 10), "Segmentation applied", fill=(255, 0, 0))
+    return image
+
+
+def draw_quads(image, prediction):
+    """OCR regions outlined in a colour picked at random per region, with the first 10 characters of their text above."""
+    draw = ImageDraw.Draw(image)
+    font = _font(15, scale_default=False)
+    for box, label in zip(prediction.get('quad_boxes', []), prediction.get('labels', [])):
+        color = random.choice(colormap)
+        points = np.array(box).reshape(-1, 2)
+        draw.polygon(points.flatten().tolist(), outline=color, width=2)
+        draw.text((points[0][0], points[0][1] - 20), f"{label[:10]}", fill=color, font=font)
+    return image
@@ -0,0 +1,104 @@
+import os
+import time
+import json
+import hashlib
+from app import wire
+from app.logging_config import get_logger
+
+logger = get_logger(__name__)
+
+RESULT_CACHE_ENABLED = os.environ.get("RESULT_CACHE_ENABLED", "true").lower() == "true"
+RESULT_CACHE_TTL = int(os.environ.get("RESULT_CACHE_TTL", "3600"))
+# LRU bound on top of the TTL, so a burst of unique images cannot crowd the task queue out of Redis
+RESULT_CACHE_MAX_ENTRIES = int(os.environ.get("RESULT_CACHE_MAX_ENTRIES", "5000"))
+# Very large results (dense OCR on posters) are not worth the memory
+RESULT_CACHE_MAX_ITEM_BYTES = int(os.environ.get("RESULT_CACHE_MAX_ITEM_BYTES", "262144"))
+
+CACHE_KEY_PREFIX = "florence_cache"
+LRU_INDEX_KEY = f"{CACHE_KEY_PREFIX}:lru"
+STATS_KEY = f"{CACHE_KEY_PREFIX}:stats"
+
+
+def make_cache_key(image_data, task, text_input, model_id, generation, precision="fp32", backend="torch"):
+    """
+    Content address of an inference: the image bytes plus everything that influences the output.
+    Two requests with the same key produce the same result, because decoding does not sample.
+    The numerics (CPU precision, inference backend) are part of it, an int8 answer is not an fp32 one.
+    """
+    digest = hashlib.sha256(image_data)
+    digest.update(json.dumps({
+        "task": task,
+        "text_input": text_input,
+        "model_id": model_id,
+        "generation": generation,
+        "precision": precision,
+        "backend": backend,
+    }, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Redis backed cache of parsed inference results, shared by every API worker.
+    Entries expire after RESULT_CACHE_TTL and the least recently used ones are evicted
+    once there are more than RESULT_CACHE_MAX_ENTRIES.
+    """
+    def __init__(self, client):
+        self.client = client
+
+    @staticmethod
+    def _entry_key(key):
+        return f"{CACHE_KEY_PREFIX}:entry:{key}"
+
+    async def get(self, key):
+        pipe = self.client.pipeline(transaction=False)
+        pipe.get(self._entry_key(key))
+        # Touch the LRU index only if the key is still indexed
+        pipe.zadd(LRU_INDEX_KEY, {key: time.time()}, xx=True)
+        raw, _ = await pipe.execute()
+
+        await self.client.hincrby(STATS_KEY, "hits" if raw else "misses", 1)
+        if not raw:
+            return None
+        return wire.unpack(raw)
+
+    async def set(self, key, result):
+        packed = wire.pack(result)
+        if len(packed) > RESULT_CACHE_MAX_ITEM_BYTES:
+            logger.debug("Result too large to cache", size_bytes=len(packed))
+            return
+
+        now = time.time()
+        pipe = self.client.pipeline(transaction=False)
+        pipe.set(self._entry_key(key), packed, ex=RESULT_CACHE_TTL)
+        pipe.zadd(LRU_INDEX_KEY, {key: now})
+        # Forget index entries whose value already expired
+        pipe.zremrangebyscore(LRU_INDEX_KEY, "-inf", now - RESULT_CACHE_TTL)
+        pipe.zcard(LRU_INDEX_KEY)
+        *_, size = await pipe.execute()
+
+        overflow = size - RESULT_CACHE_MAX_ENTRIES
+        if overflow > 0:
+            evicted = await self.client.zpopmin(LRU_INDEX_KEY, overflow)
+            if evicted:
+                await self.client.delete(*[self._entry_key(k.decode()) for k, _ in evicted])
+                logger.debug("Evicted least recently used results", count=len(evicted))
+
+    async def stats(self):
+        pipe = self.client.pipeline(transaction=False)
+        pipe.hgetall(STATS_KEY)
+        pipe.zcard(LRU_INDEX_KEY)
+        counters, entries = await pipe.execute()
+
+        hits = int(counters.get(b"hits", 0))
+        misses = int(counters.get(b"misses", 0))
+        lookups = hits + misses
+        return {
+            "enabled": RESULT_CACHE_ENABLED,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            "entries": entries,
+            "max_entries": RESULT_CACHE_MAX_ENTRIES,
+            "ttl_seconds": RESULT_CACHE_TTL,
+        }
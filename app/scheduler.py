@@ -0,0 +1,378 @@
+import os
+import time
+import torch
+from PIL import Image
+from app.model import is_expired
+from app.logging_config import get_logger
+
+logger = get_logger(__name__)
+
+# Decode rows the scheduler keeps in flight. A beam search request takes one row per beam.
+MAX_ACTIVE_ROWS = int(os.environ.get("MAX_ACTIVE_ROWS", str(int(os.environ.get("API_WORKER_COUNT", "4")) * 3)))
+# Where rows and length sit in a key/value cache tensor, in every backend's layout (see app.backends)
+ROW_DIM = -4
+LENGTH_DIM = -2
+
+
+class DecodeRequest:
+    """
+    One sequence for the scheduler to generate. handle is opaque to the scheduler and is
+    handed back with the finished tokens, so the caller can route the result.
+    stream asks for the tokens generated so far after every step, see streaming().
+    """
+    def __init__(self, handle, prompt, num_beams=1, max_new_tokens=1024, deadline=None, stream=False):
+        self.handle = handle
+        self.prompt = prompt
+        self.num_beams = max(1, int(num_beams))
+        self.max_new_tokens = int(max_new_tokens)
+        self.deadline = deadline
+        self.stream = stream
+
+
+class _Sequence:
+    """
+    Decoding state of one admitted request: its beams' tokens and scores and, for beam search,
+    the finished hypotheses. Follows generate()'s rules (forced BOS/EOS, no-repeat n-grams,
+    length penalty and early stopping) so results match what generate() would return.
+    """
+    def __init__(self, request, rules):
+        self.request = request
+        self.rules = rules
+        start = rules["decoder_start_token_id"]
+        self.beams = [[start] for _ in range(request.num_beams)]
+        # Only the first beam is live at the first step, otherwise all beams would pick the same tokens
+        self.beam_scores = [0.0] + [-1e9] * (request.num_beams - 1)
+        self.hypotheses = []  # (score, tokens), best first
+        self.generated = 0
+        self.done = False
+
+    @property
+    def width(self):
+        return self.request.num_beams
+
+    def last_tokens(self):
+        return [beam[-1] for beam in self.beams]
+
+    def position(self):
+        # Every beam has the same length, the decoder start token sits at position 0
+        return len(self.beams[0]) - 1
+
+    def result(self):
+        if self.width == 1:
+            return self.beams[0]
+        return self.hypotheses[0][1]
+
+    def partial(self):
+        """The best running beam. With beam search it can still change, not just grow."""
+        return list(self.beams[0])
+
+    def advance(self, logprobs):
+        """
+        Picks the next token of every beam from this step's log-probabilities (width, vocab).
+        Returns the parent beam of each new beam, so the caller can reorder the self-attention cache.
+        """
+        self._apply_rules(logprobs)
+        self.generated += 1
+
+        if self.width == 1:
+            token = int(logprobs[0].argmax())
+            self.beams[0].append(token)
+            if token == self.rules["eos_token_id"] or self.generated >= self.request.max_new_tokens:
+                self.done = True
+            return [0]
+
+        return self._advance_beams(logprobs)
+
+    def _apply_rules(self, logprobs):
+        n = self.rules["no_repeat_ngram_size"]
+        if n and len(self.beams[0]) >= n:
+            for b, beam in enumerate(self.beams):
+                banned = self._banned_tokens(beam, n)
+                if banned:
+                    logprobs[b, banned] = float("-inf")
+
+        forced = None
+        if self.generated == 0:
+            forced = self.rules["forced_bos_token_id"]
+        elif self.generated == self.request.max_new_tokens - 1:
+            forced = self.rules["forced_eos_token_id"]
+        if forced is not None:
+            logprobs[:] = float("-inf")
+            logprobs[:, forced] = 0.0
+
+    @staticmethod
+    def _banned_tokens(tokens, n):
+        """Tokens that would repeat an n-gram already present in tokens."""
+        prefix = tokens[len(tokens) - n + 1:]
+        return list({
+            tokens[i + n - 1]
+            for i in range(len(tokens) - n + 1)
+            if tokens[i:i + n - 1] == prefix
+        })
+
+    def _advance_beams(self, logprobs):
+        width, vocab = logprobs.shape
+        eos = self.rules["eos_token_id"]
+
+        scores = logprobs + torch.tensor(self.beam_scores, dtype=logprobs.dtype, device=logprobs.device)[:, None]
+        # 2 * width candidates always leave width of them that are not EOS
+        top_scores, top_ids = scores.view(-1).topk(2 * width)
+
+        beams, beam_scores, parents = [], [], []
+        for rank, (score, idx) in enumerate(zip(top_scores.tolist(), top_ids.tolist())):
+            parent, token = divmod(idx, vocab)
+            if token == eos:
+                # An EOS outside the top width candidates would not have been a beam either
+                if rank < width:
+                    self._add_hypothesis(self.beams[parent] + [token], score)
+            else:
+                beams.append(self.beams[parent] + [token])
+                beam_scores.append(score)
+                parents.append(parent)
+            if len(beams) == width:
+                break
+
+        self.beams, self.beam_scores = beams, beam_scores
+
+        if self.generated >= self.request.max_new_tokens:
+            # Out of budget, the running beams compete with the finished ones
+            for beam, score in zip(self.beams, self.beam_scores):
+                self._add_hypothesis(beam, score)
+            self.done = True
+        # Like generate(), the best candidate of the step bounds what is attainable, even when it was an EOS
+        elif self._beam_search_done(top_scores[0].item()):
+            self.done = True
+        return parents
+
+    def _add_hypothesis(self, tokens, sum_logprobs):
+        score = sum_logprobs / (self.generated ** self.rules["length_penalty"])
+        self.hypotheses.append((score, tokens))
+        self.hypotheses.sort(key=lambda h: h[0], reverse=True)
+        del self.hypotheses[self.width:]
+
+    def _beam_search_done(self, best_score):
+        if len(self.hypotheses) < self.width:
+            return False
+        if self.rules["early_stopping"] is True:
+            return True
+        # No running beam can still beat the worst kept hypothesis
+        best_attainable = best_score / (self.generated ** self.rules["length_penalty"])
+        return self.hypotheses[-1][0] >= best_attainable
+
+
+class ContinuousBatchScheduler:
+    """
+    Iteration-level batching for the Florence-2 encoder-decoder.
+
+    Instead of one generate() call that owns its batch until the longest sequence is done,
+    the scheduler keeps a pool of decode rows and runs one token step for all of them at a time.
+    New requests are prefilled and join at the next step boundary, and a sequence leaves the
+    pool (freeing its rows) the step it finishes or its deadline passes.
+
+    Rows live in one set of padded tensors: the self-attention cache is left padded (a row that
+    joined late has empty columns before its first token) and the cross-attention cache is right
+    padded to the longest encoder output. Masks hide the padding from attention.
+
+    The forward passes go through an InferenceBackend (app.backends), model.backend unless given.
+    The caches keep the backend's layout, they are only indexed along ROW_DIM and LENGTH_DIM.
+    """
+    def __init__(self, model, max_rows=MAX_ACTIVE_ROWS, backend=None):
+        self.model = model
+        self.backend = backend or model.backend
+        self.max_rows = max_rows
+        self.rules = model.generation_defaults()
+        self.sequences = []  # in row order
+        self._reset_cache()
+
+    def _reset_cache(self):
+        self.self_kv = None      # [(k, v)], rows x decoded_len in the backend's layout
+        self.self_valid = None   # (rows, decoded_len) bool
+        self.cross_kv = None     # [(k, v)], rows x src_len in the backend's layout
+        self.cross_valid = None  # (rows, src_len) bool
+
+    def __len__(self):
+        return len(self.sequences)
+
+    @property
+    def rows(self):
+        return sum(seq.width for seq in self.sequences)
+
+    @property
+    def free_rows(self):
+        return max(0, self.max_rows - self.rows)
+
+    def warmup(self):
+        """Runs a couple of short dummy requests through prefill and the step loop."""
+        logger.info("🔥 Warming up the decode pool...")
+        self.admit([(self.model.pixel_values([Image.new('RGB', (224, 224))]), [
+            DecodeRequest(None, "<OD>", num_beams=1, max_new_tokens=8),
+            DecodeRequest(None, "<OD>", num_beams=2, max_new_tokens=8),
+        ])])
+        while self.sequences:
+            self.step()
+        logger.info("✅ Warmup complete.")
+
+    def abort(self):
+        """Empties the pool, e.g. after a failed step. Returns the requests that were in it."""
+        requests = [seq.request for seq in self.sequences]
+        self.sequences = []
+        self._reset_cache()
+        return requests
+
+    def admit(self, groups):
+        """
+        Prefills new requests into the pool, they take part from the next step on.
+        groups is a list of (pixel_values, [DecodeRequest, ...]), pixel_values being one image from
+        model.pixel_values(). The requests of a group share the image, which goes through the
+        vision encoder once.
+        """
+        requests = [req for _, reqs in groups for req in reqs]
+        if not requests:
+            return
+
+        start_time = time.time()
+        with torch.no_grad():
+            # 1. Vision encoder, once per image
+            image_features = self.backend.encode_image(torch.cat([pixel_values for pixel_values, _ in groups]))
+            feature_rows = [g for g, (_, reqs) in enumerate(groups) for _ in reqs]
+
+            # 2. Language encoder and cross-attention projections, once per request
+            input_ids, attention_mask = self.model.tokenize([req.prompt for req in requests])
+            cross_kv, cross_valid = self.backend.prefill(image_features[feature_rows], input_ids, attention_mask)
+
+        # 3. Every beam of a request attends to the same encoder output
+        beam_rows = torch.tensor([i for i, req in enumerate(requests) for _ in range(req.num_beams)],
+                                 device=cross_valid.device)
+        cross_kv = [(k.index_select(ROW_DIM, beam_rows), v.index_select(ROW_DIM, beam_rows)) for k, v in cross_kv]
+        cross_valid = cross_valid[beam_rows]
+        self._append_rows(cross_kv, cross_valid)
+
+        self.sequences.extend(_Sequence(req, self.rules) for req in requests)
+        logger.debug("Admitted into decode pool",
+                     requests=len(requests),
+                     images=len(groups),
+                     active_rows=self.rows,
+                     prefill_ms=round((time.time() - start_time) * 1000))
+
+    def _append_rows(self, cross_kv, cross_valid):
+        new_rows, src_len = cross_valid.shape
+        device = cross_valid.device
+
+        if self.cross_valid is None:
+            self.cross_kv, self.cross_valid = cross_kv, cross_valid
+            # Nothing decoded yet: the cross cache's shape with an empty length
+            self.self_kv = [(self._resized(k, LENGTH_DIM, 0), self._resized(v, LENGTH_DIM, 0)) for k, v in cross_kv]
+            self.self_valid = torch.zeros((new_rows, 0), dtype=torch.bool, device=device)
+            return
+
+        # Right pad whichever side has the shorter encoder output
+        width = max(src_len, self.cross_valid.shape[1])
+        self.cross_kv = [
+            (torch.cat([self._pad_to(old_k, width), self._pad_to(new_k, width)], dim=ROW_DIM),
+             torch.cat([self._pad_to(old_v, width), self._pad_to(new_v, width)], dim=ROW_DIM))
+            for (old_k, old_v), (new_k, new_v) in zip(self.cross_kv, cross_kv)
+        ]
+        self.cross_valid = torch.cat([
+            torch.nn.functional.pad(self.cross_valid, (0, width - self.cross_valid.shape[1])),
+            torch.nn.functional.pad(cross_valid, (0, width - src_len)),
+        ])
+
+        # New rows have decoded nothing yet, their self-attention history is all padding
+        decoded_len = self.self_valid.shape[1]
+        self.self_kv = [
+            (torch.cat([k, self._resized(k, ROW_DIM, new_rows)], dim=ROW_DIM),
+             torch.cat([v, self._resized(v, ROW_DIM, new_rows)], dim=ROW_DIM))
+            for k, v in self.self_kv
+        ]
+        self.self_valid = torch.cat([
+            self.self_valid,
+            torch.zeros((new_rows, decoded_len), dtype=torch.bool, device=device)
+        ])
+
+    @staticmethod
+    def _pad_to(states, length):
+        """Right pads LENGTH_DIM (the second to last) with zeros."""
+        return torch.nn.functional.pad(states, (0, 0, 0, length - states.shape[LENGTH_DIM]))
+
+    @staticmethod
+    def _resized(states, dim, size):
+        """Zeros shaped like states, except size along dim."""
+        shape = list(states.shape)
+        shape[dim] = size
+        return states.new_zeros(shape)
+
+    def step(self):
+        """
+        Runs one decode step for every active row.
+        Returns (request, token_ids) for each sequence that left the pool; token_ids is None
+        when the request's deadline passed before it finished.
+        """
+        finished = []
+
+        # 1. Expired requests leave before paying for another step
+        now = time.time()
+        expired = [seq for seq in self.sequences if is_expired(seq.request.deadline, now)]
+        if expired:
+            finished.extend((seq.request, None) for seq in expired)
+            self._retire(expired)
+        if not self.sequences:
+            return finished
+
+        # 2. One token for every row
+        device = self.self_valid.device
+        tokens = torch.tensor([t for seq in self.sequences for t in seq.last_tokens()], device=device)
+        positions = torch.tensor([seq.position() for seq in self.sequences for _ in range(seq.width)], device=device)
+        self_valid = torch.cat([self.self_valid, torch.ones((len(tokens), 1), dtype=torch.bool, device=device)], dim=1)
+
+        logits, self.self_kv = self.backend.decode_step(tokens, positions, self.self_kv, self_valid,
+                                                      self.cross_kv, self.cross_valid)
+        self.self_valid = self_valid
+        logprobs = torch.log_softmax(logits.float(), dim=-1)
+
+        # 3. Token selection per sequence; beam search may reorder rows within its sequence
+        order, row = [], 0
+        for seq in self.sequences:
+            parents = seq.advance(logprobs[row:row + seq.width])
+            order.extend(row + p for p in parents)
+            row += seq.width
+        if order != list(range(row)):
+            order = torch.tensor(order, device=device)
+            self.self_kv = [(k.index_select(ROW_DIM, order), v.index_select(ROW_DIM, order)) for k, v in self.self_kv]
+
+        # 4. Finished sequences free their rows right away
+        done = [seq for seq in self.sequences if seq.done]
+        if done:
+            finished.extend((seq.request, seq.result()) for seq in done)
+            self._retire(done)
+        return finished
+
+    def streaming(self):
+        """(request, tokens so far) of every sequence in the pool that asked to stream."""
+        return [(seq.request, seq.partial()) for seq in self.sequences if seq.request.stream]
+
+    def _retire(self, leaving):
+        leaving = set(map(id, leaving))
+        keep, row = [], 0
+        for seq in self.sequences:
+            if id(seq) not in leaving:
+                keep.extend(range(row, row + seq.width))
+            row += seq.width
+        self.sequences = [seq for seq in self.sequences if id(seq) not in leaving]
+
+        if not self.sequences:
+            self._reset_cache()
+            return
+
+        keep = torch.tensor(keep, device=self.self_valid.device)
+        self_valid = self.self_valid[keep]
+        cross_valid = self.cross_valid[keep]
+
+        # Drop padding columns no remaining row needs
+        first = int(self_valid.any(dim=0).float().argmax()) if self_valid.shape[1] else 0
+        last = int(cross_valid.any(dim=0).nonzero().max()) + 1
+        self.self_valid = self_valid[:, first:]
+        self.cross_valid = cross_valid[:, :last]
+        self.self_kv = [(k.index_select(ROW_DIM, keep)[..., first:, :], v.index_select(ROW_DIM, keep)[..., first:, :])
+                        for k, v in self.self_kv]
+        self.cross_kv = [(k.index_select(ROW_DIM, keep)[..., :last, :], v.index_select(ROW_DIM, keep)[..., :last, :])
+                         for k, v in self.cross_kv]
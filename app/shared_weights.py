@@ -0,0 +1,80 @@
+import os
+import json
+import mmap
+import torch
+from app.logging_config import get_logger
+
+logger = get_logger(__name__)
+
+# Several worker processes on one host each hold the model's weights. Mapping them from one
+# safetensors file instead lets the processes share the same page cache pages, so memory does not
+# grow with every worker. The file has to hold the exact dtype the model runs in, the checkpoint
+# (model.safetensors, kept by download_model.sh) is converted once to model.<dtype>.safetensors.
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64, "F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16,
+    "I64": torch.int64, "I32": torch.int32, "I16": torch.int16, "I8": torch.int8, "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+def mapped_checkpoint_path(model_dir, dtype):
+    return os.path.join(model_dir, f"model.{str(dtype).replace('torch.', '')}.safetensors")
+
+
+def ensure_mapped_checkpoint(model_dir, dtype=torch.float32):
+    """
+    Returns the path of the checkpoint in dtype, writing it from model.safetensors on first use.
+    The file is renamed into place once complete, so concurrent callers never map a partial file.
+    """
+    path = mapped_checkpoint_path(model_dir, dtype)
+    if os.path.exists(path):
+        return path
+
+    from safetensors.torch import load_file, save_file
+
+    source = os.path.join(model_dir, "model.safetensors")
+    logger.info("Writing memory mappable checkpoint", source=source, target=path, dtype=str(dtype))
+    tensors = {
+        name: (tensor.to(dtype) if tensor.is_floating_point() else tensor).contiguous()
+        for name, tensor in load_file(source).items()
+    }
+    tmp = f"{path}.{os.getpid()}.tmp"
+    save_file(tensors, tmp, metadata={"format": "pt"})
+    os.replace(tmp, path)
+    return path
+
+
+def map_weights(module, path):
+    """
+    Replaces module's parameters and buffers with read-only views into the memory mapped file at path.
+    Returns how many tensors were mapped; names the file does not have keep their own memory.
+    """
+    with open(path, "rb") as f:
+        header_len = int.from_bytes(f.read(8), "little")
+        header = json.loads(f.read(header_len))
+        # Private mapping: pages stay shared with every other process mapping the file unless written
+        mapped = mmap.mmap(f.fileno(), 0, flags=mmap.MAP_PRIVATE, prot=mmap.PROT_READ | mmap.PROT_WRITE)
+    data_start = 8 + header_len
+
+    tensors = dict(module.named_parameters())
+    tensors.update(module.named_buffers())
+    count = skipped = 0
+    for name, info in header.items():
+        if name == "__metadata__":
+            continue
+        target = tensors.get(name)
+        dtype = SAFETENSORS_DTYPES.get(info["dtype"])
+        begin, end = info["data_offsets"]
+        if target is None or dtype != target.dtype or list(target.shape) != info["shape"]:
+            skipped += 1
+            continue
+        if end > begin:
+            view = torch.frombuffer(mapped, dtype=dtype, count=(end - begin) // target.element_size(), offset=data_start + begin)
+            # Tied weights share one tensor, mapping it once covers every name
+            target.data = view.view(info["shape"])
+        count += 1
+
+    # Held by the module too, so the mapping lives exactly as long as the model
+    module._mapped_checkpoint = mapped
+    logger.info("Mapped weights from shared checkpoint", path=path, tensors=count, skipped=skipped)
+    return count
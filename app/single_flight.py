@@ -0,0 +1,51 @@
+import os
+from app.logging_config import get_logger
+
+logger = get_logger(__name__)
+
+COALESCE_ENABLED = os.environ.get("COALESCE_ENABLED", "true").lower() == "true"
+INFLIGHT_KEY_PREFIX = "florence_inflight"
+
+# Single-flight across every API process: the first request for a key becomes the leader and
+# enqueues the task; identical requests arriving while it is in flight register as waiters.
+# When the worker finishes the leader's task it fans the reply out to every waiter.
+#
+# Both sides are Lua scripts, so a waiter either registers before the worker collects the
+# waiter set (and gets the reply) or finds the flight gone and goes through the normal path.
+
+# KEYS[1] = flight key, KEYS[2] = waiter set
+# ARGV[1] = waiter address, ARGV[2] = flight ttl (ms)
+# Returns 1 if the caller is the leader, 0 if it joined an existing flight
+JOIN_SCRIPT = """
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    return 1
+end
+redis.call('SADD', KEYS[2], ARGV[1])
+redis.call('PEXPIRE', KEYS[2], ARGV[2])
+return 0
+"""
+
+# KEYS[1] = flight key, KEYS[2] = waiter set
+# Ends the flight and returns the waiter addresses to deliver to
+FINISH_SCRIPT = """
+local waiters = redis.call('SMEMBERS', KEYS[2])
+redis.call('DEL', KEYS[1], KEYS[2])
+return waiters
+"""
+
+
+def flight_keys(coalesce_key):
+    flight = f"{INFLIGHT_KEY_PREFIX}:{coalesce_key}"
+    return [flight, f"{flight}:waiters"]
+
+
+def waiter_address(task_id, reply_to):
+    return f"{task_id}@{reply_to}"
+
+
+def parse_waiter_address(address):
+    """Returns (task_id, reply_to)."""
+    if isinstance(address, bytes):
+        address = address.decode()
+    task_id, reply_to = address.split("@", 1)
+    return task_id, reply_to
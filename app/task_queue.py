@@ -0,0 +1,249 @@
+import os
+import time
+import socket
+import threading
+import redis
+from app.logging_config import get_logger
+
+logger = get_logger(__name__)
+
+# "list" keeps the original LPUSH/BRPOP queue, "stream" uses a Redis Stream with a consumer group
+QUEUE_BACKEND = os.environ.get("QUEUE_BACKEND", "list").lower()
+TASK_LIST_KEY = "florence_tasks"
+TASK_STREAM_KEY = os.environ.get("TASK_STREAM_KEY", "florence_task_stream")
+STREAM_GROUP = os.environ.get("STREAM_GROUP", "florence_workers")
+# An entry that has been delivered but not acked for this long is considered orphaned
+# (its worker crashed or was OOM-killed) and gets claimed by another worker.
+# Below MODEL_TIMEOUT, so an orphaned task is redelivered while its caller still waits.
+STREAM_CLAIM_IDLE_MS = int(os.environ.get("STREAM_CLAIM_IDLE_MS", "15000"))
+STREAM_CLAIM_INTERVAL_S = float(os.environ.get("STREAM_CLAIM_INTERVAL_S", "5"))
+# How often a worker resets the idle time of the entries it still holds (prepared, waiting to be
+# batched or decoding), so live work never looks orphaned. Well below STREAM_CLAIM_IDLE_MS.
+STREAM_REFRESH_INTERVAL_S = float(os.environ.get("STREAM_REFRESH_INTERVAL_S", str(STREAM_CLAIM_IDLE_MS / 3000)))
+# Poison-pill guard: tasks that keep killing workers are dropped after this many deliveries
+STREAM_MAX_DELIVERIES = int(os.environ.get("STREAM_MAX_DELIVERIES", "3"))
+
+
+class ListTaskQueue:
+    """
+    The original queue: producers LPUSH, the worker pops from the right.
+    A popped task only lives in worker memory, so it is lost if the worker dies mid-batch.
+    """
+    def __init__(self, client):
+        self.client = client
+        self.key = TASK_LIST_KEY
+        self._has_blmpop = True
+
+    def push(self, pipe, raw):
+        """Queues the push on a (sync or async) pipeline; the caller executes it."""
+        pipe.lpush(self.key, raw)
+
+    def push_depth(self, pipe):
+        pipe.llen(self.key)
+
+    def setup(self):
+        pass
+
+    def pop(self, count, block_ms=None):
+        """
+        Returns a list of (entry_id, raw) tuples. List entries have no id.
+        With block_ms, waits up to block_ms for the first entry and takes up to count in the same call.
+        """
+        if block_ms:
+            raws = self._blocking_pop(count, max(block_ms / 1000, 0.01))
+        else:
+            raws = self.client.rpop(self.key, count) or []
+        return [(None, raw) for raw in raws]
+
+    def _blocking_pop(self, count, timeout):
+        if self._has_blmpop:
+            try:
+                # BLMPOP: one blocking round trip for a whole batch
+                res = self.client.blmpop(timeout, 1, self.key, direction="RIGHT", count=count)
+                return res[1] if res else []
+            except redis.ResponseError as e:
+                if "unknown command" not in str(e).lower():
+                    raise
+                self._has_blmpop = False
+                logger.warning("Redis has no BLMPOP (added in 7.0), falling back to BRPOP + RPOP")
+
+        res = self.client.brpop(self.key, timeout=timeout)
+        if not res:
+            return []
+        rest = self.client.rpop(self.key, count - 1) if count > 1 else None
+        return [res[1]] + (rest or [])
+
+    def ack(self, entry_ids):
+        pass
+
+    def refresh(self):
+        pass
+
+    def dead_letters(self):
+        return []
+
+    def depth(self):
+        return self.client.llen(self.key)
+
+
+class StreamTaskQueue:
+    """
+    Reliable queue on a Redis Stream consumer group.
+    Entries stay in the group's pending list until the worker acks them after delivery,
+    and entries left pending by a dead worker are claimed by the next worker that polls.
+    Any number of workers on any number of hosts can share one group.
+    """
+    def __init__(self, client, consumer=None):
+        self.client = client
+        self.key = TASK_STREAM_KEY
+        self.group = STREAM_GROUP
+        self.consumer = consumer or os.environ.get("WORKER_CONSUMER_NAME") or f"{socket.gethostname()}-{os.getpid()}"
+        self._claim_cursor = "0-0"
+        self._last_claim = 0.0
+        # Entries delivered to this consumer and not acked yet. pop, ack and refresh run on
+        # different pipeline threads of the worker.
+        self._held = set()
+        self._held_lock = threading.Lock()
+        self._last_refresh = time.time()
+        # (entry_id, raw) of tasks past STREAM_MAX_DELIVERIES, for the worker to fail and ack
+        self._dead = []
+
+    def push(self, pipe, raw):
+        """Queues the XADD on a (sync or async) pipeline; the caller executes it."""
+        pipe.xadd(self.key, {"payload": raw})
+
+    def push_depth(self, pipe):
+        pipe.xlen(self.key)
+
+    def setup(self):
+        """Creates the consumer group (and the stream) if this is the first worker."""
+        try:
+            self.client.xgroup_create(self.key, self.group, id="0", mkstream=True)
+            logger.info("Created stream consumer group", stream=self.key, group=self.group)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def pop(self, count, block_ms=None):
+        """Returns a list of (entry_id, raw) tuples, orphaned entries first."""
+        entries = self._claim_stale(count)
+        if entries:
+            self._hold(entries)
+            return entries
+
+        res = self.client.xreadgroup(
+            self.group,
+            self.consumer,
+            {self.key: ">"},
+            count=count,
+            # XREADGROUP takes whole milliseconds, and BLOCK 0 would mean forever
+            block=max(1, int(block_ms)) if block_ms else None
+        )
+        if not res:
+            return []
+
+        # res: [[stream_key, [(entry_id, {b"payload": raw}), ...]]]
+        _, messages = res[0]
+        entries = [(entry_id, fields[b"payload"]) for entry_id, fields in messages if fields]
+        self._hold(entries)
+        return entries
+
+    def _hold(self, entries):
+        with self._held_lock:
+            self._held.update(entry_id for entry_id, _ in entries)
+
+    def refresh(self):
+        """
+        Every STREAM_REFRESH_INTERVAL_S, resets the idle time of the entries this consumer still
+        holds, so other workers' XAUTOCLAIM only ever takes work whose worker has stopped.
+        """
+        now = time.time()
+        if now - self._last_refresh < STREAM_REFRESH_INTERVAL_S:
+            return
+        self._last_refresh = now
+        with self._held_lock:
+            entry_ids = list(self._held)
+        if entry_ids:
+            # XCLAIM by the owner with a min idle time of 0: JUSTID skips the payloads and
+            # leaves the delivery count alone, so refreshes never count as failed deliveries
+            self.client.xclaim(self.key, self.group, self.consumer, 0, entry_ids, justid=True)
+
+    def _claim_stale(self, count):
+        now = time.time()
+        if now - self._last_claim < STREAM_CLAIM_INTERVAL_S:
+            return []
+        self._last_claim = now
+
+        next_cursor, messages, *_ = self.client.xautoclaim(
+            self.key,
+            self.group,
+            self.consumer,
+            min_idle_time=STREAM_CLAIM_IDLE_MS,
+            start_id=self._claim_cursor,
+            count=count
+        )
+        self._claim_cursor = next_cursor
+        if not messages:
+            return []
+
+        # XAUTOCLAIM does not report delivery counts, XPENDING does
+        pipe = self.client.pipeline(transaction=False)
+        for entry_id, _ in messages:
+            pipe.xpending_range(self.key, self.group, min=entry_id, max=entry_id, count=1)
+        pending_info = pipe.execute()
+
+        entries, dead, deleted = [], [], []
+        for (entry_id, fields), info in zip(messages, pending_info):
+            deliveries = info[0]["times_delivered"] if info else 1
+            if not fields:
+                # Entry was deleted while pending, nothing left to run or answer
+                deleted.append(entry_id)
+            elif deliveries > STREAM_MAX_DELIVERIES:
+                logger.error("Dropping task after repeated failed deliveries",
+                             entry_id=entry_id,
+                             deliveries=deliveries)
+                dead.append((entry_id, fields[b"payload"]))
+            else:
+                entries.append((entry_id, fields[b"payload"]))
+
+        if deleted:
+            self.ack(deleted)
+        if dead:
+            # Held until the worker has answered them, like any other delivered entry
+            self._hold(dead)
+            self._dead.extend(dead)
+        if entries:
+            logger.warning("Reclaimed orphaned tasks", count=len(entries), consumer=self.consumer)
+        return entries
+
+    def dead_letters(self):
+        """
+        Removes and returns the (entry_id, raw) tasks dropped after STREAM_MAX_DELIVERIES. They are
+        still pending: the caller answers them with an error, so nobody waits out the timeout, then acks.
+        """
+        dead, self._dead = self._dead, []
+        return dead
+
+    def ack(self, entry_ids):
+        entry_ids = [e for e in entry_ids if e is not None]
+        if not entry_ids:
+            return
+        with self._held_lock:
+            self._held.difference_update(entry_ids)
+        # Acked entries are deleted too, so the stream only ever holds outstanding work
+        pipe = self.client.pipeline(transaction=False)
+        pipe.xack(self.key, self.group, *entry_ids)
+        pipe.xdel(self.key, *entry_ids)
+        pipe.execute()
+
+    def depth(self):
+        return self.client.xlen(self.key)
+
+
+def get_task_queue(client):
+    """Factory for the configured queue backend. `client` may be a sync or an asyncio Redis client."""
+    if QUEUE_BACKEND == "stream":
+        return StreamTaskQueue(client)
+    if QUEUE_BACKEND != "list":
+        raise ValueError(f"Unknown QUEUE_BACKEND '{QUEUE_BACKEND}', expected 'list' or 'stream'")
+    return ListTaskQueue(client)
@@ -110,5 +110,7 @@ def fig_to_pil(fig):
     logger.debug("Converting Matplotlib figure to PIL image")
     buf = io.BytesIO()
     fig.savefig(buf, format='png', dpi=150, bbox_inches='tight')
+    # pyplot keeps every open figure alive until it is closed
+    plt.close(fig)
     buf.seek(0)
     return Image.open(buf)
\ No newline at end of file
@@ -0,0 +1,52 @@
+import os
+from app import wire
+from app.logging_config import get_logger
+
+logger = get_logger(__name__)
+
+# How long a lazily visualized request can still be rendered through /visualize/{request_id}
+VISUALIZE_TTL = int(os.environ.get("VISUALIZE_TTL", "3600"))
+VISUALIZE_KEY_PREFIX = "florence_visualize"
+# eager: draw overlays in the request (the original behaviour), lazy: draw them on the first
+# GET /visualize/{request_id}, none: never. Overlays are opt-in, machine clients only read result_data.
+VISUALIZE_MODES = ("eager", "lazy", "none")
+VISUALIZE_DEFAULT = os.environ.get("VISUALIZE_DEFAULT", "none").lower()
+
+
+class VisualizationStore:
+    """
+    Keeps what is needed to draw a request's overlays later: its parsed results and the storage
+    key of the uploaded input. The image itself stays out of Redis. Rendered overlays are cached in
+    the same Redis hash per (task, format, quality), and everything expires after VISUALIZE_TTL.
+    """
+    def __init__(self, client):
+        self.client = client
+
+    @staticmethod
+    def _key(request_id):
+        return f"{VISUALIZE_KEY_PREFIX}:{request_id}"
+
+    @staticmethod
+    def _overlay_field(task, image_format, quality):
+        return f"overlay:{task}:{image_format}:{quality or ''}"
+
+    async def save(self, request_id, results, input_key):
+        """results maps task -> parsed result, input_key is the stored input image's object key."""
+        source = {"results": results, "input_key": input_key}
+
+        pipe = self.client.pipeline(transaction=True)
+        pipe.delete(self._key(request_id))
+        pipe.hset(self._key(request_id), "source", wire.pack(source))
+        pipe.expire(self._key(request_id), VISUALIZE_TTL)
+        await pipe.execute()
+
+    async def load(self, request_id):
+        raw = await self.client.hget(self._key(request_id), "source")
+        return wire.unpack(raw) if raw else None
+
+    async def get_overlay(self, request_id, task, image_format, quality):
+        return await self.client.hget(self._key(request_id), self._overlay_field(task, image_format, quality))
+
+    async def set_overlay(self, request_id, task, image_format, quality, data):
+        # The hash keeps the TTL set by save(), overlays never outlive their source
+        await self.client.hset(self._key(request_id), self._overlay_field(task, image_format, quality), data)
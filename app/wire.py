@@ -0,0 +1,67 @@
+import os
+import msgpack
+from app.logging_config import get_logger
+
+logger = get_logger(__name__)
+
+# When the API and the worker share a host (the default single container setup), image bytes can be
+# handed over through tmpfs instead of travelling through Redis. Only a path goes on the queue.
+SHM_TRANSPORT = os.environ.get("SHM_TRANSPORT", "false").lower() == "true"
+SHM_DIR = os.environ.get("SHM_DIR", "/dev/shm/florence")
+
+
+# Wire format for everything on the task queue and the reply lists.
+# Tasks and replies are msgpack maps; image bytes travel as a raw msgpack bin field,
+# so there is no base64 inflation and no JSON parsing of megabytes of text on the worker.
+def pack(message: dict) -> bytes:
+    return msgpack.packb(message, use_bin_type=True)
+
+
+def unpack(raw: bytes) -> dict:
+    return msgpack.unpackb(raw, raw=False)
+
+
+def attach_image(payload: dict, image_data: bytes, task_id: str):
+    """
+    Puts the image into the task payload, through shared memory when enabled.
+    Returns the shm path that the caller owns and must release, or None.
+    """
+    if SHM_TRANSPORT:
+        path = os.path.join(SHM_DIR, task_id)
+        try:
+            os.makedirs(SHM_DIR, exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(image_data)
+            payload["image_shm"] = path
+            return path
+        except OSError as e:
+            # tmpfs full or missing, fall back to sending the bytes inline
+            logger.warning("Shared memory transport unavailable, sending image inline", error=str(e))
+            release_image(path)
+
+    payload["image"] = image_data
+    return None
+
+
+def has_image(payload: dict) -> bool:
+    return "image" in payload or "image_shm" in payload
+
+
+def read_image(payload: dict) -> bytes:
+    """Returns the raw image bytes of a task, wherever they were put."""
+    if "image" in payload:
+        return payload["image"]
+    with open(payload["image_shm"], "rb") as f:
+        return f.read()
+
+
+def release_image(path):
+    if not path:
+        return
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        # Also reached from attach_image's fallback, where the file may never have been created
+        logger.warning("Could not remove shared memory image", path=path, error=str(e))
@@ -0,0 +1,144 @@
+import os
+import sys
+import time
+import signal
+import subprocess
+from app.cpu_affinity import parse_cpus, format_cpus, split_cpus
+from app.logging_config import get_logger, setup_logging
+
+# Initialize structured logger
+setup_logging()
+logger = get_logger("worker_supervisor")
+
+# --- CONFIGURATION ---
+# Inference processes on this host. They share the task queue like workers on separate hosts would.
+WORKER_PROCESSES = int(os.environ.get("WORKER_PROCESSES", "1"))
+# Cores to spread the workers over (e.g. "0-15" or "0-7,16-23"), default every core this process may use
+WORKER_CPUS = os.environ.get("WORKER_CPUS")
+# A child that dies is restarted after this many seconds, doubling up to RESTART_BACKOFF_MAX_S while it keeps dying
+RESTART_BACKOFF_S = float(os.environ.get("RESTART_BACKOFF_S", "1"))
+RESTART_BACKOFF_MAX_S = float(os.environ.get("RESTART_BACKOFF_MAX_S", "60"))
+# A child that ran this long before dying is considered healthy again, its backoff starts over
+HEALTHY_AFTER_S = float(os.environ.get("HEALTHY_AFTER_S", "300"))
+# Children start one after another: the next one only once the previous has loaded its model, so
+# the transient full copy every child makes while loading never exists in several processes at once
+START_TIMEOUT_S = float(os.environ.get("START_TIMEOUT_S", "600"))
+
+
+class Child:
+    def __init__(self, index, cpus):
+        self.index = index
+        self.cpus = cpus
+        self.process = None
+        self.started_at = 0.0
+        self.backoff = RESTART_BACKOFF_S
+        self.restart_at = None
+        self.ready_file = f"/tmp/florence_worker_{index}.ready"
+
+    def start(self):
+        env = dict(os.environ)
+        env.update({
+            "WORKER_CPUS": format_cpus(self.cpus),
+            "WORKER_THREADS": os.environ.get("WORKER_THREADS") or str(len(self.cpus)),
+            # OpenMP and MKL size their own pools from these, before torch is told
+            "OMP_NUM_THREADS": os.environ.get("WORKER_THREADS") or str(len(self.cpus)),
+            "MKL_NUM_THREADS": os.environ.get("WORKER_THREADS") or str(len(self.cpus)),
+            "MMAP_WEIGHTS": os.environ.get("MMAP_WEIGHTS", "true"),
+            "WORKER_READY_FILE": self.ready_file,
+        })
+        if os.path.exists(self.ready_file):
+            os.unlink(self.ready_file)
+        self.process = subprocess.Popen([sys.executable, "-u", "-m", "app.model_worker"], env=env)
+        self.started_at = time.time()
+        self.restart_at = None
+        logger.info("Worker process started", index=self.index, pid=self.process.pid, cpus=format_cpus(self.cpus))
+
+    def wait_ready(self):
+        """Blocks until the child has loaded its model, died, or START_TIMEOUT_S passed."""
+        deadline = time.time() + START_TIMEOUT_S
+        while time.time() < deadline:
+            if os.path.exists(self.ready_file):
+                return True
+            if self.process.poll() is not None:
+                return False
+            time.sleep(0.5)
+        logger.warning("Worker process not ready in time, starting the next one anyway", index=self.index)
+        return False
+
+
+def prepare_shared_weights():
+    """Writes the memory mappable checkpoint once, before any child races to do it."""
+    from app.config import ModelConfig
+    from app.shared_weights import ensure_mapped_checkpoint
+
+    config = ModelConfig()
+    if os.environ.get("MMAP_WEIGHTS", "true").lower() != "true" or not os.path.isdir(config.MODEL_ID):
+        return
+    if config.CPU_PRECISION.lower() == "int8":
+        logger.info("CPU_PRECISION=int8 quantizes per process, weights are not shared")
+        return
+    try:
+        import torch
+        if not torch.cuda.is_available():
+            ensure_mapped_checkpoint(config.MODEL_ID, torch.float32)
+    except Exception as e:
+        # Every child still loads its own copy
+        logger.exception("Failed to prepare the shared checkpoint", error=str(e))
+
+
+def supervise():
+    available = parse_cpus(WORKER_CPUS) if WORKER_CPUS else sorted(os.sched_getaffinity(0))
+    processes = max(1, min(WORKER_PROCESSES, len(available)))
+    children = [Child(i, cpus) for i, cpus in enumerate(split_cpus(available, processes))]
+    logger.info("Worker supervisor starting", processes=processes, cpus=format_cpus(available),
+                threads_per_worker=[len(c.cpus) for c in children])
+
+    prepare_shared_weights()
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        logger.info("Stopping worker processes", signal=signum)
+        for child in children:
+            if child.process is not None and child.process.poll() is None:
+                child.process.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for child in children:
+        if stopping:
+            break
+        child.start()
+        child.wait_ready()
+
+    while not stopping:
+        now = time.time()
+        for child in children:
+            code = child.process.poll()
+            if code is None or stopping:
+                continue
+            if child.restart_at is None:
+                if now - child.started_at >= HEALTHY_AFTER_S:
+                    child.backoff = RESTART_BACKOFF_S
+                child.restart_at = now + child.backoff
+                logger.error("Worker process died, restarting", index=child.index, pid=child.process.pid,
+                             exit_code=code, restart_in_s=child.backoff)
+                child.backoff = min(child.backoff * 2, RESTART_BACKOFF_MAX_S)
+            elif now >= child.restart_at:
+                child.start()
+        time.sleep(0.5)
+
+    for child in children:
+        if child.process is not None:
+            try:
+                child.process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                child.process.kill()
+    logger.info("Worker supervisor stopped")
+
+
+if __name__ == "__main__":
+    supervise()
@@ -1,7 +1,7 @@
 import os
 import chainlit as cl
 from app.model import Florence2Model
-from app.config import ModelConfig, S3StorageClient
+from app.config import ModelConfig, get_storage_client
 from app.constants import (
     TASK_TYPES,
     CAPTION_TO_PHRASE_GROUNDING,
@@ -22,7 +22,7 @@ def fix_context():
 
 logger = get_logger(__name__)
 model = RedisModelProxy()
-storage_client = S3StorageClient()
+storage_client = get_storage_client()
 
 @cl.data_layer
 def setup_data_layer():
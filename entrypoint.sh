@@ -4,28 +4,27 @@ set -e
 echo "Current Model Path (MODEL_ID): $MODEL_ID"
 
 wait_for_worker() {
-    local log_file="/tmp/model_worker.log"
-    local timeout=120
+    local timeout=${WORKER_READY_TIMEOUT:-120}
     local elapsed=0
     
-    echo "[WAIT] Monitoring GPU Warmup..."
+    echo "[WAIT] Waiting for the worker's readiness heartbeat..."
 
     while [ "$elapsed" -lt "$timeout" ]; do
-        if ! pgrep -f "app.model_worker" > /dev/null; then
+        # The worker itself, or the supervisor that may still be preparing weights before its first child
+        if ! kill -0 "$WORKER_PID" 2>/dev/null; then
             echo "CRITICAL: Model Worker died!"
             exit 1
         fi
 
-        if grep -q "Warmup complete" "$log_file" 2>/dev/null; then
+        # Exits 0 once a worker on this host has warmed up and sends heartbeats
+        if python3 -m app.readiness --local 2>/dev/null; then
             echo "SUCCESS: Model is ready."
-            # CLEANUP: We don't need this temp file anymore
-            rm -f "$log_file"
             return 0
         fi
 
         echo " Still warming up... (${elapsed}s/${timeout}s)"
-        sleep 5
-        elapsed=`expr $elapsed + 5`
+        sleep 2
+        elapsed=`expr $elapsed + 2`
     done
 
     echo "ERROR: Warmup timed out."
@@ -36,11 +35,18 @@ wait_for_worker() {
 echo "Checking for model weights..."
 ./download_model.sh
 
-echo "🧠 Starting Single Model Worker (The Brain)..."
 export PYTHONPATH=$PYTHONPATH:.
-rm -f /tmp/model_worker.log
-touch /tmp/model_worker.log
-python3 -u -m app.model_worker 2>&1 | tee /tmp/model_worker.log &
+# Tags this start's heartbeats, so a key left by the previous run of this container can't pass for ready
+export WORKER_BOOT_ID=`cat /proc/sys/kernel/random/uuid 2>/dev/null || date +%s`
+if [ "${WORKER_PROCESSES:-1}" -gt 1 ]; then
+    echo "🧠 Starting $WORKER_PROCESSES Model Workers under the supervisor..."
+    python3 -u -m app.worker_supervisor &
+    WORKER_PID=$!
+else
+    echo "🧠 Starting Single Model Worker (The Brain)..."
+    python3 -u -m app.model_worker &
+    WORKER_PID=$!
+fi
 sleep 2
 wait_for_worker
 
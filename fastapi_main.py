@@ -6,6 +6,7 @@ from fastapi import FastAPI, Request
 from starlette.middleware.base import BaseHTTPMiddleware
 from contextlib import asynccontextmanager
 from api import api_router
+from api.florence_api import model_proxy
 
 from app.logging_config import get_logger, setup_logging, LOGFIRE_ENABLED
 from app.config import ModelConfig
@@ -41,6 +42,7 @@ async def lifespan(app: FastAPI):
     yield
     # Shutdown
     logger.info("FastAPI Server Shutting Down")
+    await model_proxy.close()
 
 # 3. Create FastAPI App
 app = FastAPI(title="Florence-ai API", lifespan=lifespan)
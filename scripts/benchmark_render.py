@@ -0,0 +1,110 @@
+"""
+Micro-benchmark of result visualization: the legacy matplotlib path (app.utils) against the
+Pillow/NumPy renderer (app.render), on synthetic detection, segmentation and OCR results.
+With --save, also writes both renderings of each result side by side (legacy left, new right).
+
+    PYTHONPATH=. python scripts/benchmark_render.py --size 1920x1080 --boxes 50 --repeat 20 --save /tmp/render
+"""
+import io
+import os
+import math
+import time
+import random
+import argparse
+import tracemalloc
+from PIL import Image
+from app import render
+from app.utils import plot_bbox, fig_to_pil, draw_polygons, draw_ocr_bboxes
+from app.constants import OD, REFERRING_EXPRESSION_SEGMENTATION, OCR_WITH_REGION
+
+
+def synthetic_results(width, height, count, seed=0):
+    rng = random.Random(seed)
+
+    def box():
+        x1, y1 = rng.uniform(0, width * 0.8), rng.uniform(0, height * 0.8)
+        return [x1, y1, x1 + rng.uniform(20, width * 0.2), y1 + rng.uniform(20, height * 0.2)]
+
+    bboxes = [box() for _ in range(count)]
+    quads = [[x1, y1, x2, y1, x2, y2, x1, y2] for x1, y1, x2, y2 in bboxes]
+    cx, cy, r = width / 2, height / 2, min(width, height) / 3
+    polygon = []
+    for i in range(64):
+        angle = i / 64 * 2 * math.pi
+        polygon += [cx + r * rng.uniform(0.7, 1.0) * math.cos(angle),
+                    cy + r * rng.uniform(0.7, 1.0) * math.sin(angle)]
+    return {
+        OD: {"bboxes": bboxes, "labels": [f"object {i}" for i in range(count)]},
+        REFERRING_EXPRESSION_SEGMENTATION: {"polygons": [[polygon]], "labels": [""]},
+        OCR_WITH_REGION: {"quad_boxes": quads, "labels": [f"text {i}" for i in range(count)]},
+    }
+
+
+def legacy_png(task_type, prediction, image_bytes):
+    """The visualization path as it was before app.render: matplotlib for boxes, PIL drawing in place for the rest."""
+    image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+    if task_type == OD:
+        processed = fig_to_pil(plot_bbox(image, prediction))
+    elif task_type == REFERRING_EXPRESSION_SEGMENTATION:
+        processed = image.copy()
+        draw_polygons(processed, prediction, fill_mask=True)
+    else:
+        processed = image.copy()
+        draw_ocr_bboxes(processed, prediction)
+    buf = io.BytesIO()
+    processed.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def measure(fn, task_type, prediction, image_bytes, repeat):
+    fn(task_type, prediction, image_bytes)  # warm up fonts, imports and caches
+    tracemalloc.start()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(task_type, prediction, image_bytes)
+    elapsed = (time.perf_counter() - start) / repeat
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed * 1000, peak / 1024 ** 2
+
+
+def side_by_side(legacy_bytes, new_bytes):
+    """Both renderings at the same height, legacy on the left. The matplotlib figure has its own size and margins."""
+    legacy = Image.open(io.BytesIO(legacy_bytes)).convert("RGB")
+    new = Image.open(io.BytesIO(new_bytes)).convert("RGB")
+    legacy = legacy.resize((round(legacy.width * new.height / legacy.height), new.height))
+    combined = Image.new("RGB", (legacy.width + new.width + 10, new.height), (255, 255, 255))
+    combined.paste(legacy, (0, 0))
+    combined.paste(new, (legacy.width + 10, 0))
+    return combined
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", default="1920x1080", help="WIDTHxHEIGHT of the synthetic image")
+    parser.add_argument("--boxes", type=int, default=50, help="detections / OCR regions per result")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--save", metavar="DIR", help="write legacy and new renderings side by side as PNGs")
+    args = parser.parse_args()
+
+    width, height = map(int, args.size.lower().split("x"))
+    buf = io.BytesIO()
+    Image.new("RGB", (width, height), (90, 120, 150)).save(buf, format="JPEG")
+    image_bytes = buf.getvalue()
+
+    print(f"{args.size}, {args.boxes} regions, mean of {args.repeat} runs")
+    print(f"{'task':<40}{'legacy ms':>12}{'new ms':>10}{'speedup':>10}{'legacy MB':>12}{'new MB':>10}")
+    for task_type, prediction in synthetic_results(width, height, args.boxes).items():
+        legacy_ms, legacy_mb = measure(legacy_png, task_type, prediction, image_bytes, args.repeat)
+        new_ms, new_mb = measure(render.render_encoded, task_type, prediction, image_bytes, args.repeat)
+        print(f"{task_type:<40}{legacy_ms:>12.1f}{new_ms:>10.1f}{legacy_ms / new_ms:>9.1f}x{legacy_mb:>12.1f}{new_mb:>10.1f}")
+        if args.save:
+            os.makedirs(args.save, exist_ok=True)
+            path = os.path.join(args.save, f"{task_type.strip('<>').lower()}.png")
+            side_by_side(legacy_png(task_type, prediction, image_bytes),
+                         render.render_encoded(task_type, prediction, image_bytes)).save(path)
+            print(f"{'':<40}saved {path}")
+
+
+if __name__ == "__main__":
+    main()
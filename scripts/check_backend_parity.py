@@ -0,0 +1,71 @@
+"""
+Parity check of the ONNX Runtime backend against the PyTorch backend: runs the same images and tasks
+through the continuous batching scheduler on both and compares the parsed results. Exits with 1 when
+any result differs (text exactly, coordinates within --tolerance pixels).
+
+    PYTHONPATH=. python scripts/check_backend_parity.py --images ./samples --onnx-dir /app/hf_cache/florence-2-large-onnx
+"""
+import os
+import sys
+import argparse
+from PIL import Image
+from app.config import ModelConfig
+from app.model import Florence2Model
+from app.backends import OnnxBackend
+from app.scheduler import ContinuousBatchScheduler, DecodeRequest
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp")
+
+
+def run(scheduler, model, images, tasks, num_beams):
+    """Parsed result per (image name, task). Every image's tasks are admitted together, as the worker would."""
+    results = {}
+    for name, image in images:
+        requests = [DecodeRequest((name, task), task, num_beams=num_beams) for task in tasks]
+        scheduler.admit([(model.pixel_values([image]), requests)])
+        while len(scheduler):
+            for request, token_ids in scheduler.step():
+                _, task = request.handle
+                results[(name, task)] = model.decode_tokens(token_ids, task, (image.width, image.height))[task]
+    return results
+
+
+def same(a, b, tolerance):
+    if isinstance(a, float) or isinstance(b, float):
+        return isinstance(a, (int, float)) and isinstance(b, (int, float)) and abs(a - b) <= tolerance
+    if isinstance(a, dict):
+        return isinstance(b, dict) and a.keys() == b.keys() and all(same(a[k], b[k], tolerance) for k in a)
+    if isinstance(a, list):
+        return isinstance(b, list) and len(a) == len(b) and all(same(x, y, tolerance) for x, y in zip(a, b))
+    return a == b
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", required=True, help="directory of test images")
+    parser.add_argument("--onnx-dir", default=os.environ.get("ONNX_MODEL_DIR", "/app/hf_cache/florence-2-large-onnx"))
+    parser.add_argument("--tasks", default="<CAPTION>,<MORE_DETAILED_CAPTION>,<OD>,<OCR>,<OCR_WITH_REGION>")
+    parser.add_argument("--num-beams", type=int, default=3)
+    parser.add_argument("--limit", type=int, default=10)
+    parser.add_argument("--tolerance", type=float, default=1.0, help="pixels coordinates may differ by")
+    args = parser.parse_args()
+
+    names = sorted(n for n in os.listdir(args.images) if n.lower().endswith(IMAGE_EXTENSIONS))[:args.limit]
+    images = [(name, Image.open(os.path.join(args.images, name)).convert("RGB")) for name in names]
+    tasks = args.tasks.split(",")
+
+    model = Florence2Model(ModelConfig(CPU_PRECISION="fp32", INFERENCE_BACKEND="torch"))
+    max_rows = len(tasks) * args.num_beams
+    reference = run(ContinuousBatchScheduler(model, max_rows=max_rows), model, images, tasks, args.num_beams)
+    onnx = run(ContinuousBatchScheduler(model, max_rows=max_rows, backend=OnnxBackend(args.onnx_dir)),
+               model, images, tasks, args.num_beams)
+
+    mismatches = [key for key in reference if not same(reference[key], onnx.get(key), args.tolerance)]
+    for name, task in mismatches:
+        print(f"MISMATCH {name} {task}\n  torch: {reference[(name, task)]}\n  onnx:  {onnx.get((name, task))}")
+    print(f"{len(reference) - len(mismatches)}/{len(reference)} results identical")
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Accuracy vs latency of the CPU precision modes (ModelConfig.CPU_PRECISION): fp32, bf16 autocast
+and dynamic int8. Every mode runs in its own process, so load time and RSS are measured cleanly,
+on the same local images and tasks through the worker's decode path. Outputs are compared with fp32:
+text by similarity ratio, boxes by the mean IoU of same-label matches.
+
+    PYTHONPATH=. python scripts/compare_cpu_precision.py --images ./samples --tasks "<CAPTION>,<OD>,<OCR>"
+"""
+import os
+import sys
+import json
+import time
+import difflib
+import argparse
+import subprocess
+from statistics import mean
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp")
+
+
+def load_images(directory, limit):
+    names = sorted(n for n in os.listdir(directory) if n.lower().endswith(IMAGE_EXTENSIONS))[:limit]
+    if not names:
+        raise SystemExit(f"No images in {directory}")
+    images = []
+    for name in names:
+        with open(os.path.join(directory, name), "rb") as f:
+            images.append((name, f.read()))
+    return images
+
+
+def run_mode(mode, images, tasks, num_beams):
+    """Loads the model in this process with the given precision and returns its measurements and outputs."""
+    os.environ["CPU_PRECISION"] = mode
+    import torch
+    from app.config import ModelConfig
+    from app.model import Florence2Model
+    from app.scheduler import ContinuousBatchScheduler, DecodeRequest
+
+    torch.set_num_threads(int(os.environ.get("OMP_NUM_THREADS", torch.get_num_threads())))
+    start = time.perf_counter()
+    model = Florence2Model(ModelConfig())
+    load_s = time.perf_counter() - start
+    scheduler = ContinuousBatchScheduler(model, max_rows=num_beams)
+    scheduler.warmup()
+
+    outputs, latencies = {}, {task: [] for task in tasks}
+    for name, data in images:
+        image = model.preprocess_image(data)
+        for task in tasks:
+            start = time.perf_counter()
+            scheduler.admit([(model.pixel_values([image]), [DecodeRequest(None, task, num_beams=num_beams)])])
+            finished = []
+            while not finished:
+                finished = scheduler.step()
+            result = model.decode_tokens(finished[0][1], task, (image.width, image.height))
+            latencies[task].append((time.perf_counter() - start) * 1000)
+            outputs[f"{name}|{task}"] = result[task]
+
+    return {
+        "mode": mode,
+        "load_s": round(load_s, 1),
+        **model.memory_footprint(),
+        "latency_ms": {task: round(mean(values), 1) for task, values in latencies.items()},
+        "outputs": outputs,
+    }
+
+
+def iou(a, b):
+    x1, y1, x2, y2 = max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3])
+    inter = max(0.0, x2 - x1) * max(0.0, y2 - y1)
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0.0
+
+
+def agreement(reference, output):
+    """1.0 means identical to the fp32 output."""
+    if isinstance(reference, str):
+        return difflib.SequenceMatcher(None, reference, output).ratio()
+    if isinstance(reference, dict) and "bboxes" in reference:
+        ref = list(zip(reference["bboxes"], reference.get("labels", [])))
+        out = list(zip(output.get("bboxes", []), output.get("labels", [])))
+        if not ref and not out:
+            return 1.0
+        # Every reference box against its best same-label match, missing and extra boxes count as 0
+        scores = [max((iou(box, other) for other, other_label in out if other_label == label), default=0.0)
+                  for box, label in ref]
+        return sum(scores) / max(len(ref), len(out))
+    return float(reference == output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", required=True, help="directory of test images")
+    parser.add_argument("--tasks", default="<CAPTION>,<MORE_DETAILED_CAPTION>,<OD>,<OCR>")
+    parser.add_argument("--modes", default="fp32,bf16,int8", help="fp32 first, it is the reference")
+    parser.add_argument("--limit", type=int, default=20, help="most images to use")
+    parser.add_argument("--num-beams", type=int, default=3, help="3 = the quality profile, 1 = fast")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    tasks = args.tasks.split(",")
+    images = load_images(args.images, args.limit)
+
+    if args.child:
+        json.dump(run_mode(args.child, images, tasks, args.num_beams), sys.stdout)
+        return
+
+    runs = []
+    for mode in args.modes.split(","):
+        print(f"Running {mode}...", file=sys.stderr)
+        child = subprocess.run(
+            [sys.executable, __file__, "--child", mode, "--images", args.images, "--tasks", args.tasks,
+             "--limit", str(args.limit), "--num-beams", str(args.num_beams)],
+            stdout=subprocess.PIPE, check=True
+        )
+        # The model logs to stdout as well, the JSON document is the last line
+        runs.append(json.loads(child.stdout.decode().strip().splitlines()[-1]))
+
+    reference = runs[0]["outputs"]
+    print(f"{len(images)} images, tasks {tasks}, {args.num_beams} beams, reference {runs[0]['mode']}")
+    print(f"{'mode':<8}{'load s':>8}{'weights MB':>12}{'RSS MB':>10}" + "".join(f"{t + ' ms':>28}" for t in tasks) + f"{'agreement':>11}")
+    for run in runs:
+        score = mean(agreement(reference[key], output) for key, output in run["outputs"].items())
+        print(f"{run['mode']:<8}{run['load_s']:>8}{run['weights_mb']:>12}{run['rss_mb']:>10}"
+              + "".join(f"{run['latency_ms'][t]:>28}" for t in tasks) + f"{score:>11.3f}")
+
+
+if __name__ == "__main__":
+    main()
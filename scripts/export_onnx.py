@@ -0,0 +1,125 @@
+"""
+Exports the worker's three step graphs (vision encoder, prefill, decode step) of Florence-2 to ONNX
+for INFERENCE_BACKEND=onnx. The graphs are traced from Florence2Model's step primitives in float32,
+with dynamic rows, prompt/encoder lengths and key/value cache length.
+
+    PYTHONPATH=. python scripts/export_onnx.py --output /app/hf_cache/florence-2-large-onnx
+
+Check the result against the PyTorch backend with scripts/check_backend_parity.py.
+"""
+import os
+import inspect
+import argparse
+import torch
+from PIL import Image
+from app.config import ModelConfig
+from app.model import Florence2Model
+
+
+class VisionEncoder(torch.nn.Module):
+    def __init__(self, florence):
+        super().__init__()
+        self.florence = florence
+
+    def forward(self, pixel_values):
+        return self.florence.encode_image(pixel_values)
+
+
+class Prefill(torch.nn.Module):
+    def __init__(self, florence):
+        super().__init__()
+        self.florence = florence
+
+    def forward(self, image_features, input_ids, attention_mask):
+        cross_kv, encoder_mask = self.florence.prefill(image_features, input_ids, attention_mask)
+        return (torch.stack([k for k, _ in cross_kv]), torch.stack([v for _, v in cross_kv]),
+                encoder_mask.to(torch.int64))
+
+
+class DecodeStep(torch.nn.Module):
+    def __init__(self, florence):
+        super().__init__()
+        self.florence = florence
+
+    def forward(self, tokens, positions, self_k, self_v, self_valid, cross_k, cross_v, cross_valid):
+        logits, self_kv = self.florence.decode_step(
+            tokens, positions,
+            list(zip(self_k.unbind(0), self_v.unbind(0))), self_valid,
+            list(zip(cross_k.unbind(0), cross_v.unbind(0))), cross_valid,
+        )
+        return logits, torch.stack([k for k, _ in self_kv]), torch.stack([v for _, v in self_kv])
+
+
+def export(module, args, path, input_names, output_names, dynamic_axes, opset):
+    options = {}
+    # torch >= 2.9 defaults to the dynamo exporter, these graphs are traced with dynamic_axes
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        options["dynamo"] = False
+    torch.onnx.export(module, args, path, input_names=input_names, output_names=output_names,
+                      dynamic_axes=dynamic_axes, opset_version=opset, do_constant_folding=True, **options)
+    print(f"Wrote {path} ({os.path.getsize(path) / 1024 ** 2:.0f} MB)")
+
+
+def export_graphs(model, output_dir, pixel_values, input_ids, attention_mask, opset=17):
+    """
+    Traces the three graphs of a float32 Florence2Model into output_dir, from sample images and
+    prompts of two rows each so the row axis is not specialized to 1.
+    """
+    layers, heads, head_dim = model.kv_layout()
+    # The wrappers reach the weights through Florence2Model, which is not a module, so the tracer
+    # stores them as constants, and it refuses constants that require grad
+    model.model.requires_grad_(False)
+    with torch.no_grad():
+        image_features = model.encode_image(pixel_values)
+        cross_kv, cross_valid = model.prefill(image_features, input_ids, attention_mask)
+
+    past = 3
+    cache = torch.zeros((layers, 2, heads, past, head_dim))
+    decode_inputs = (
+        torch.tensor([2, 0]), torch.tensor([past, past]),
+        cache, cache.clone(), torch.ones((2, past + 1), dtype=torch.bool),
+        torch.stack([k for k, _ in cross_kv]), torch.stack([v for _, v in cross_kv]), cross_valid,
+    )
+
+    export(VisionEncoder(model).eval(), (pixel_values,), os.path.join(output_dir, "vision_encoder.onnx"),
+           ["pixel_values"], ["image_features"],
+           {"pixel_values": {0: "images"}, "image_features": {0: "images"}}, opset)
+    export(Prefill(model).eval(), (image_features, input_ids, attention_mask), os.path.join(output_dir, "prefill.onnx"),
+           ["image_features", "input_ids", "attention_mask"], ["cross_k", "cross_v", "encoder_mask"],
+           {"image_features": {0: "rows"}, "input_ids": {0: "rows", 1: "prompt_len"},
+            "attention_mask": {0: "rows", 1: "prompt_len"},
+            "cross_k": {1: "rows", 3: "src_len"}, "cross_v": {1: "rows", 3: "src_len"},
+            "encoder_mask": {0: "rows", 1: "src_len"}}, opset)
+    export(DecodeStep(model).eval(), decode_inputs, os.path.join(output_dir, "decode_step.onnx"),
+           ["tokens", "positions", "self_k", "self_v", "self_valid", "cross_k", "cross_v", "cross_valid"],
+           ["logits", "new_self_k", "new_self_v"],
+           {"tokens": {0: "rows"}, "positions": {0: "rows"},
+            "self_k": {1: "rows", 3: "past_len"}, "self_v": {1: "rows", 3: "past_len"},
+            "self_valid": {0: "rows", 1: "total_len"},
+            "cross_k": {1: "rows", 3: "src_len"}, "cross_v": {1: "rows", 3: "src_len"},
+            "cross_valid": {0: "rows", 1: "src_len"},
+            "logits": {0: "rows"}, "new_self_k": {1: "rows", 3: "total_len"}, "new_self_v": {1: "rows", 3: "total_len"}},
+           opset)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", default=os.environ.get("ONNX_MODEL_DIR", "/app/hf_cache/florence-2-large-onnx"))
+    parser.add_argument("--opset", type=int, default=17)
+    args = parser.parse_args()
+    os.makedirs(args.output, exist_ok=True)
+
+    # Traced on CPU in float32 with the PyTorch primitives, whatever the environment selects
+    model = Florence2Model(ModelConfig(CPU_PRECISION="fp32", INFERENCE_BACKEND="torch"))
+    if model.device.type != "cpu":
+        raise SystemExit("Export on a CPU-only host (or with CUDA_VISIBLE_DEVICES=''), the graphs must be float32")
+
+    # Sample inputs from real images and prompts
+    with torch.no_grad():
+        pixel_values = model.pixel_values([Image.new("RGB", (224, 224))] * 2)
+        input_ids, attention_mask = model.tokenize(["<OD>", "<MORE_DETAILED_CAPTION>"])
+    export_graphs(model, args.output, pixel_values, input_ids, attention_mask, args.opset)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+import os
+import tempfile
+
+# Importing chainlit (app.config does) writes its default config files into the app root, keep them out of the tree
+os.environ.setdefault("CHAINLIT_APP_ROOT", tempfile.mkdtemp(prefix="chainlit-"))
@@ -0,0 +1,120 @@
+import asyncio
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+fastapi = pytest.importorskip("fastapi")
+
+from app import admission
+from app.admission import AdmissionController
+from app.batch_controller import WORKER_METRICS_KEY_PREFIX
+from app.task_queue import ListTaskQueue
+
+
+@pytest.fixture(autouse=True)
+def settings(monkeypatch):
+    monkeypatch.setattr(admission, "ADMISSION_CONTROL", True)
+    monkeypatch.setattr(admission, "MAX_QUEUE_LENGTH", 100)
+    monkeypatch.setattr(admission, "ADMISSION_RETRY_AFTER_S", 5)
+    # Every call re-reads the metrics
+    monkeypatch.setattr(admission, "ADMISSION_REFRESH_S", 0)
+
+
+def run(scenario):
+    """Runs scenario(client, controller) against a fresh in-memory Redis."""
+    async def main():
+        client = fakeredis.aioredis.FakeRedis()
+        return await scenario(client, AdmissionController(client, ListTaskQueue(client)))
+    return asyncio.run(main())
+
+
+async def worker(client, name, requests_per_s, queue_depth=0, waiting_tasks=0, active_tasks=0):
+    await client.hset(f"{WORKER_METRICS_KEY_PREFIX}:{name}", mapping={
+        "requests_per_s": requests_per_s, "queue_depth": queue_depth,
+        "waiting_tasks": waiting_tasks, "active_tasks": active_tasks,
+    })
+
+
+async def queue_tasks(client, count):
+    if count:
+        await client.lpush("florence_tasks", *[b"task"] * count)
+
+
+async def rejection(controller, budget_s, items=1):
+    with pytest.raises(fastapi.HTTPException) as error:
+        await controller.admit(budget_s, items)
+    return error.value
+
+
+def test_throughput_only_counts_windows_with_tasks_waiting():
+    async def scenario(client, controller):
+        # Idle workers only measure the arrival rate
+        await worker(client, "a:1", 3.0)
+        assert await controller.refresh() == (None, 0)
+
+        # Backlog in Redis, or already pulled into a worker
+        await worker(client, "a:1", 3.0, queue_depth=4)
+        await worker(client, "b:1", 2.0, waiting_tasks=1, active_tasks=3)
+        assert await controller.refresh() == (5.0, 4)
+
+        # Back to idle: the capacity figure stays, the backlog is current
+        await worker(client, "a:1", 0.5)
+        await worker(client, "b:1", 0.5)
+        assert await controller.refresh() == (5.0, 0)
+
+    run(scenario)
+
+
+def test_worker_backlog_counts_towards_the_wait():
+    async def scenario(client, controller):
+        # Redis is empty, but the worker holds 25 tasks and completes 1 per second
+        await worker(client, "a:1", 1.0, waiting_tasks=20, active_tasks=5)
+        error = await rejection(controller, budget_s=10)
+        assert error.status_code == 503
+        # 26 s estimated against a 10 s budget
+        assert error.headers["Retry-After"] == "16"
+
+        await worker(client, "a:1", 1.0, waiting_tasks=2, active_tasks=5)
+        await controller.admit(10)
+
+    run(scenario)
+
+
+def test_queue_cap_applies_before_any_throughput_is_known():
+    async def scenario(client, controller):
+        await queue_tasks(client, 100)
+        error = await rejection(controller, budget_s=30)
+        assert error.headers["Retry-After"] == "5"
+        assert error.detail == "Task queue is full, retry later"
+
+    run(scenario)
+
+
+def test_queue_cap_retry_after_uses_throughput():
+    async def scenario(client, controller):
+        await queue_tasks(client, 99)
+        await worker(client, "a:1", 10.0, queue_depth=99)
+        # 9 items past the cap drain in about a second
+        error = await rejection(controller, budget_s=3600, items=10)
+        assert error.headers["Retry-After"] == "1"
+
+    run(scenario)
+
+
+def test_requests_within_budget_are_admitted():
+    async def scenario(client, controller):
+        await queue_tasks(client, 10)
+        await worker(client, "a:1", 4.0, queue_depth=10)
+        await controller.admit(30)
+
+    run(scenario)
+
+
+def test_disabled_admission_control_admits_everything(monkeypatch):
+    monkeypatch.setattr(admission, "ADMISSION_CONTROL", False)
+
+    async def scenario(client, controller):
+        await queue_tasks(client, 200)
+        await worker(client, "a:1", 0.1, queue_depth=200)
+        await controller.admit(1)
+
+    run(scenario)
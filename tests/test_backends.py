@@ -0,0 +1,143 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+pytest.importorskip("onnx")
+pytest.importorskip("onnxruntime")
+pytest.importorskip("chainlit")
+
+from transformers import BartConfig, BartForConditionalGeneration, GenerationConfig
+from app.model import Florence2Model
+from app.backends import TorchBackend, OnnxBackend, InferenceBackend
+from app.scheduler import ContinuousBatchScheduler, DecodeRequest
+from scripts.export_onnx import export_graphs
+
+PAD = 1
+
+
+class TinyFlorence(torch.nn.Module):
+    """Just enough of Florence-2 for the step primitives: a patch projection as vision tower and a random BART."""
+    def __init__(self):
+        super().__init__()
+        self.language_model = BartForConditionalGeneration(BartConfig(
+            vocab_size=64, d_model=32, encoder_layers=2, decoder_layers=2,
+            encoder_attention_heads=2, decoder_attention_heads=2,
+            encoder_ffn_dim=64, decoder_ffn_dim=64, max_position_embeddings=64,
+        ))
+        self.patches = torch.nn.Linear(3 * 4 * 4, 32)
+
+    def get_input_embeddings(self):
+        return self.language_model.get_input_embeddings()
+
+    def _encode_image(self, pixel_values):
+        # (images, 3, 8, 8) -> (images, 4 patches, d_model)
+        patches = torch.nn.functional.unfold(pixel_values, kernel_size=4, stride=4).transpose(1, 2)
+        return self.patches(patches)
+
+    def _merge_input_ids_with_image_features(self, image_features, inputs_embeds):
+        return torch.cat([image_features, inputs_embeds], dim=1), None
+
+
+def tokenize(prompts):
+    """Prompts are space separated token ids, right padded like the real tokenizer."""
+    ids = [[int(t) for t in prompt.split()] for prompt in prompts]
+    length = max(len(row) for row in ids)
+    input_ids = torch.tensor([row + [PAD] * (length - len(row)) for row in ids])
+    attention_mask = torch.tensor([[1] * len(row) + [0] * (length - len(row)) for row in ids])
+    return input_ids, attention_mask
+
+
+@pytest.fixture(scope="module")
+def florence():
+    torch.manual_seed(0)
+    tiny = TinyFlorence().eval()
+    # Florence2Model without loading anything: the attributes the step primitives read
+    model = Florence2Model.__new__(Florence2Model)
+    model.model = tiny
+    model.model_config = type("Config", (), {"text_config": tiny.language_model.config})
+    model.device = torch.device("cpu")
+    model.precision = "fp32"
+    model.generation_config = GenerationConfig(
+        decoder_start_token_id=2, eos_token_id=2, forced_bos_token_id=0, forced_eos_token_id=2,
+        no_repeat_ngram_size=3, length_penalty=1.0, early_stopping=False,
+    )
+    model.tokenize = tokenize
+    model.backend = TorchBackend(model)
+    return model
+
+
+@pytest.fixture(scope="module")
+def onnx_dir(florence, tmp_path_factory):
+    output = tmp_path_factory.mktemp("onnx")
+    torch.manual_seed(1)
+    export_graphs(florence, str(output), torch.randn(2, 3, 8, 8), *tokenize(["0 5 9 2", "0 7 2"]))
+    return str(output)
+
+
+def image(seed):
+    return torch.randn(1, 3, 8, 8, generator=torch.Generator().manual_seed(seed))
+
+
+def decode(scheduler, waves):
+    """Admits each wave of (image seed, prompt, beams) groups two steps after the previous one, returns the tokens per handle."""
+    results = {}
+    for wave in waves:
+        scheduler.admit([
+            (image(seed), [DecodeRequest((seed, prompt, beams), prompt, num_beams=beams, max_new_tokens=10)])
+            for seed, prompt, beams in wave
+        ])
+        for _ in range(2):
+            results.update((request.handle, tokens) for request, tokens in scheduler.step())
+    while len(scheduler):
+        results.update((request.handle, tokens) for request, tokens in scheduler.step())
+    return results
+
+
+def test_backends_are_abstract():
+    with pytest.raises(TypeError):
+        InferenceBackend()
+
+
+def test_onnx_steps_match_torch(florence, onnx_dir):
+    torch_backend, onnx_backend = florence.backend, OnnxBackend(onnx_dir)
+    pixel_values = torch.cat([image(0), image(1)])
+    input_ids, attention_mask = tokenize(["0 5 9 13 2", "0 7 2"])
+
+    torch_features = torch_backend.encode_image(pixel_values)
+    onnx_features = onnx_backend.encode_image(pixel_values)
+    torch.testing.assert_close(onnx_features, torch_features, atol=1e-4, rtol=1e-4)
+
+    torch_cross, torch_valid = torch_backend.prefill(torch_features, input_ids, attention_mask)
+    onnx_cross, onnx_valid = onnx_backend.prefill(torch_features, input_ids, attention_mask)
+    assert torch.equal(onnx_valid, torch_valid)
+    # torch keeps one pair per layer, onnx all layers stacked
+    torch.testing.assert_close(onnx_cross[0][0], torch.stack([k for k, _ in torch_cross]), atol=1e-4, rtol=1e-4)
+
+    layers, heads, head_dim = florence.kv_layout()
+    torch_self = [(torch.zeros(2, heads, 0, head_dim),) * 2 for _ in range(layers)]
+    onnx_self = [(torch.zeros(layers, 2, heads, 0, head_dim),) * 2]
+    tokens, positions = torch.tensor([2, 2]), torch.tensor([0, 0])
+    for step in range(3):
+        valid = torch.ones(2, step + 1, dtype=torch.bool)
+        torch_logits, torch_self = torch_backend.decode_step(tokens, positions, torch_self, valid, torch_cross, torch_valid)
+        onnx_logits, onnx_self = onnx_backend.decode_step(tokens, positions, onnx_self, valid, onnx_cross, onnx_valid)
+        torch.testing.assert_close(onnx_logits, torch_logits, atol=1e-4, rtol=1e-4)
+        torch.testing.assert_close(onnx_self[0][1], torch.stack([v for _, v in torch_self]), atol=1e-4, rtol=1e-4)
+        tokens, positions = torch_logits.argmax(-1), positions + 1
+
+
+@pytest.mark.parametrize("beams", [1, 3])
+def test_onnx_scheduler_results_match_torch(florence, onnx_dir, beams):
+    # Rows join and leave at different steps, so the onnx backend rebinds its cross cache along the way
+    waves = [
+        [(0, "0 5 9 13 2", beams), (1, "0 7 2", beams)],
+        [(2, "0 11 4 2", beams)],
+        [(3, "0 6 2", 1)],
+    ]
+    reference = decode(ContinuousBatchScheduler(florence, max_rows=16), waves)
+    onnx = decode(ContinuousBatchScheduler(florence, max_rows=16, backend=OnnxBackend(onnx_dir)), waves)
+
+    assert len(reference) == 4
+    assert onnx == reference
+
+
@@ -0,0 +1,61 @@
+import sys
+import threading
+import pytest
+
+from app import batch_controller
+from app.batch_controller import AdaptiveBatchController
+
+
+@pytest.fixture
+def frequent_switches():
+    """Switches threads as often as possible, so an unguarded window loses observations."""
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    yield
+    sys.setswitchinterval(interval)
+
+
+def test_observations_are_not_lost_while_windows_close(monkeypatch, frequent_switches):
+    monkeypatch.setattr(batch_controller, "ADAPTIVE_BATCHING", False)
+    controller = AdaptiveBatchController(4, 12, 0.01)
+    per_thread, threads = 20000, 4
+    done = threading.Event()
+
+    def observe():
+        for _ in range(per_thread):
+            controller.observe_request(0.5)
+            controller.observe_step(0.01, 3)
+
+    completed, steps = 0, 0
+    workers = [threading.Thread(target=observe) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    # Closes windows as fast as it can while the observers run, as the scheduler thread would
+    def wait_for_workers():
+        for worker in workers:
+            worker.join()
+        done.set()
+    closer = threading.Thread(target=wait_for_workers)
+    closer.start()
+    while not done.is_set():
+        metrics = controller.adjust(queue_depth=0, active_rows=0)
+        completed += metrics["completed"]
+        steps += metrics["steps"]
+    closer.join()
+    metrics = controller.adjust(queue_depth=0, active_rows=0)
+    completed += metrics["completed"]
+    steps += metrics["steps"]
+
+    assert completed == steps == per_thread * threads
+
+
+def test_window_metrics_cover_only_their_window(monkeypatch):
+    monkeypatch.setattr(batch_controller, "ADAPTIVE_BATCHING", False)
+    controller = AdaptiveBatchController(4, 12, 0.01)
+    for latency in (0.1, 0.2, 0.3):
+        controller.observe_request(latency)
+    controller.observe_prefill(2)
+
+    metrics = controller.adjust(queue_depth=3, active_rows=6)
+    assert (metrics["completed"], metrics["p95_latency_ms"], metrics["prefill_avg"]) == (3, 300, 2)
+    assert controller.adjust(queue_depth=0, active_rows=0)["completed"] == 0
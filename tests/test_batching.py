@@ -0,0 +1,80 @@
+import time
+import pytest
+
+pytest.importorskip("structlog")
+
+from app import batching
+from app.batching import BatchFormer, batch_bucket
+from app.constants import CAPTION, OD, OCR_WITH_REGION
+
+
+def former_with(*tasks):
+    former = BatchFormer()
+    for i, task in enumerate(tasks):
+        former.add(f"e{i}", task)
+    return former
+
+
+def age(former, index, seconds):
+    """Backdates when the pending task at index was received."""
+    entry_id, task, _ = former.pending[index]
+    former.pending[index] = (entry_id, task, time.time() - seconds)
+
+
+def test_buckets_split_by_profile_output_length_and_multi_task():
+    assert batch_bucket({"task": CAPTION}) == batch_bucket({"task": CAPTION, "profile": None})
+    assert batch_bucket({"task": CAPTION}) != batch_bucket({"task": OCR_WITH_REGION})
+    assert batch_bucket({"task": CAPTION}) != batch_bucket({"task": CAPTION, "profile": "fast"})
+    assert batch_bucket({"tasks": [{"task": CAPTION}]}) == "multi"
+
+
+def test_largest_bucket_goes_first():
+    former = former_with({"task": OCR_WITH_REGION}, {"task": CAPTION}, {"task": CAPTION}, {"task": OD})
+
+    assert [e for e, _ in former.next_batch(4)] == ["e1", "e2"]
+    assert len(former) == 2
+
+
+def test_ties_go_to_the_bucket_with_the_oldest_task():
+    former = former_with({"task": OD}, {"task": CAPTION})
+
+    assert [e for e, _ in former.next_batch(4)] == ["e0"]
+
+
+def test_starving_task_goes_next_whatever_its_bucket_size():
+    former = former_with({"task": OCR_WITH_REGION}, {"task": CAPTION}, {"task": CAPTION}, {"task": CAPTION})
+    age(former, 0, batching.BATCH_STARVATION_MS + 0.1)
+
+    assert [e for e, _ in former.next_batch(4)] == ["e0"]
+    assert [e for e, _ in former.next_batch(4)] == ["e1", "e2", "e3"]
+
+
+def test_row_budget_keeps_bucket_order():
+    former = former_with({"task": CAPTION, "rows": 1}, {"task": CAPTION, "rows": 3}, {"task": CAPTION, "rows": 1})
+    rows_of = lambda task: task["rows"]
+
+    # The 3-row task does not fit, and the 1-row task behind it does not jump it
+    assert [e for e, _ in former.next_batch(4, max_rows=3, rows_of=rows_of)] == ["e0"]
+    assert former.next_batch(4, max_rows=2, rows_of=rows_of) == []
+    # An empty pool takes it anyway
+    assert [e for e, _ in former.next_batch(4, max_rows=2, rows_of=rows_of, min_one=True)] == ["e1"]
+
+
+def test_ready_when_a_bucket_fills_or_the_oldest_has_waited():
+    former = former_with({"task": CAPTION}, {"task": OD})
+    assert not former.ready(max_size=2, wait_s=1)
+
+    former.add("e2", {"task": CAPTION})
+    assert former.ready(max_size=2, wait_s=1)
+
+    former = former_with({"task": CAPTION})
+    age(former, 0, 2)
+    assert former.ready(max_size=4, wait_s=1)
+
+
+def test_expired_tasks_are_dropped():
+    former = former_with({"task": CAPTION, "deadline": time.time() - 1}, {"task": CAPTION, "deadline": time.time() + 60},
+                         {"task": CAPTION})
+
+    assert [e for e, _ in former.drop_expired()] == ["e0"]
+    assert [e for e, _, _ in former.pending] == ["e1", "e2"]
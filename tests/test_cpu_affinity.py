@@ -0,0 +1,51 @@
+import os
+import pytest
+
+from app.cpu_affinity import parse_cpus, format_cpus, split_cpus, apply_pinning
+
+
+def test_parse_and_format_round_trip():
+    assert parse_cpus("0-3,8, 10-11,") == [0, 1, 2, 3, 8, 10, 11]
+    assert format_cpus(parse_cpus("0-3,8")) == "0,1,2,3,8"
+    assert parse_cpus("") == []
+
+
+@pytest.mark.parametrize("count,parts,sizes", [(8, 2, [4, 4]), (10, 4, [3, 3, 2, 2]), (3, 3, [1, 1, 1]), (5, 1, [5])])
+def test_split_is_contiguous_and_near_equal(count, parts, sizes):
+    cpus = list(range(100, 100 + count))
+    sets = split_cpus(cpus, parts)
+
+    assert [len(s) for s in sets] == sizes
+    # Every core once, in order, each set a contiguous run
+    assert [cpu for s in sets for cpu in s] == cpus
+
+
+def test_split_keeps_gaps_in_the_available_set():
+    assert split_cpus(parse_cpus("0-1,4-5"), 2) == [[0, 1], [4, 5]]
+
+
+def test_pinning_follows_worker_cpus_and_threads(monkeypatch):
+    torch = pytest.importorskip("torch")
+    pinned, threads = [], []
+    monkeypatch.setattr(os, "sched_setaffinity", lambda pid, cpus: pinned.append(list(cpus)), raising=False)
+    monkeypatch.setattr(torch, "set_num_threads", threads.append)
+
+    monkeypatch.setenv("WORKER_CPUS", "2-4")
+    monkeypatch.delenv("WORKER_THREADS", raising=False)
+    assert apply_pinning() == ("2-4", 3)
+    assert pinned == [[2, 3, 4]] and threads == [3]
+
+    monkeypatch.setenv("WORKER_THREADS", "2")
+    assert apply_pinning() == ("2-4", 2)
+    assert threads[-1] == 2
+
+
+def test_no_pinning_without_worker_cpus(monkeypatch):
+    torch = pytest.importorskip("torch")
+    monkeypatch.delenv("WORKER_CPUS", raising=False)
+    monkeypatch.delenv("WORKER_THREADS", raising=False)
+    monkeypatch.setattr(os, "sched_setaffinity", lambda *args: pytest.fail("pinned"), raising=False)
+    monkeypatch.setattr(torch, "set_num_threads", lambda n: pytest.fail("threads set"))
+
+    assert apply_pinning() == (None, 0)
+
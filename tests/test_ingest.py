@@ -0,0 +1,55 @@
+import io
+import pytest
+
+Image = pytest.importorskip("PIL.Image")
+pytest.importorskip("structlog")
+
+from app import ingest
+from app.ingest import prepare_image, rescale_result
+from app.constants import OD, OCR_WITH_REGION, REFERRING_EXPRESSION_SEGMENTATION, CAPTION
+
+
+def jpeg(width, height):
+    buf = io.BytesIO()
+    Image.new("RGB", (width, height), (90, 120, 150)).save(buf, format="JPEG")
+    return buf.getvalue()
+
+
+def test_boxes_quads_and_nested_polygons_are_scaled_per_axis():
+    result = {
+        OD: {"bboxes": [[10, 20, 30, 40]], "labels": ["cat"]},
+        OCR_WITH_REGION: {"quad_boxes": [[1, 1, 3, 1, 3, 2, 1, 2]], "labels": ["text"]},
+        REFERRING_EXPRESSION_SEGMENTATION: {"polygons": [[[1, 2, 3, 4, 5, 6]]], "labels": [""]},
+    }
+    scaled = rescale_result(result, (2.0, 0.5))
+
+    assert scaled[OD] == {"bboxes": [[20.0, 10.0, 60.0, 20.0]], "labels": ["cat"]}
+    assert scaled[OCR_WITH_REGION]["quad_boxes"] == [[2.0, 0.5, 6.0, 0.5, 6.0, 1.0, 2.0, 1.0]]
+    assert scaled[REFERRING_EXPRESSION_SEGMENTATION]["polygons"] == [[[2.0, 1.0, 6.0, 2.0, 10.0, 3.0]]]
+
+
+def test_coordinates_are_rounded_to_two_decimals():
+    assert rescale_result({OD: {"bboxes": [[1, 1, 1, 1]]}}, (1 / 3, 2 / 3))[OD]["bboxes"] == [[0.33, 0.67, 0.33, 0.67]]
+
+
+def test_text_results_and_unscaled_uploads_pass_through():
+    result = {CAPTION: "a cat on a mat"}
+    assert rescale_result(result, (2.0, 2.0)) == result
+    assert rescale_result({OD: {"bboxes": [[1, 2, 3, 4]]}}, None) == {OD: {"bboxes": [[1, 2, 3, 4]]}}
+    assert rescale_result("error text", (2.0, 2.0)) == "error text"
+
+
+def test_large_uploads_are_downscaled_within_the_budget(monkeypatch):
+    monkeypatch.setattr(ingest, "INGEST_MAX_PIXELS", 100 * 100)
+    data, scale = prepare_image(jpeg(400, 200))
+
+    with Image.open(io.BytesIO(data)) as image:
+        assert image.width * image.height <= 100 * 100
+        assert scale == (400 / image.width, 200 / image.height)
+
+
+def test_small_and_unreadable_uploads_are_queued_as_is(monkeypatch):
+    monkeypatch.setattr(ingest, "INGEST_MAX_PIXELS", 100 * 100)
+    small = jpeg(50, 50)
+    assert prepare_image(small) == (small, None)
+    assert prepare_image(b"not an image") == (b"not an image", None)
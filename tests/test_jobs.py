@@ -0,0 +1,174 @@
+import json
+import asyncio
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("fastapi")
+
+from app import jobs, redis_model_proxy
+from app.jobs import JobStore, queue_job_update, job_key, JOB_STATES
+
+RESULT = {"<OD>": {"bboxes": [[1.0, 2.0, 3.0, 4.0]], "labels": ["cat"]}}
+
+
+def run(scenario):
+    """Runs scenario(worker, store): the worker's sync client and the API's JobStore on one in-memory Redis."""
+    async def main():
+        server = fakeredis.FakeServer()
+        return await scenario(fakeredis.FakeRedis(server=server), JobStore(fakeredis.aioredis.FakeRedis(server=server)))
+    return asyncio.run(main())
+
+
+def update(worker, job_id, status, **fields):
+    """A state change as the worker writes it."""
+    pipe = worker.pipeline(transaction=False)
+    queue_job_update(pipe, job_id, status, **fields)
+    pipe.execute()
+
+
+def parse(message):
+    """(event, data) of an SSE message, (None, comment) for a comment."""
+    if message.startswith(":"):
+        return None, message[1:].strip()
+    event, data = message.strip().split("\n")
+    return event.removeprefix("event: "), json.loads(data.removeprefix("data: "))
+
+
+async def collect(events):
+    return [parse(message) async for message in events]
+
+
+def test_job_moves_through_its_states_to_done():
+    async def scenario(worker, store):
+        await store.create("j1", task="<OD>", text_input=None, profile="quality", request_id="r1")
+        seen = [(await store.get("j1"))["status"]]
+        for status in ("batched", "generating"):
+            update(worker, "j1", status)
+            seen.append((await store.get("j1"))["status"])
+        update(worker, "j1", "done", result=RESULT)
+        return seen, await store.get("j1")
+
+    seen, job = run(scenario)
+    assert seen + [job["status"]] == [s for s in JOB_STATES if s != "failed"]
+    assert job["result_data"] == RESULT
+    assert job["task"] == "<OD>" and "text_input" not in job
+    assert job["updated_at"] >= job["created_at"]
+
+
+def test_failed_job_keeps_the_error():
+    async def scenario(worker, store):
+        await store.create("j1")
+        update(worker, "j1", "failed", error="Task expired in queue")
+        return await store.get("j1")
+
+    job = run(scenario)
+    assert (job["status"], job["error"]) == ("failed", "Task expired in queue")
+    assert "result_data" not in job
+
+
+def test_jobs_expire_after_their_last_update(monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_TTL", 60)
+
+    async def scenario(worker, store):
+        await store.create("j1")
+        worker.expire(job_key("j1"), 5)
+        # Every update renews the TTL
+        update(worker, "j1", "batched")
+        ttl = worker.ttl(job_key("j1"))
+        worker.delete(job_key("j1"))
+        return ttl, await store.get("j1")
+
+    ttl, job = run(scenario)
+    assert 5 < ttl <= 60
+    assert job is None
+
+
+def test_events_relay_every_change_and_end_with_the_result():
+    async def scenario(worker, store):
+        await store.create("j1")
+        events = store.events("j1")
+        # The first event means the stream is subscribed, later changes cannot be missed
+        first = parse(await anext(events))
+        update(worker, "j1", "batched")
+        update(worker, "j1", "generating")
+        update(worker, "j1", "done", result=RESULT)
+        return [first] + await collect(events)
+
+    events = run(scenario)
+    assert [(event, data["status"]) for event, data in events] == [
+        ("status", "queued"), ("status", "batched"), ("status", "generating"), ("status", "done")]
+    assert events[-1][1]["result_data"] == RESULT
+
+
+def test_events_of_a_final_job_end_at_once():
+    async def scenario(worker, store):
+        await store.create("j1", "done", result=RESULT)
+        return await collect(store.events("j1"))
+
+    events = run(scenario)
+    assert len(events) == 1
+    assert (events[0][1]["status"], events[0][1]["result_data"]) == ("done", RESULT)
+
+
+def test_events_of_an_unknown_job_report_an_error():
+    async def scenario(worker, store):
+        return await collect(store.events("missing"))
+
+    assert run(scenario) == [("error", {"job_id": "missing", "detail": "Unknown or expired job"})]
+
+
+def test_idle_stream_sends_keepalives_and_notices_a_missed_final_state(monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_EVENTS_KEEPALIVE_S", 0)
+
+    async def scenario(worker, store):
+        await store.create("j1")
+        events = store.events("j1")
+        await anext(events)
+        # Written without its event, as if it was published while the subscription reconnected
+        worker.hset(job_key("j1"), mapping={"status": "failed", "error": "boom"})
+        return await collect(events)
+
+    events = run(scenario)
+    assert events[0] == (None, "keepalive")
+    assert events[-1][0] == "status"
+    assert (events[-1][1]["status"], events[-1][1]["error"]) == ("failed", "boom")
+
+
+def test_stream_of_an_expired_job_ends_with_an_error(monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_EVENTS_KEEPALIVE_S", 0)
+
+    async def scenario(worker, store):
+        await store.create("j1")
+        events = store.events("j1")
+        await anext(events)
+        worker.delete(job_key("j1"))
+        return await collect(events)
+
+    assert run(scenario) == [(None, "keepalive"), ("error", {"job_id": "j1", "detail": "Unknown or expired job"})]
+
+
+def test_events_endpoint_streams_until_the_job_is_final(monkeypatch):
+    florence_api = pytest.importorskip("api.florence_api")
+
+    async def main():
+        server = fakeredis.FakeServer()
+        monkeypatch.setattr(redis_model_proxy.aioredis, "from_url",
+                            lambda url: fakeredis.aioredis.FakeRedis(server=server))
+        proxy = redis_model_proxy.RedisModelProxy()
+        monkeypatch.setattr(florence_api, "model_proxy", proxy)
+        worker = fakeredis.FakeRedis(server=server)
+        try:
+            await proxy.jobs.create("j1")
+            response = await florence_api.job_events("j1")
+            body = response.body_iterator
+            first = parse(await anext(body))
+            update(worker, "j1", "generating")
+            update(worker, "j1", "done", result=RESULT)
+            return response.media_type, [first] + await collect(body)
+        finally:
+            await proxy.close()
+
+    media_type, events = asyncio.run(main())
+    assert media_type == "text/event-stream"
+    assert [data["status"] for _, data in events] == ["queued", "generating", "done"]
+    assert events[-1][1]["result_data"] == RESULT
@@ -0,0 +1,66 @@
+import asyncio
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")
+pytest.importorskip("fastapi")
+
+from app import redis_model_proxy, wire
+from app.redis_model_proxy import RedisModelProxy
+from app.single_flight import JOIN_SCRIPT, flight_keys, waiter_address
+
+
+def run(scenario, monkeypatch):
+    """Runs scenario(client, proxy) with the proxy bound to a fresh in-memory Redis."""
+    async def main():
+        server = fakeredis.FakeServer()
+        monkeypatch.setattr(redis_model_proxy.aioredis, "from_url",
+                            lambda url: fakeredis.aioredis.FakeRedis(server=server))
+        proxy = RedisModelProxy()
+        proxy._ensure_listener()
+        try:
+            return await scenario(fakeredis.aioredis.FakeRedis(server=server), proxy)
+        finally:
+            await proxy.close()
+    return asyncio.run(main())
+
+
+def test_failed_leader_releases_the_flight_and_fails_its_waiters(monkeypatch):
+    def broken_attach(payload, image_data, task_id):
+        raise OSError("no space left on device")
+    monkeypatch.setattr(wire, "attach_image", broken_attach)
+
+    async def scenario(client, proxy):
+        keys = flight_keys("abc")
+        # A request from another process joins right after the leader won the flight
+        original_join = proxy._join_flight
+
+        async def join_then_wait(coalesce_key, task_id):
+            is_leader = await original_join(coalesce_key, task_id)
+            await client.register_script(JOIN_SCRIPT)(keys=keys, args=[waiter_address("t2", "replies:other"), 30000])
+            return is_leader
+        proxy._join_flight = join_then_wait
+
+        with pytest.raises(OSError):
+            await proxy._dispatch({"task": "<OD>"}, b"image", coalesce_key="abc", task_id="leader")
+
+        assert not await client.exists(*keys)
+        reply = wire.unpack(await client.rpop("replies:other"))
+        assert reply["task_id"] == "t2"
+        assert "no space left on device" in reply["error"]
+        assert await client.llen("florence_tasks") == 0
+
+    run(scenario, monkeypatch)
+
+
+def test_failed_leader_without_waiters_lets_the_next_request_lead(monkeypatch):
+    async def scenario(client, proxy):
+        def broken_push(pipe, raw):
+            raise ConnectionError("redis went away")
+        proxy._queue.push = broken_push
+
+        with pytest.raises(ConnectionError):
+            await proxy._dispatch({"task": "<OD>"}, b"image", coalesce_key="abc", task_id="leader")
+        assert await proxy._join_flight("abc", "next")
+
+    run(scenario, monkeypatch)
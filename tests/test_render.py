@@ -0,0 +1,77 @@
+import math
+import random
+import numpy as np
+import pytest
+
+pytest.importorskip("matplotlib")
+from PIL import Image, ImageFilter
+
+from app import render
+from app.utils import plot_bbox, fig_to_pil, draw_polygons, draw_ocr_bboxes
+
+BACKGROUND = (90, 90, 90)
+
+
+def blank(size):
+    return Image.new("RGB", size, BACKGROUND)
+
+
+def polygon(width, height):
+    cx, cy, r = width / 2, height / 2, min(width, height) / 3
+    points = []
+    for i in range(32):
+        angle = i / 32 * 2 * math.pi
+        points += [cx + r * (0.7 + 0.3 * (i % 3) / 2) * math.cos(angle), cy + r * math.sin(angle)]
+    return points
+
+
+def red(pixels):
+    return (pixels[..., 0] > 180) & (pixels[..., 1] < 80) & (pixels[..., 2] < 80)
+
+
+def grow(mask, size):
+    return np.asarray(Image.fromarray(mask.astype(np.uint8) * 255).filter(ImageFilter.MaxFilter(size))) > 0
+
+
+def test_masks_match_the_legacy_solid_fill():
+    prediction = {"polygons": [[polygon(640, 480)]], "labels": [""]}
+    legacy = draw_polygons(blank((640, 480)), prediction, fill_mask=True)
+    assert np.array_equal(np.asarray(render.draw_masks(blank((640, 480)), prediction)), np.asarray(legacy))
+
+
+def test_masks_can_be_blended():
+    prediction = {"polygons": [polygon(640, 480)]}
+    pixels = np.asarray(render.draw_masks(blank((640, 480)), prediction, opacity=0.5))
+    assert tuple(pixels[240, 320]) == (172, 45, 45)
+    assert tuple(pixels[5, 635]) == BACKGROUND
+
+
+def test_quads_match_the_legacy_drawing():
+    boxes = [[40, 60, 200, 60, 200, 120, 40, 120], [300, 200, 500, 210, 495, 300, 298, 290]]
+    prediction = {"quad_boxes": boxes, "labels": ["hello world", "receipt total"]}
+    # The colours are picked at random, as they always were
+    random.seed(7)
+    legacy = draw_ocr_bboxes(blank((640, 480)), prediction)
+    random.seed(7)
+    assert np.array_equal(np.asarray(render.draw_quads(blank((640, 480)), prediction)), np.asarray(legacy))
+
+
+@pytest.mark.parametrize("size", [(640, 480), (1920, 1080)])
+def test_boxes_match_the_legacy_plot(size):
+    width, height = size
+    prediction = {"bboxes": [[width * .1, height * .3, width * .4, height * .8],
+                             [width * .6, height * .2, width * .9, height * .6]],
+                  "labels": ["cat", "dog"]}
+    legacy = fig_to_pil(plot_bbox(blank(size), prediction)).convert("RGB")
+
+    # The plot framed the image with white margins and resampled it, cut it out and scale it back
+    ys, xs = np.where(np.abs(np.asarray(legacy, dtype=int) - BACKGROUND).sum(-1) < 6)
+    legacy = legacy.crop((xs.min(), ys.min(), xs.max() + 1, ys.max() + 1)).resize(size, Image.BILINEAR)
+    # Resampling moves edges by up to a pixel of the figure, which is this many pixels of the image
+    tolerance = 2 * math.ceil(2 * width / (xs.max() + 1 - xs.min())) + 1
+
+    legacy_red = red(np.asarray(legacy))
+    new_red = red(np.asarray(render.draw_bboxes(blank(size), prediction)))
+    assert legacy_red.sum() == pytest.approx(new_red.sum(), rel=0.1)
+    assert (legacy_red & grow(new_red, tolerance)).sum() / legacy_red.sum() > 0.95
+    assert (new_red & grow(legacy_red, tolerance)).sum() / new_red.sum() > 0.95
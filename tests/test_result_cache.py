@@ -0,0 +1,126 @@
+import asyncio
+import itertools
+from types import SimpleNamespace
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("fastapi")
+
+from app import result_cache, redis_model_proxy
+from app.redis_model_proxy import RedisModelProxy
+from app.result_cache import ResultCache, make_cache_key, LRU_INDEX_KEY
+
+RESULT = {"<OD>": {"bboxes": [[1.0, 2.0, 3.0, 4.0]], "labels": ["cat"]}}
+
+
+@pytest.fixture(autouse=True)
+def settings(monkeypatch):
+    monkeypatch.setattr(redis_model_proxy, "RESULT_CACHE_ENABLED", True)
+    monkeypatch.setattr(result_cache, "RESULT_CACHE_MAX_ENTRIES", 100)
+    # Every call is a tick later, so LRU order does not depend on the clock's resolution
+    clock = itertools.count(1_000_000)
+    monkeypatch.setattr(result_cache, "time", SimpleNamespace(time=lambda: float(next(clock))))
+
+
+def run(scenario):
+    """Runs scenario(client, proxy) with the proxy's result cache on a fresh in-memory Redis."""
+    async def main():
+        client = fakeredis.aioredis.FakeRedis()
+        proxy = RedisModelProxy()
+        proxy._cache = ResultCache(client)
+        return await scenario(client, proxy)
+    return asyncio.run(main())
+
+
+def test_request_key_covers_everything_that_changes_the_result():
+    proxy = RedisModelProxy()
+    key = proxy._request_key(b"image", "<OD>", None, "quality")
+
+    assert key == proxy._request_key(b"image", "<OD>", None, "quality")
+    assert key != proxy._request_key(b"other image", "<OD>", None, "quality")
+    assert key != proxy._request_key(b"image", "<CAPTION>", None, "quality")
+    assert key != proxy._request_key(b"image", "<OD>", "a cat", "quality")
+    assert key != proxy._request_key(b"image", "<OD>", None, "fast")
+
+
+def test_request_key_covers_precision_and_backend():
+    proxy = RedisModelProxy()
+    fp32_torch = proxy._request_key(b"image", "<OD>", None, "quality")
+
+    proxy.config.CPU_PRECISION = "INT8"
+    int8_torch = proxy._request_key(b"image", "<OD>", None, "quality")
+    proxy.config.INFERENCE_BACKEND = "ONNX"
+    int8_onnx = proxy._request_key(b"image", "<OD>", None, "quality")
+
+    assert len({fp32_torch, int8_torch, int8_onnx}) == 3
+    assert int8_onnx == make_cache_key(b"image", "<OD>", None, proxy.config.MODEL_ID,
+                                       proxy.config.generation_kwargs("quality"), "int8", "onnx")
+
+
+def test_results_round_trip_and_count_hits_and_misses():
+    async def scenario(client, proxy):
+        assert await proxy._cache_get("k1") is None
+        await proxy._cache_set("k1", RESULT)
+        assert await proxy._cache_get("k1") == RESULT
+        assert await proxy._cache_get("k1") == RESULT
+        return await proxy._cache.stats()
+
+    stats = run(scenario)
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (2, 1, 1)
+    assert stats["hit_rate"] == pytest.approx(0.6667)
+
+
+def test_least_recently_used_results_are_evicted(monkeypatch):
+    monkeypatch.setattr(result_cache, "RESULT_CACHE_MAX_ENTRIES", 2)
+
+    async def scenario(client, proxy):
+        await proxy._cache_set("old", RESULT)
+        await proxy._cache_set("used", RESULT)
+        # Reading makes it the most recently used, so "old" goes first
+        await proxy._cache_get("old")
+        await proxy._cache_set("new", RESULT)
+
+        assert await client.zrange(LRU_INDEX_KEY, 0, -1) == [b"old", b"new"]
+        assert not await client.exists(ResultCache._entry_key("used"))
+        assert await proxy._cache_get("used") is None
+        assert await proxy._cache_get("old") == RESULT
+
+    run(scenario)
+
+
+def test_oversized_results_are_not_cached(monkeypatch):
+    monkeypatch.setattr(result_cache, "RESULT_CACHE_MAX_ITEM_BYTES", 16)
+
+    async def scenario(client, proxy):
+        await proxy._cache_set("big", {"<OCR>": "x" * 100})
+        assert await proxy._cache_get("big") is None
+        assert await client.zcard(LRU_INDEX_KEY) == 0
+
+    run(scenario)
+
+
+def test_cache_errors_are_treated_as_misses():
+    class BrokenCache:
+        async def get(self, key):
+            raise ConnectionError("redis went away")
+
+        async def set(self, key, result):
+            raise ConnectionError("redis went away")
+
+    async def scenario(client, proxy):
+        proxy._cache = BrokenCache()
+        assert await proxy._cache_get("k1") is None
+        await proxy._cache_set("k1", RESULT)
+
+    run(scenario)
+
+
+def test_disabled_cache_is_never_touched(monkeypatch):
+    monkeypatch.setattr(redis_model_proxy, "RESULT_CACHE_ENABLED", False)
+
+    async def scenario(client, proxy):
+        await proxy._cache_set("k1", RESULT)
+        assert await proxy._cache_get("k1") is None
+        assert await client.keys("*") == []
+
+    run(scenario)
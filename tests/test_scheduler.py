@@ -0,0 +1,130 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from app.scheduler import DecodeRequest, _Sequence
+
+RULES = {
+    "decoder_start_token_id": 2,
+    "eos_token_id": 2,
+    "forced_bos_token_id": 0,
+    "forced_eos_token_id": 2,
+    "no_repeat_ngram_size": 0,
+    "length_penalty": 1.0,
+    "early_stopping": False,
+}
+VOCAB = 8
+
+
+def sequence(num_beams=1, max_new_tokens=10, **rules):
+    return _Sequence(DecodeRequest(None, "", num_beams=num_beams, max_new_tokens=max_new_tokens), {**RULES, **rules})
+
+
+def logprobs_favouring(width, *tokens):
+    """Log-probabilities (width, VOCAB) where each beam prefers tokens in the given order."""
+    logits = torch.full((width, VOCAB), -10.0)
+    for rank, token in enumerate(tokens):
+        logits[:, token] = -float(rank)
+    return logits.log_softmax(-1)
+
+
+def test_greedy_forces_bos_first_and_stops_at_eos():
+    seq = sequence()
+    seq.advance(logprobs_favouring(1, 5))
+    assert seq.beams[0] == [2, 0]
+
+    seq.advance(logprobs_favouring(1, 5))
+    seq.advance(logprobs_favouring(1, 2))
+    assert seq.done
+    assert seq.result() == [2, 0, 5, 2]
+
+
+def test_greedy_forces_eos_at_the_token_budget():
+    seq = sequence(max_new_tokens=3)
+    for _ in range(3):
+        seq.advance(logprobs_favouring(1, 5))
+    assert seq.done
+    assert seq.result() == [2, 0, 5, 2]
+
+
+def test_no_repeat_ngram_bans_the_completing_token():
+    seq = sequence(no_repeat_ngram_size=2)
+    seq.beams[0] = [2, 0, 5, 6, 5]
+    seq.generated = 4
+    # 5 -> 6 was already generated, so 6 may not follow 5 again
+    seq.advance(logprobs_favouring(1, 6, 7))
+    assert seq.beams[0][-1] == 7
+
+
+def test_only_the_first_beam_is_live_at_the_first_step():
+    seq = sequence(num_beams=3, forced_bos_token_id=None)
+    parents = seq.advance(logprobs_favouring(3, 5, 6, 7))
+    assert parents == [0, 0, 0]
+    assert [beam[-1] for beam in seq.beams] == [5, 6, 7]
+
+
+@pytest.mark.parametrize("length_penalty", [0.5, 1.0, 2.0])
+def test_hypotheses_are_scored_with_the_length_penalty(length_penalty):
+    seq = sequence(num_beams=2, length_penalty=length_penalty)
+    seq.generated = 4
+    seq._add_hypothesis([2, 0, 5, 6, 2], -2.0)
+    assert seq.hypotheses == [(-2.0 / 4 ** length_penalty, [2, 0, 5, 6, 2])]
+
+
+def test_hypotheses_keep_only_the_best_width():
+    seq = sequence(num_beams=2)
+    seq.generated = 2
+    for tokens, score in (([1], -3.0), ([2], -1.0), ([3], -2.0)):
+        seq._add_hypothesis(tokens, score)
+    assert [tokens for _, tokens in seq.hypotheses] == [[2], [3]]
+
+
+def test_beam_search_stops_when_no_running_beam_can_win():
+    seq = sequence(num_beams=2)
+    seq.generated = 4
+    seq._add_hypothesis([1], -1.0)
+    seq._add_hypothesis([2], -2.0)
+    # The worst kept hypothesis scores -0.5, a best candidate at -4.0 can reach -1.0 at best
+    assert seq._beam_search_done(-4.0)
+    assert not seq._beam_search_done(-1.0)
+
+
+def test_early_stopping_ends_once_width_hypotheses_are_found():
+    seq = sequence(num_beams=2, early_stopping=True)
+    seq.generated = 2
+    seq._add_hypothesis([1], -1.0)
+    seq._add_hypothesis([2], -9.0)
+    assert seq._beam_search_done(0.0)
+
+
+@pytest.mark.parametrize("seed", range(4))
+@pytest.mark.parametrize("length_penalty", [0.5, 1.0, 2.0])
+@pytest.mark.parametrize("early_stopping", [False, True])
+def test_beam_search_matches_generate(seed, length_penalty, early_stopping):
+    """Decodes a tiny random BART with _Sequence and with generate(), same rules, same result."""
+    from transformers import BartConfig, BartForConditionalGeneration, GenerationConfig
+
+    torch.manual_seed(seed)
+    config = BartConfig(vocab_size=32, d_model=16, encoder_layers=1, decoder_layers=1,
+                        encoder_attention_heads=2, decoder_attention_heads=2,
+                        encoder_ffn_dim=32, decoder_ffn_dim=32, max_position_embeddings=64)
+    model = BartForConditionalGeneration(config).eval()
+    # A random model rarely ends on its own, finished hypotheses of several lengths are what the penalty is about
+    model.final_logits_bias[0, config.eos_token_id] = 0.5
+    input_ids = torch.tensor([[0, 5, 9, 13, 2]])
+    rules = {**RULES, "no_repeat_ngram_size": 3, "length_penalty": length_penalty, "early_stopping": early_stopping}
+
+    generation = GenerationConfig(num_beams=3, max_new_tokens=12, do_sample=False, min_length=0, **rules)
+    expected = model.generate(input_ids, generation_config=generation)[0].tolist()
+
+    seq = _Sequence(DecodeRequest(None, "", num_beams=3, max_new_tokens=12), rules)
+    with torch.no_grad():
+        encoder_states = model.get_encoder()(input_ids).last_hidden_state
+        while not seq.done:
+            beams = torch.tensor(seq.beams)
+            logits = model(encoder_outputs=(encoder_states.expand(len(beams), -1, -1),),
+                           decoder_input_ids=beams).logits[:, -1]
+            seq.advance(logits.log_softmax(-1))
+
+    assert seq.result() == expected
@@ -0,0 +1,56 @@
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")
+
+from app.single_flight import (
+    JOIN_SCRIPT, FINISH_SCRIPT, flight_keys, waiter_address, parse_waiter_address
+)
+
+
+@pytest.fixture
+def client():
+    return fakeredis.FakeRedis()
+
+
+@pytest.fixture
+def scripts(client):
+    return client.register_script(JOIN_SCRIPT), client.register_script(FINISH_SCRIPT)
+
+
+def test_first_request_leads_and_identical_ones_wait(client, scripts):
+    join, finish = scripts
+    keys = flight_keys("abc")
+
+    assert join(keys=keys, args=[waiter_address("t1", "replies:1"), 30000]) == 1
+    assert join(keys=keys, args=[waiter_address("t2", "replies:2"), 30000]) == 0
+    assert join(keys=keys, args=[waiter_address("t3", "replies:1"), 30000]) == 0
+
+    waiters = sorted(parse_waiter_address(w) for w in finish(keys=keys))
+    assert waiters == [("t2", "replies:2"), ("t3", "replies:1")]
+    assert not client.exists(*keys)
+
+
+def test_finished_flight_lets_the_next_request_lead(scripts):
+    join, finish = scripts
+    keys = flight_keys("abc")
+
+    join(keys=keys, args=[waiter_address("t1", "r"), 30000])
+    assert finish(keys=keys) == []
+    assert join(keys=keys, args=[waiter_address("t2", "r"), 30000]) == 1
+
+
+def test_flights_expire_with_their_ttl(client, scripts):
+    join, _ = scripts
+    keys = flight_keys("abc")
+
+    join(keys=keys, args=[waiter_address("t1", "r"), 30000])
+    join(keys=keys, args=[waiter_address("t2", "r"), 30000])
+    assert 0 < client.pttl(keys[0]) <= 30000
+    assert 0 < client.pttl(keys[1]) <= 30000
+
+
+def test_waiter_address_round_trip():
+    # Reply keys may contain the separator, task ids never do
+    assert parse_waiter_address(waiter_address("t1", "replies@host")) == ("t1", "replies@host")
+    assert parse_waiter_address(b"t1@replies") == ("t1", "replies")
@@ -0,0 +1,154 @@
+import time
+import asyncio
+import threading
+import pytest
+
+pytest.importorskip("boto3")
+pytest.importorskip("chainlit")
+moto = pytest.importorskip("moto")
+
+from app import config
+from app.config import S3StorageClient, get_storage_client
+
+BUCKET = "florence-test"
+
+
+@pytest.fixture
+def storage(monkeypatch):
+    monkeypatch.setenv("S3_BUCKET", BUCKET)
+    monkeypatch.delenv("S3_ENDPOINT_URL", raising=False)
+    monkeypatch.setenv("S3_ACCESS_KEY", "test")
+    monkeypatch.setenv("S3_SECRET_KEY", "test")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with moto.mock_aws():
+        client = S3StorageClient()
+        client.client.create_bucket(Bucket=BUCKET)
+        yield client
+        client._executor.shutdown(wait=True)
+
+
+def count_puts(client):
+    calls = []
+    put_object = client.client.put_object
+
+    def counting(**kwargs):
+        calls.append(kwargs["Key"])
+        return put_object(**kwargs)
+
+    client.client.put_object = counting
+    return calls
+
+
+def test_run_executes_on_the_s3_pool_off_the_event_loop(storage):
+    async def main():
+        loop_thread = threading.current_thread().name
+        thread = await storage._run(lambda: threading.current_thread().name)
+        return loop_thread, thread
+
+    loop_thread, thread = asyncio.run(main())
+    assert thread.startswith("s3") and thread != loop_thread
+
+
+def test_run_passes_arguments_and_raises_errors(storage):
+    async def main():
+        assert await storage._run(lambda a, b=0: a + b, 1, b=2) == 3
+        with pytest.raises(storage.client.exceptions.NoSuchKey):
+            await storage._run(storage.client.get_object, Bucket=BUCKET, Key="missing")
+
+    asyncio.run(main())
+
+
+def test_uploads_overlap_instead_of_blocking_the_loop(storage):
+    def slow():
+        time.sleep(0.2)
+        return True
+
+    async def main():
+        start = time.perf_counter()
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+
+        ticker = asyncio.create_task(tick())
+        assert await asyncio.gather(*(storage._run(slow) for _ in range(4))) == [True] * 4
+        ticker.cancel()
+        return time.perf_counter() - start, ticks
+
+    elapsed, ticks = asyncio.run(main())
+    assert elapsed < 0.6
+    assert ticks >= 10
+
+
+def test_content_addressed_upload_is_stored_once(storage):
+    puts = count_puts(storage)
+
+    async def main():
+        first = await storage.store_content_addressed(b"image bytes", "image/jpeg")
+        second = await storage.store_content_addressed(b"image bytes", "image/jpeg")
+        other = await storage.store_content_addressed(b"other bytes", "image/jpeg")
+        return first, second, other, await storage.download_file(first)
+
+    first, second, other, body = asyncio.run(main())
+    assert first == second != other
+    assert first.startswith(f"{config.INPUT_KEY_PREFIX}/") and first.endswith(".jpg")
+    assert puts == [first, other]
+    assert body == b"image bytes"
+
+
+def test_object_already_in_s3_is_not_uploaded_again(storage):
+    async def main():
+        return await storage.store_content_addressed(b"image bytes", "image/png")
+
+    key = asyncio.run(main())
+    # A fresh process knows nothing about the key, S3 still has it
+    storage._recent_keys.clear()
+    puts = count_puts(storage)
+    assert asyncio.run(main()) == key
+    assert puts == []
+
+
+def test_cancelled_uploads_leave_the_pool_usable(storage):
+    release = threading.Event()
+    put_object = storage.client.put_object
+
+    def blocked_put(**kwargs):
+        release.wait(5)
+        return put_object(**kwargs)
+
+    storage.client.put_object = blocked_put
+
+    async def main():
+        uploads = [
+            asyncio.create_task(storage.upload_file(data=b"x", mime="image/png", threadId="t", object_key=f"f{i}.png"))
+            for i in range(8)
+        ]
+        await asyncio.sleep(0.05)
+        for upload in uploads:
+            upload.cancel()
+        # Cancellation returns at once, it does not wait for the blocked boto3 calls
+        start = time.perf_counter()
+        results = await asyncio.gather(*uploads, return_exceptions=True)
+        cancelled_in = time.perf_counter() - start
+
+        release.set()
+        storage.client.put_object = put_object
+        key = await storage.store_content_addressed(b"after cancel", "image/png")
+        return results, cancelled_in, key
+
+    results, cancelled_in, key = asyncio.run(main())
+    assert all(isinstance(r, asyncio.CancelledError) for r in results)
+    assert cancelled_in < 0.5
+    assert storage.client.head_object(Bucket=BUCKET, Key=key)
+
+
+def test_get_storage_client_shares_one_client(monkeypatch):
+    monkeypatch.setattr(config, "_shared_storage_client", None)
+    created = []
+    monkeypatch.setattr(config, "S3StorageClient", lambda: created.append(object()) or created[-1])
+
+    assert get_storage_client() is get_storage_client()
+    assert len(created) == 1
@@ -0,0 +1,108 @@
+import time
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+
+from app import task_queue
+from app.task_queue import StreamTaskQueue, ListTaskQueue
+
+
+@pytest.fixture
+def client():
+    return fakeredis.FakeRedis()
+
+
+def stream_queue(client, consumer):
+    queue = StreamTaskQueue(client, consumer=consumer)
+    queue.setup()
+    return queue
+
+
+def idle_ms(client, queue, entry_id):
+    info = client.xpending_range(queue.key, queue.group, min=entry_id, max=entry_id, count=1)
+    return info[0]["time_since_delivered"]
+
+
+def test_stream_delivers_each_entry_once_and_acked_entries_are_gone(client):
+    a, b = stream_queue(client, "a"), stream_queue(client, "b")
+    a.push(client, b"one")
+    a.push(client, b"two")
+
+    first = a.pop(1)
+    second = b.pop(10)
+    assert [raw for _, raw in first + second] == [b"one", b"two"]
+
+    a.ack([entry_id for entry_id, _ in first])
+    b.ack([entry_id for entry_id, _ in second])
+    assert a.depth() == 0
+
+
+def test_entries_of_a_stopped_worker_are_claimed(client, monkeypatch):
+    monkeypatch.setattr(task_queue, "STREAM_CLAIM_IDLE_MS", 50)
+    monkeypatch.setattr(task_queue, "STREAM_CLAIM_INTERVAL_S", 0)
+    dead, live = stream_queue(client, "dead"), stream_queue(client, "live")
+    dead.push(client, b"task")
+    [(entry_id, _)] = dead.pop(1)
+
+    time.sleep(0.1)
+    assert live.pop(1) == [(entry_id, b"task")]
+
+
+def test_held_entries_are_refreshed_and_not_claimed(client, monkeypatch):
+    monkeypatch.setattr(task_queue, "STREAM_CLAIM_IDLE_MS", 150)
+    monkeypatch.setattr(task_queue, "STREAM_CLAIM_INTERVAL_S", 0)
+    monkeypatch.setattr(task_queue, "STREAM_REFRESH_INTERVAL_S", 0.05)
+    holder, other = stream_queue(client, "holder"), stream_queue(client, "other")
+    holder.push(client, b"task")
+    [(entry_id, _)] = holder.pop(1)
+
+    # Held for longer than the claim idle time, refreshed along the way like the worker loop does
+    for _ in range(6):
+        time.sleep(0.05)
+        holder.refresh()
+        assert other.pop(1) == []
+    assert idle_ms(client, holder, entry_id) < 150
+
+    # Once acked it is no longer refreshed
+    holder.ack([entry_id])
+    assert not holder._held
+
+
+def test_refresh_does_not_count_as_a_delivery(client, monkeypatch):
+    monkeypatch.setattr(task_queue, "STREAM_REFRESH_INTERVAL_S", 0)
+    queue = stream_queue(client, "holder")
+    queue.push(client, b"task")
+    [(entry_id, _)] = queue.pop(1)
+
+    queue.refresh()
+    queue.refresh()
+    info = client.xpending_range(queue.key, queue.group, min=entry_id, max=entry_id, count=1)
+    assert info[0]["times_delivered"] == 1
+
+
+def test_list_queue_pops_in_order(client):
+    queue = ListTaskQueue(client)
+    for raw in (b"one", b"two", b"three"):
+        queue.push(client, raw)
+    assert [raw for _, raw in queue.pop(2)] == [b"one", b"two"]
+    queue.refresh()
+    assert queue.depth() == 1
+
+
+def test_repeatedly_failing_entries_are_handed_back_for_an_error_reply(client, monkeypatch):
+    monkeypatch.setattr(task_queue, "STREAM_CLAIM_IDLE_MS", 0)
+    monkeypatch.setattr(task_queue, "STREAM_CLAIM_INTERVAL_S", 0)
+    monkeypatch.setattr(task_queue, "STREAM_MAX_DELIVERIES", 2)
+    queue = stream_queue(client, "worker")
+    queue.push(client, b"poison")
+    [(entry_id, _)] = queue.pop(1)
+    # Crashed and redelivered up to the limit
+    assert queue.pop(1) == [(entry_id, b"poison")]
+
+    assert queue.pop(1) == []
+    assert queue.dead_letters() == [(entry_id, b"poison")]
+    assert queue.dead_letters() == []
+    # Still pending until the worker has answered it
+    assert client.xpending(queue.key, queue.group)["pending"] == 1
+    queue.ack([entry_id])
+    assert client.xpending(queue.key, queue.group)["pending"] == 0
@@ -0,0 +1,63 @@
+import os
+import pytest
+
+pytest.importorskip("msgpack")
+
+from app import wire
+
+IMAGE = b"\x89PNG\r\n\x1a\n" + bytes(range(256)) * 64
+
+
+def test_pack_round_trip_keeps_bytes_raw():
+    task = {"task_id": "t1", "deadline": 1234.5, "tasks": ["<OD>", "<CAPTION>"], "text_input": None,
+            "scale": [2.0, 2.0], "image": IMAGE}
+    raw = wire.pack(task)
+
+    assert wire.unpack(raw) == task
+    # Bytes travel as a msgpack bin field, not base64 text
+    assert len(raw) < len(IMAGE) + 200
+    assert isinstance(wire.unpack(raw)["image"], bytes)
+
+
+def test_inline_image_without_shm(monkeypatch):
+    monkeypatch.setattr(wire, "SHM_TRANSPORT", False)
+    payload = {}
+
+    assert wire.attach_image(payload, IMAGE, "t1") is None
+    assert payload == {"image": IMAGE}
+    assert wire.has_image(payload)
+    assert wire.read_image(wire.unpack(wire.pack(payload))) == IMAGE
+    wire.release_image(None)
+
+
+def test_image_through_shm(monkeypatch, tmp_path):
+    monkeypatch.setattr(wire, "SHM_TRANSPORT", True)
+    monkeypatch.setattr(wire, "SHM_DIR", str(tmp_path / "florence"))
+    payload = {}
+
+    path = wire.attach_image(payload, IMAGE, "t1")
+    assert path == str(tmp_path / "florence" / "t1")
+    assert payload == {"image_shm": path}
+    assert wire.has_image(payload)
+    assert wire.read_image(wire.unpack(wire.pack(payload))) == IMAGE
+
+    wire.release_image(path)
+    assert not os.path.exists(path)
+    # Releasing twice is harmless, the worker may have raced the caller
+    wire.release_image(path)
+
+
+def test_falls_back_to_inline_when_shm_is_unavailable(monkeypatch, tmp_path):
+    blocker = tmp_path / "not_a_dir"
+    blocker.write_bytes(b"")
+    monkeypatch.setattr(wire, "SHM_TRANSPORT", True)
+    monkeypatch.setattr(wire, "SHM_DIR", str(blocker / "florence"))
+    payload = {}
+
+    assert wire.attach_image(payload, IMAGE, "t1") is None
+    assert payload == {"image": IMAGE}
+    assert wire.read_image(payload) == IMAGE
+
+
+def test_payload_without_image():
+    assert not wire.has_image({"task_id": "t1"})